@@ -0,0 +1,991 @@
+"""stmp.py 性能基准
+
+用法: python bench_stmp.py [基准名 ...]
+不带参数时运行除 suite 以外的全部基准。
+
+    python bench_stmp.py suite [--pages 1,100,1000] [--json 结果.json] [--compare 旧结果.json]
+
+suite 在本地生成合成PDF（混合页面尺寸）和印章（小图与4K），逐项测量加载、印章处理、
+预览重绘/拖拽、add_stamp_to_pdf 与导出的耗时、峰值内存和输出大小，结果写入JSON，
+可与之前版本的结果对比。每项在独立进程中运行，峰值内存互不影响。
+"""
+import argparse
+import io
+import json
+import math
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from types import SimpleNamespace
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import numpy as np
+from PIL import Image
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfgen import canvas
+
+import stmp
+
+
+def make_seal(width, height, seed=0):
+    """生成合成印章图片：白底 + 红色圆环 + 灰色阴影噪点"""
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:height, 0:width]
+    cx, cy = width / 2, height / 2
+    r = np.hypot((xx - cx) / (width / 2), (yy - cy) / (height / 2))
+    rgb = np.full((height, width, 3), 250, dtype=np.uint8)
+    ring = (r > 0.8) & (r < 0.95)
+    rgb[ring] = (200, 40, 40)
+    shadow = rng.random((height, width)) < 0.05
+    rgb[shadow & ~ring] = (200, 200, 200)
+    return Image.fromarray(rgb, "RGB").convert("RGBA")
+
+
+def make_pdf(path, pages, page_size=(595, 842)):
+    """生成合成PDF，每页一行文字"""
+    c = canvas.Canvas(path, pagesize=page_size)
+    for i in range(pages):
+        c.drawString(72, page_size[1] - 72, f"page {i + 1}")
+        c.showPage()
+    c.save()
+
+
+# 混合页面尺寸：A4 纵向、Letter、A3 横向、A5
+MIXED_PAGE_SIZES = [(595, 842), (612, 792), (1191, 842), (420, 595)]
+
+
+def make_mixed_pdf(path, pages):
+    """生成页面尺寸循环变化的合成PDF"""
+    c = canvas.Canvas(path)
+    for i in range(pages):
+        width, height = MIXED_PAGE_SIZES[i % len(MIXED_PAGE_SIZES)]
+        c.setPageSize((width, height))
+        c.drawString(72, height - 72, f"page {i + 1} ({width}x{height})")
+        c.rect(36, 36, width - 72, height - 72)
+        c.showPage()
+    c.save()
+
+
+def make_shared_resources_pdf(path, pages):
+    """生成各页共用一个间接 /Resources 的PDF（/Font 为直接字典，字体为间接对象），
+    reportlab 不会生成这种结构，这里直接写出PDF对象"""
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None,
+               b"<< /Font << /F1 4 0 R /F2 5 0 R >> >>",
+               b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+               b"<< /Type /Font /Subtype /Type1 /BaseFont /Courier >>"]
+    kids = []
+    for i in range(pages):
+        content = (f"BT /F1 18 Tf 72 720 Td (Helvetica {i + 1}) Tj ET "
+                   f"BT /F2 14 Tf 72 680 Td (Courier {i + 1}) Tj ET").encode()
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(content), content))
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                       b"/Resources 3 0 R /Contents %d 0 R >>" % len(objects))
+        kids.append(b"%d 0 R" % len(objects))
+    objects[1] = b"<< /Type /Pages /Count %d /Kids [%s] >>" % (pages, b" ".join(kids))
+    with open(path, "wb") as f:
+        f.write(b"%PDF-1.4\n")
+        offsets = []
+        for number, obj in enumerate(objects, 1):
+            offsets.append(f.tell())
+            f.write(b"%d 0 obj\n%s\nendobj\n" % (number, obj))
+        xref_offset = f.tell()
+        f.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+        for offset in offsets:
+            f.write(b"%010d 00000 n \n" % offset)
+        f.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+                % (len(objects) + 1, xref_offset))
+
+
+def make_scanned_pdf(path, pages, page_size=(595, 842), seed=0):
+    """生成模拟扫描件的PDF：每页一幅不可压缩的噪声图像（约每页0.5 MB）"""
+    rng = np.random.default_rng(seed)
+    c = canvas.Canvas(path, pagesize=page_size)
+    for i in range(pages):
+        noise = rng.integers(0, 256, (420, 420, 3), dtype=np.uint8)
+        c.drawImage(ImageReader(Image.fromarray(noise, "RGB")), 0, 0,
+                    width=page_size[0], height=page_size[1])
+        c.showPage()
+    c.save()
+
+
+def legacy_process(img):
+    """原逐像素循环实现（作为对照）"""
+    out = img.copy()
+    new_data = []
+    for item in out.getdata():
+        if item[0] > 230 and item[1] > 230 and item[2] > 230:
+            new_data.append((255, 255, 255, 0))
+        elif item[0] > 180 and item[1] > 180 and item[2] > 180:
+            new_data.append((255, 255, 255, 0))
+        else:
+            color_intensity = 255 - ((item[0] + item[1] + item[2]) / 3)
+            alpha = min(255, int(color_intensity * 2.0 * 0.7))
+            new_data.append((255, 30, 30, alpha))
+    out.putdata(new_data)
+    return out
+
+
+def timed(func, *args, repeat=1, **kwargs):
+    """返回 (最短耗时秒数, 结果)"""
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def bench_process():
+    """印章透明化：原循环 vs 向量化，按每百万像素耗时对比"""
+    for side in (500, 2000):
+        seal = make_seal(side, side)
+        mpix = side * side / 1e6
+        t_old, old = timed(legacy_process, seal)
+        t_new, new = timed(stmp.process_stamp_image, seal, repeat=3)
+        same = old.tobytes() == new.tobytes()
+        print(f"process {side}x{side}: 循环 {t_old / mpix * 1000:8.1f} ms/MP  "
+              f"向量化 {t_new / mpix * 1000:8.1f} ms/MP  "
+              f"加速 {t_old / t_new:6.1f}x  结果一致={same}")
+
+
+# 每增加一个盖章页面允许的输出增长（字节）：页面对象、叠加层内容流与引用，不含印章图像
+XOBJECT_MAX_PAGE_GROWTH = 500
+
+
+def bench_xobject():
+    """每增加一个盖章页面，输出文件增长的字节数（印章图像只应嵌入一次）"""
+    with tempfile.TemporaryDirectory() as tmp:
+        seal_path = os.path.join(tmp, "seal.png")
+        stmp.process_stamp_image(make_seal(800, 800)).save(seal_path)
+        growth = {}
+        for pages in (10, 50):
+            src = os.path.join(tmp, f"in{pages}.pdf")
+            out = os.path.join(tmp, f"out{pages}.pdf")
+            make_pdf(src, pages)
+            stmp.add_stamp_to_pdf(src, seal_path, out, position=(300, 400), size=0.1)
+            growth[pages] = os.path.getsize(out) - os.path.getsize(src)
+        per_page = (growth[50] - growth[10]) / 40
+        print(f"xobject: 印章图像+首页 {growth[10]} 字节, 每增加一页 {per_page:.0f} 字节")
+        assert per_page < XOBJECT_MAX_PAGE_GROWTH, \
+            f"每增加一页输出增长 {per_page:.0f} 字节，超过 {XOBJECT_MAX_PAGE_GROWTH}（印章图像被重复嵌入？）"
+
+
+def bench_incremental():
+    """全量重写 vs 增量更新：写出耗时与写入字节数"""
+    from PyPDF2 import PdfReader
+    with tempfile.TemporaryDirectory() as tmp:
+        src = os.path.join(tmp, "scan.pdf")
+        make_scanned_pdf(src, 60)
+        src_size = os.path.getsize(src)
+        stamp_image = ImageReader(stmp.process_stamp_image(make_seal(800, 800)))
+        page_placements = {page: [(400, 150, 100, 100)] for page in range(60)}
+        print(f"incremental: 原文件 {src_size / 1e6:.1f} MB，60 页全部盖章")
+        
+        out = os.path.join(tmp, "full.pdf")
+        t, _ = timed(lambda: stmp.write_stamped_pdf(PdfReader(src), page_placements,
+                                                    stamp_image, out))
+        print(f"  全量重写        {t * 1000:8.0f} ms  写入 {os.path.getsize(out):>11,} 字节")
+        
+        out = os.path.join(tmp, "copy_append.pdf")
+        t, appended = timed(stmp.append_stamped_pdf, src, page_placements, stamp_image, out)
+        print(f"  复制+增量追加   {t * 1000:8.0f} ms  写入 {os.path.getsize(out):>11,} 字节"
+              f"（其中追加 {appended:,}）")
+        
+        inplace = os.path.join(tmp, "inplace.pdf")
+        shutil.copyfile(src, inplace)
+        t, appended = timed(stmp.append_stamped_pdf, inplace, page_placements,
+                            stamp_image, inplace)
+        print(f"  原地增量追加    {t * 1000:8.0f} ms  写入 {appended:>11,} 字节")
+
+
+def bench_rules():
+    """页码规则：2000 页文档全部盖章时叠加层的构建数量与导出耗时"""
+    from PyPDF2 import PdfReader
+    with tempfile.TemporaryDirectory() as tmp:
+        src = os.path.join(tmp, "long.pdf")
+        out = os.path.join(tmp, "out.pdf")
+        make_pdf(src, 2000)
+        seal = stmp.process_stamp_image(make_seal(800, 800))
+        stamp_images = {None: ImageReader(seal)}
+        seal_sizes = {None: seal.size}
+        
+        layout = stmp.StampLayout()
+        layout.set_page_count(2000)
+        layout.add_rule("all", 300, 400, 0.1, 80, 80)
+        layout.add(0, 100, 100, 0.1, 80, 80)  # 首页另加一枚，几何不同
+        
+        pdf_reader = PdfReader(src)
+        t_expand, page_placements = timed(
+            stmp.StampApp.compute_page_placements, pdf_reader, layout.snapshot(),
+            (595, 842), seal_sizes, layout.rule_snapshot())
+        page_specs = [(595, 842, page_placements[page]) for page in sorted(page_placements)]
+        t_build, overlays = timed(stmp.build_stamp_overlays, page_specs, stamp_images)
+        t_write, _ = timed(stmp.write_stamped_pdf, pdf_reader, page_placements,
+                           stamp_images, out)
+        print(f"rules: 2000 页，规则展开 {t_expand * 1000:.0f} ms，"
+              f"叠加层 {len({id(overlay) for overlay in overlays})} 个（构建 {t_build * 1000:.0f} ms），"
+              f"导出 {t_write:.2f} s，输出 {os.path.getsize(out) - os.path.getsize(src):,} 字节增量")
+
+
+def bench_stamp_pdf():
+    """批量接口：1000 页混合尺寸文档、5000 个位置，一次读取、一次写出到内存"""
+    with tempfile.TemporaryDirectory() as tmp:
+        src = os.path.join(tmp, "mixed.pdf")
+        make_mixed_pdf(src, 1000)
+        seals = {None: ImageReader(stmp.process_stamp_image(make_seal(400, 400)))}
+        anchors = list(stmp.ANCHORS)
+        placements = [{'page': page, 'x': 60 + i * 80, 'y': 60, 'size': 0.15,
+                       'anchor': anchors[(page + i) % len(anchors)]}
+                      for page in range(1000) for i in range(5)]
+        t, data = timed(stmp.stamp_pdf, src, placements, seals)
+        print(f"stamp_pdf: {len(placements)} 个位置 {t:.2f} s "
+              f"（{t / len(placements) * 1e6:.0f} us/个），输出 {len(data):,} 字节")
+
+
+def bench_serve(requests=40, clients=4):
+    """HTTP服务：本机客户端并发请求的吞吐与延迟"""
+    import json as json_module
+    import threading
+    import urllib.error
+    import urllib.request
+    with tempfile.TemporaryDirectory() as tmp:
+        src = os.path.join(tmp, "mixed.pdf")
+        seal_path = os.path.join(tmp, "seal.png")
+        make_mixed_pdf(src, 10)
+        make_seal(400, 400).convert("RGB").save(seal_path)
+        with open(src, "rb") as f:
+            pdf = f.read()
+        layout = json_module.dumps({'placements': [{'pages': "all", 'x': 300, 'y': 200, 'size': 0.2}]})
+        
+        service = stmp.StampService({None: seal_path}, queue_size=requests)
+        server = service.make_server("127.0.0.1", 0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_port}"
+        statuses = []
+        
+        def client(count):
+            for _ in range(count):
+                request = urllib.request.Request(f"{url}/stamp", data=pdf,
+                                                 headers={'X-Stamp-Layout': layout})
+                try:
+                    with urllib.request.urlopen(request) as response:
+                        response.read()
+                        statuses.append(response.status)
+                except urllib.error.HTTPError as e:
+                    statuses.append(e.code)
+        
+        try:
+            start = time.perf_counter()
+            threads = [threading.Thread(target=client, args=(requests // clients,))
+                       for _ in range(clients)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+            with urllib.request.urlopen(f"{url}/stats") as response:
+                stats = json_module.load(response)
+        finally:
+            server.shutdown()
+            server.server_close()
+            service.close()
+        latency = stats['latency_ms']
+        print(f"serve: {len(statuses)} 个请求（{clients} 个客户端，{service.workers} 个进程）"
+              f"成功 {statuses.count(200)}，{len(statuses) / elapsed:.1f} 个/秒，"
+              f"延迟 p50 {latency['p50']} ms / p95 {latency['p95']} ms")
+
+
+def bench_trace():
+    """耗时追踪：未启用时每个时间段的额外开销"""
+    tracer = stmp.Tracer()
+    n = 1_000_000
+    
+    def baseline():
+        for i in range(n):
+            pass
+    
+    def disabled():
+        for i in range(n):
+            with tracer.span("export.page", page=i):
+                pass
+    
+    t_base, _ = timed(baseline, repeat=3)
+    t_off, _ = timed(disabled, repeat=3)
+    tracer.enable(path=None)
+    t_on, _ = timed(disabled)
+    print(f"trace: 未启用 {(t_off - t_base) / n * 1e9:.0f} ns/段，"
+          f"启用 {(t_on - t_base) / n * 1e9:.0f} ns/段")
+
+
+def bench_zoom(zoom=3.0, viewport=(600, 800)):
+    """放大预览：整页按高 dpi 渲染 vs 只渲染视口内的图块（需要 poppler）"""
+    from pdf2image import convert_from_path
+    with tempfile.TemporaryDirectory() as tmp:
+        pdf_path = os.path.join(tmp, "in.pdf")
+        make_pdf(pdf_path, 1)
+        renderer = stmp.PageRenderer(pdf_path, dpi=72)
+        try:
+            page = renderer.get(0)
+            preview_scale = min(1.0, viewport[0] / page.width, viewport[1] / page.height)
+            dpi = round(72 * preview_scale * zoom, 2)
+            size = renderer.tile_size
+            tiles = [(col, row) for col in range(math.ceil(viewport[0] / size))
+                     for row in range(math.ceil(viewport[1] / size))]
+            t_full, full = timed(lambda: convert_from_path(pdf_path, dpi=dpi, use_cropbox=True)[0])
+            t_tiles, images = timed(lambda: [stmp.render_page_region(pdf_path, 0, dpi, col * size,
+                                                                     row * size, size, size)
+                                             for col, row in tiles])
+        except Exception as e:
+            print(f"zoom: 跳过（{type(e).__name__}: {e}）")
+            return
+        finally:
+            renderer.close()
+    full_pixels = full.width * full.height
+    tile_pixels = sum(img.width * img.height for img in images)
+    print(f"zoom {zoom:.0%}: 整页 {full_pixels / 1e6:.2f} MP {t_full * 1000:.0f} ms，"
+          f"视口图块 {len(images)} 块 {tile_pixels / 1e6:.2f} MP {t_tiles * 1000:.0f} ms")
+
+
+def bench_thumbnails(pages=400, visible=(200, 205)):
+    """缩略图导航：跳到文档中部时可见缩略图就绪的耗时（需要 poppler）"""
+    with tempfile.TemporaryDirectory() as tmp:
+        pdf_path = os.path.join(tmp, "long.pdf")
+        make_pdf(pdf_path, pages)
+        renderer = stmp.ThumbnailRenderer(pdf_path, pages)
+        try:
+            start = time.perf_counter()
+            renderer.request(*visible)
+            wanted = set(range(visible[0], visible[1] + 1))
+            done = 0
+            while wanted:
+                page_num = renderer.ready.get(timeout=60)
+                if renderer.get(page_num) is None:
+                    raise RuntimeError(f"第 {page_num + 1} 页缩略图生成失败")
+                wanted.discard(page_num)
+                done += 1
+            t_visible = time.perf_counter() - start
+            while done < pages:
+                renderer.ready.get(timeout=60)
+                done += 1
+            t_all = time.perf_counter() - start
+        except Exception as e:
+            print(f"thumbnails: 跳过（{type(e).__name__}: {e}）")
+            return
+        finally:
+            renderer.close()
+    print(f"thumbnails {pages} 页: 可见 {visible[1] - visible[0] + 1} 页就绪 {t_visible * 1000:.0f} ms，"
+          f"全部 {t_all:.2f} s")
+
+
+def bench_render_cache(pages=20):
+    """磁盘渲染缓存：首次打开（poppler 渲染）vs 再次打开（读取缓存）前几页的耗时"""
+    with tempfile.TemporaryDirectory() as tmp:
+        pdf_path = os.path.join(tmp, "in.pdf")
+        make_pdf(pdf_path, pages)
+        cache_dir = os.path.join(tmp, "cache")
+        
+        def open_and_render():
+            renderer = stmp.PageRenderer(pdf_path, dpi=72,
+                                         disk_cache=stmp.RenderCache(cache_dir))
+            try:
+                for page_num in range(min(pages, 5)):
+                    renderer.get(page_num)
+            finally:
+                renderer.close()
+        
+        try:
+            t_cold, _ = timed(open_and_render)
+            t_warm, _ = timed(open_and_render, repeat=3)
+        except Exception as e:
+            print(f"render_cache: 跳过（{type(e).__name__}: {e}）")
+            return
+        size = sum(entry.stat().st_size for entry in os.scandir(cache_dir))
+    print(f"render_cache: 首次打开 {t_cold * 1000:.0f} ms，再次打开 {t_warm * 1000:.1f} ms，"
+          f"缓存 {size / 1024:.0f} KB")
+
+
+def bench_encoding(pages=100):
+    """印章编码：原始像素 / 300dpi 无损 / 300dpi JPEG / 矢量路径的输出大小、叠加层构建与导出耗时
+
+    4000x4000 印章画成 3 cm；矢量的首次构建包含描摹，之后命中缓存。
+    """
+    seal = stmp.process_stamp_image(make_seal(4000, 4000).convert("RGBA"))
+    size = 3 / 2.54 * 72 / seal.width
+    modes = [("原始像素", None), ("300dpi 无损", stmp.SealEncoding(dpi=300)),
+             ("300dpi JPEG", stmp.SealEncoding(dpi=300, format="jpeg")),
+             ("矢量路径", stmp.SealEncoding(format="vector"))]
+    draw_size = seal.width * size
+    specs = [(595, 842, [(450, 120, draw_size, draw_size, None)])]
+    with tempfile.TemporaryDirectory() as tmp:
+        pdf_path = os.path.join(tmp, "in.pdf")
+        make_pdf(pdf_path, pages)
+        placements = [(page_num, 450, 120, size) for page_num in range(pages)]
+        for name, encoding in modes:
+            reader = ImageReader(seal)
+            t_first, _ = timed(stmp.build_stamp_overlays, specs, {None: reader}, encoding)
+            t_overlay, _ = timed(stmp.build_stamp_overlays, specs, {None: reader}, encoding,
+                                 repeat=3)
+            seconds, data = timed(stmp.stamp_pdf, pdf_path, placements, seal, encoding=encoding)
+            print(f"encoding {name:<12} {len(data):>10,} 字节  叠加层 {t_first * 1000:6.0f} ms"
+                  f"（再次 {t_overlay * 1000:5.0f} ms）  导出 {seconds * 1000:7.0f} ms")
+
+
+def bench_anchor_text(documents=20, pages=10):
+    """按文字定位：每份文档首次（提取文字）、磁盘缓存命中、内存缓存命中时的解析吞吐（份/分钟）
+
+    每页若干行正文，最后一页有 "Signature Here"；布局按文字定位到签名处。
+    """
+    layout = {"placements": [{"text": "Signature Here", "size": 0.1}]}
+    seal_sizes = {None: (400, 400)}
+    with tempfile.TemporaryDirectory() as tmp:
+        pdf_paths = []
+        for index in range(documents):
+            path = os.path.join(tmp, f"doc{index}.pdf")
+            c = canvas.Canvas(path, pagesize=(595, 842))
+            for page_num in range(pages):
+                for line in range(40):
+                    c.drawString(72, 800 - line * 18, f"doc {index} page {page_num + 1} line {line}")
+                if page_num == pages - 1:
+                    c.drawString(300, 60, "Signature Here")
+                c.showPage()
+            c.save()
+            pdf_paths.append(path)
+        cache_dir = os.path.join(tmp, "text")
+        
+        def resolve_all(cache):
+            found = 0
+            for path in pdf_paths:
+                reader = stmp.PdfReader(path)
+                text_index = cache.index(reader, cache.document_key(path))
+                found += len(stmp.layout_to_placements(layout, reader, seal_sizes, text_index))
+                cache.save(text_index)
+            assert found == documents
+        
+        memory_cache = stmp.TextIndexCache(cache_dir, max_entries=documents)
+        t_cold, _ = timed(resolve_all, memory_cache)
+        t_disk, _ = timed(lambda: resolve_all(stmp.TextIndexCache(cache_dir)), repeat=3)
+        t_memory, _ = timed(resolve_all, memory_cache, repeat=3)
+    for name, seconds in (("首次", t_cold), ("磁盘缓存", t_disk), ("内存缓存", t_memory)):
+        print(f"anchor_text {name:<8} {documents / seconds * 60:10,.0f} 份/分钟"
+              f"（每份 {seconds / documents * 1000:.1f} ms，{pages} 页）")
+
+
+def bench_layout_replay(pages=1000):
+    """布局文件重放：读取界面保存的布局（比例坐标）并展开到新文件各页的耗时（不渲染页面）
+
+    布局为一条 "all" 规则加每页一枚单页印章；与界面导出的 compute_page_placements 对比，
+    并给出包含写出的完整重放耗时。
+    """
+    seal = make_seal(400, 400)
+    layout = stmp.StampLayout()
+    layout.set_page_count(pages)
+    layout.add_rule("all", 100, 700, 0.1, 40, 40, "seal")
+    layout.add_many([(page_num, 300, 400, 0.2, 80, 80, "seal") for page_num in range(pages)])
+    with tempfile.TemporaryDirectory() as tmp:
+        pdf_path = os.path.join(tmp, "revised.pdf")
+        make_mixed_pdf(pdf_path, pages)
+        seal_path = os.path.join(tmp, "seal.png")
+        seal.save(seal_path)
+        layout_path = os.path.join(tmp, "layout.json")
+        stmp.save_layout(layout_path, {"seals": {"seal": seal_path},
+                                       "placements": layout.layout_items((566, 800))})
+        seal_sizes = {"seal": seal.size}
+        reader = stmp.PdfReader(pdf_path)
+        
+        def replay():
+            return stmp.layout_to_placements(stmp.load_layout(layout_path), reader, seal_sizes)
+        
+        t_replay, _ = timed(replay, repeat=3)
+        t_gui, _ = timed(stmp.StampApp.compute_page_placements, reader, layout.snapshot(),
+                         (566, 800), seal_sizes, layout.rule_snapshot(), repeat=3)
+        def full():
+            pdf_reader = stmp.PdfReader(pdf_path)
+            page_placements = stmp.layout_to_placements(stmp.load_layout(layout_path),
+                                                        pdf_reader, seal_sizes)
+            stmp.write_stamped_pdf(pdf_reader, page_placements, {"seal": ImageReader(seal)},
+                                   io.BytesIO())
+        
+        t_full, _ = timed(full)
+        size = os.path.getsize(layout_path)
+    print(f"layout_replay: 布局 {size / 1024:.0f} KB，展开 {t_replay * 1000:.0f} ms"
+          f"（{t_replay / pages * 1000:.3f} ms/页，界面换算 {t_gui * 1000:.0f} ms），"
+          f"含写出 {t_full * 1000:.0f} ms（{t_full / pages * 1000:.2f} ms/页）")
+
+
+def bench_overlay_workers(pages=10000, worker_counts=(1, 2, 4, 8)):
+    """叠加层并行生成：每页印章位置都不同（无法共用叠加层）时，按进程数对比
+    叠加层生成与完整导出的耗时（加速比受本机CPU核数限制）"""
+    seal = ImageReader(stmp.process_stamp_image(make_seal(400, 400)))
+    with tempfile.TemporaryDirectory() as tmp:
+        pdf_path = os.path.join(tmp, "in.pdf")
+        make_pdf(pdf_path, pages)
+        reader = stmp.PdfReader(pdf_path)
+        page_placements = {page_num: [(100 + page_num % 400, 100 + page_num // 400, 80, 80, None, 0),
+                                      (450, 120, 60, 60, None, 0)]
+                           for page_num in range(pages)}
+        page_specs = [(595, 842, page_placements[page_num]) for page_num in range(pages)]
+        baseline = None
+        print(f"overlay_workers: 本机 {os.cpu_count()} 个CPU，"
+              f"每 {stmp.OVERLAY_CHUNK_SIZE} 个叠加层一块")
+        for workers in worker_counts:
+            t_overlays, _ = timed(stmp.build_stamp_overlays, page_specs, seal, workers=workers)
+            t_export, _ = timed(stmp.write_stamped_pdf, reader, page_placements, seal,
+                                io.BytesIO(), workers=workers)
+            baseline = baseline or (t_overlays, t_export)
+            print(f"overlay_workers {workers} 进程: 叠加层 {t_overlays * 1000:6.0f} ms"
+                  f"（{baseline[0] / t_overlays:4.2f}x）  导出 {t_export * 1000:6.0f} ms"
+                  f"（{baseline[1] / t_export:4.2f}x）  {pages} 页")
+
+
+def bench_compact(page_counts=(10, 1000, 5000)):
+    """紧凑输出：同一份盖章结果按默认方式与紧凑方式（去重、压缩、对象流）写出，
+    对比文件大小与写出耗时"""
+    seal = ImageReader(stmp.process_stamp_image(make_seal(400, 400)))
+    with tempfile.TemporaryDirectory() as tmp:
+        for pages in page_counts:
+            pdf_path = os.path.join(tmp, f"in{pages}.pdf")
+            make_mixed_pdf(pdf_path, pages)
+            page_placements = {page_num: [(450, 700, 80, 80, None, 0)] for page_num in range(pages)}
+            sizes = {}
+            for compact in (False, True):
+                output = io.BytesIO()
+                elapsed, _ = timed(stmp.write_stamped_pdf, stmp.PdfReader(pdf_path),
+                                   page_placements, seal, output, compact=compact)
+                sizes[compact] = len(output.getvalue())
+                print(f"compact {pages:5d} 页 {'紧凑' if compact else '默认'}: "
+                      f"{elapsed * 1000:7.0f} ms  {sizes[compact]:>10,} 字节")
+            print(f"compact {pages:5d} 页: "
+                  f"{stmp.describe_size_change(os.path.getsize(pdf_path), sizes[True])}，"
+                  f"比默认输出小 {(1 - sizes[True] / sizes[False]) * 100:.0f}%")
+        
+        # 回归检查：各页共用的直接 /Font 字典中的引用只能换号一次
+        pdf_path = os.path.join(tmp, "shared.pdf")
+        make_shared_resources_pdf(pdf_path, 5)
+        page_placements = {page_num: [(100, 100, 80, 80, None, 0)] for page_num in range(5)}
+        readers = {}
+        for compact in (False, True):
+            output = io.BytesIO()
+            stmp.write_stamped_pdf(stmp.PdfReader(pdf_path), page_placements, seal, output,
+                                   compact=compact)
+            readers[compact] = stmp.PdfReader(io.BytesIO(output.getvalue()))
+        # 先比较字体（引用错位时 extract_text 本身会出错），再比较文字
+        fonts = {compact: [{name: font.get_object().get("/BaseFont")
+                            for name, font in page["/Resources"]["/Font"].items()}
+                           for page in reader.pages]
+                 for compact, reader in readers.items()}
+        assert fonts[True] == fonts[False], \
+            f"紧凑输出的字体与默认输出不一致: {fonts[True][0]} != {fonts[False][0]}"
+        texts = {compact: [page.extract_text() for page in reader.pages]
+                 for compact, reader in readers.items()}
+        assert texts[True] == texts[False], "紧凑输出的文字与默认输出不一致"
+        print("compact 共用资源: 字体与文字与默认输出一致")
+
+
+# ---------------------------------------------------------------------------
+# suite：可在版本之间对比的完整基准（结果写入JSON）
+# ---------------------------------------------------------------------------
+
+SUITE_SEALS = {'small': (400, 400), '4k': (3840, 2160)}
+# 导出时印章图像的重采样/编码方式（SealEncoding 参数），与默认的原始像素对比
+SUITE_ENCODINGS = {
+    '300dpi_flate': {'dpi': 300, 'format': 'flate'},
+    '300dpi_jpeg': {'dpi': 300, 'format': 'jpeg'},
+    'vector': {'format': 'vector'},
+}
+
+
+class _NullWidget:
+    """无界面运行 StampApp 方法时代替控件"""
+    def config(self, **kwargs):
+        pass
+
+    def set(self, value):
+        pass
+
+
+class _StubCanvas:
+    """没有显示器时代替 tk.Canvas：只记录画布项及其标签，不绘制（画布未滚动）"""
+    def __init__(self):
+        self.items = {}  # {画布项: 标签}
+        self.next_item = 1
+
+    def _create(self, tags):
+        item = self.next_item
+        self.next_item += 1
+        self.items[item] = tags
+        return item
+
+    def create_image(self, x, y, tags="", **kwargs):
+        return self._create(tags)
+
+    def create_rectangle(self, x1, y1, x2, y2, tags="", **kwargs):
+        return self._create(tags)
+
+    def coords(self, item, *coords):
+        pass
+
+    def delete(self, tag_or_item):
+        for item in [item for item, tags in self.items.items()
+                     if tag_or_item in (item, tags)]:
+            del self.items[item]
+
+    def canvasx(self, x):
+        return x
+
+    def canvasy(self, y):
+        return y
+
+
+class _StubListbox:
+    """没有显示器时代替 tk.Listbox"""
+    def delete(self, first, last=None):
+        pass
+
+    def insert(self, index, text):
+        pass
+
+    def selection_set(self, index):
+        pass
+
+
+class _StubPhoto:
+    """没有显示器时代替 ImageTk.PhotoImage（不上传到 Tk）"""
+    def __init__(self, image):
+        self._size = image.size
+
+    def width(self):
+        return self._size[0]
+
+    def height(self):
+        return self._size[1]
+
+
+def _headless_app():
+    """不创建窗口的 StampApp（只用于不涉及画布的方法）"""
+    app = stmp.StampApp.__new__(stmp.StampApp)
+    app.seals = stmp.SealLibrary()
+    app.current_seal_id = None
+    app.seal_combo = _NullWidget()
+    return app
+
+
+def _peak_rss():
+    """当前进程的峰值内存（字节），不支持的平台返回 None"""
+    # Linux 下 ru_maxrss 在 exec 后仍保留父进程的峰值，优先使用只统计本进程的 VmHWM
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def case_load_convert(data, pages):
+    """原启动方式：convert_from_path 一次渲染全部页面"""
+    from pdf2image import convert_from_path
+    start = time.perf_counter()
+    images = convert_from_path(data[f"pdf{pages}"], dpi=72)
+    return time.perf_counter() - start, {'pages': len(images)}
+
+
+def case_load_first_page(data, pages):
+    """当前启动方式：PageRenderer 打开文档并渲染第一页"""
+    start = time.perf_counter()
+    renderer = stmp.PageRenderer(data[f"pdf{pages}"], dpi=72, cache_size=8)
+    renderer.get(0)
+    elapsed = time.perf_counter() - start
+    renderer.close()
+    return elapsed, {'pages': renderer.page_count}
+
+
+def case_load_stamp(data, seal):
+    """StampApp.load_stamp：读取印章并完成透明化处理"""
+    app = _headless_app()
+    start = time.perf_counter()
+    app.load_stamp(data[f"seal_{seal}"])
+    elapsed = time.perf_counter() - start
+    if app.current_seal_id is None:
+        raise RuntimeError("load_stamp 失败")
+    return elapsed, {}
+
+
+def _headless_preview_app():
+    """在替身画布上预览印章的 StampApp（重绘与拖拽所需的状态与 __init__ 一致）"""
+    app = _headless_app()
+    app.canvas = _StubCanvas()
+    app.stamp_listbox = _StubListbox()
+    app.stamp_photo_cache = OrderedDict()
+    app.stamp_photo_cache_size = 32
+    app.stamp_photos = []
+    app.stamp_items = {}
+    app.selection_rect = None
+    app.dragging = False
+    app.current_page = 0
+    app.layout = stmp.StampLayout()
+    app.selected_stamp_id = None
+    app.stamp_list_ids = []
+    app.zoom = 1.0
+    return app
+
+
+def case_redraw(data, seal, stamps=20, redraws=50, drag_steps=200):
+    """预览重绘（show_current_page_stamps）与拖拽（on_drag）
+
+    有显示器时使用真实的 Tk 画布；没有时（如CI）在替身画布上运行同样的方法，
+    不含 Tk 绘制与 PhotoImage 上传的耗时，结果中 display 为 False。
+    """
+    import tkinter as tk
+    try:
+        root = tk.Tk()
+    except tk.TclError:
+        root = None
+    if root is None:
+        app = _headless_preview_app()
+        photo_image, stmp.ImageTk.PhotoImage = stmp.ImageTk.PhotoImage, _StubPhoto
+        update = lambda: None
+    else:
+        root.withdraw()
+        app = stmp.StampApp(root)
+        update = root.update_idletasks
+    try:
+        app.load_stamp(data[f"seal_{seal}"])
+        app.preview_width, app.preview_height = 595, 842
+        width, height = app.stamp_extent(app.current_seal_id, 0.05)
+        for i in range(stamps):
+            app.layout.add(0, 60 + (i % 5) * 110, 80 + (i // 5) * 180, 0.05,
+                           width, height, app.current_seal_id)
+        
+        start = time.perf_counter()
+        for _ in range(redraws):
+            app.show_current_page_stamps()
+            update()
+        redraw = (time.perf_counter() - start) / redraws
+        
+        app.selected_stamp_id = app.layout.page_stamps(0)[0].id
+        app.show_current_page_stamps()
+        start = time.perf_counter()
+        for step in range(drag_steps):
+            app.on_drag(SimpleNamespace(x=100 + step % 300, y=100 + step % 500))
+            update()
+        app.stop_drag(None)
+        drag = (time.perf_counter() - start) / drag_steps
+    finally:
+        if root is None:
+            stmp.ImageTk.PhotoImage = photo_image
+        else:
+            root.destroy()
+    return redraw * redraws + drag * drag_steps, {
+        'redraw_ms': round(redraw * 1000, 3), 'drag_step_ms': round(drag * 1000, 3),
+        'display': root is not None}
+
+
+def case_add_stamp_to_pdf(data, pages, seal):
+    """add_stamp_to_pdf：每页同一位置盖章并写出"""
+    out = os.path.join(data['out_dir'], f"add_{pages}_{seal}.pdf")
+    start = time.perf_counter()
+    stmp.add_stamp_to_pdf(data[f"pdf{pages}"], data[f"seal_{seal}"], out,
+                          position=(200, 200), size=0.05)
+    return time.perf_counter() - start, {'output_bytes': os.path.getsize(out)}
+
+
+def case_export(data, pages, seal, incremental=False, encoding=None, compact=False):
+    """导出线程逻辑（_save_pdf_async）：界面坐标换算、合并印章、写出
+
+    encoding 为 SealEncoding 的参数字典（None 为默认的原始像素）。
+    """
+    import queue
+    import threading
+    app = _headless_app()
+    app.load_stamp(data[f"seal_{seal}"])
+    seal_id = app.current_seal_id
+    tag = "_".join(f"{value}" for value in (encoding or {}).values())
+    out = os.path.join(data['out_dir'],
+                       f"export_{pages}_{seal}_{int(incremental)}{int(compact)}{tag}.pdf")
+    job = {
+        'pdf_path': data[f"pdf{pages}"],
+        'output_path': out,
+        'page_stamps': {page: [(450, 700, 0.05, seal_id)] for page in range(pages)},
+        'page_rules': [],
+        'preview_size': (595, 842),
+        'seal_sizes': {seal_id: (app.seals.get(seal_id).width, app.seals.get(seal_id).height)},
+        'stamp_images': {seal_id: app.seals.export_image(seal_id)},
+        'incremental': incremental,
+        'compact': compact,
+        'encoding': stmp.SealEncoding(**encoding) if encoding else None,
+        'queue': queue.Queue(),
+        'cancel_event': threading.Event(),
+    }
+    start = time.perf_counter()
+    app._save_pdf_async(job)
+    elapsed = time.perf_counter() - start
+    messages = []
+    while not job['queue'].empty():
+        messages.append(job['queue'].get())
+    if not messages or messages[-1][0] != 'done':
+        raise RuntimeError(f"导出失败: {messages[-1] if messages else '无结果'}")
+    return elapsed, {'output_bytes': os.path.getsize(out)}
+
+
+def suite_cases(page_counts):
+    """[(名称, 函数, 参数), ...]"""
+    cases = []
+    for pages in page_counts:
+        cases.append((f"load_convert[{pages}p]", case_load_convert, {'pages': pages}))
+        cases.append((f"load_first_page[{pages}p]", case_load_first_page, {'pages': pages}))
+    for seal in SUITE_SEALS:
+        cases.append((f"load_stamp[{seal}]", case_load_stamp, {'seal': seal}))
+        cases.append((f"redraw[{seal}]", case_redraw, {'seal': seal}))
+    for pages in page_counts:
+        for seal in SUITE_SEALS:
+            args = {'pages': pages, 'seal': seal}
+            cases.append((f"add_stamp_to_pdf[{pages}p,{seal}]", case_add_stamp_to_pdf, args))
+            cases.append((f"export[{pages}p,{seal}]", case_export, args))
+            cases.append((f"export_incremental[{pages}p,{seal}]", case_export,
+                          dict(args, incremental=True)))
+            cases.append((f"export_compact[{pages}p,{seal}]", case_export,
+                          dict(args, compact=True)))
+            for name, encoding in SUITE_ENCODINGS.items():
+                cases.append((f"export_{name}[{pages}p,{seal}]", case_export,
+                              dict(args, encoding=encoding)))
+    return cases
+
+
+def _run_case(func, data, kwargs):
+    """在子进程中运行一项基准，返回结果字典"""
+    try:
+        seconds, extra = func(data, **kwargs)
+        result = {'status': 'ok', 'wall_s': round(seconds, 4)}
+        result.update(extra)
+    except Exception as e:
+        result = {'status': 'error', 'error': f"{type(e).__name__}: {e}"}
+    result['peak_rss_bytes'] = _peak_rss()
+    return result
+
+
+def make_suite_data(tmp, page_counts):
+    """生成 suite 所需的合成PDF和印章图片，返回 {名称: 路径}"""
+    data = {'out_dir': os.path.join(tmp, "out")}
+    os.makedirs(data['out_dir'])
+    for pages in page_counts:
+        data[f"pdf{pages}"] = os.path.join(tmp, f"mixed_{pages}.pdf")
+        make_mixed_pdf(data[f"pdf{pages}"], pages)
+    for name, (width, height) in SUITE_SEALS.items():
+        # 未处理的白底印章照片，与用户实际选择的图片一致
+        data[f"seal_{name}"] = os.path.join(tmp, f"seal_{name}.png")
+        make_seal(width, height).convert("RGB").save(data[f"seal_{name}"])
+    return data
+
+
+def _git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(page_counts=(1, 100, 1000), json_path="bench_results.json", compare=None):
+    """运行 suite 并写出JSON结果"""
+    report = {
+        'revision': _git_revision(),
+        'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'page_counts': list(page_counts),
+        'seals': {name: list(size) for name, size in SUITE_SEALS.items()},
+        'results': {},
+    }
+    previous = None
+    if compare:
+        with open(compare, encoding="utf-8") as f:
+            previous = json.load(f)['results']
+    
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as tmp:
+        data = make_suite_data(tmp, page_counts)
+        for name, func, kwargs in suite_cases(page_counts):
+            # 每项使用新的进程，峰值内存只反映该项
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                result = executor.submit(_run_case, func, data, kwargs).result()
+            report['results'][name] = result
+            print(_format_result(name, result, previous.get(name) if previous else None))
+    
+    with open(json_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"结果已写入 {json_path}")
+
+
+def _format_result(name, result, previous=None):
+    if result['status'] != 'ok':
+        return f"{name:<36} 失败: {result['error']}"
+    rss = result.get('peak_rss_bytes')
+    line = f"{name:<36} {result['wall_s'] * 1000:10.1f} ms"
+    line += f"  峰值内存 {rss / 2**20:7.1f} MB" if rss else "  峰值内存     n/a"
+    if 'output_bytes' in result:
+        line += f"  输出 {result['output_bytes']:>12,} 字节"
+    if result.get('display') is False:
+        line += "  （无显示器：替身画布，不含 Tk 绘制）"
+    if previous and previous.get('status') == 'ok' and previous['wall_s'] > 0:
+        line += f"  对比旧版 {result['wall_s'] / previous['wall_s']:5.2f}x"
+    return line
+
+
+BENCHES = {
+    'process': bench_process,
+    'xobject': bench_xobject,
+    'incremental': bench_incremental,
+    'rules': bench_rules,
+    'trace': bench_trace,
+    'stamp_pdf': bench_stamp_pdf,
+    'serve': bench_serve,
+    'zoom': bench_zoom,
+    'thumbnails': bench_thumbnails,
+    'render_cache': bench_render_cache,
+    'encoding': bench_encoding,
+    'anchor_text': bench_anchor_text,
+    'layout_replay': bench_layout_replay,
+    'overlay_workers': bench_overlay_workers,
+    'compact': bench_compact,
+}
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="stmp.py 性能基准")
+    parser.add_argument("names", nargs="*", help=f"基准名（可选: {', '.join(BENCHES)}, suite）")
+    parser.add_argument("--pages", default="1,100,1000", help="suite 使用的PDF页数，逗号分隔")
+    parser.add_argument("--json", default="bench_results.json", help="suite 结果输出文件")
+    parser.add_argument("--compare", help="与之前的 suite 结果文件对比")
+    args = parser.parse_args(argv)
+    
+    for name in args.names or list(BENCHES):
+        if name == "suite":
+            run_suite([int(pages) for pages in args.pages.split(",")], args.json, args.compare)
+        elif name in BENCHES:
+            BENCHES[name]()
+        else:
+            print(f"未知基准: {name}（可选: {', '.join(BENCHES)}, suite）")
+            return 2
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
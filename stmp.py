@@ -1,60 +1,1537 @@
 import os
 import io
+import sys
+import glob
+import json
+import time
+import zlib
+import math
+import shutil
+import hashlib
+import queue
+import atexit
+import argparse
 import tempfile
+import weakref
+import threading
+import unicodedata
+import multiprocessing
+import subprocess
+from collections import OrderedDict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FutureTimeoutError
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
+import numpy as np
 from PIL import Image, ImageTk
-from PyPDF2 import PdfReader, PdfWriter
+from PyPDF2 import PageObject, PdfReader, PdfWriter, __version__ as PYPDF2_VERSION
+from PyPDF2.errors import PdfReadError
+from PyPDF2.generic import (ArrayObject, DecodedStreamObject, DictionaryObject,
+                            EncodedStreamObject, FloatObject, IndirectObject, NameObject,
+                            NumberObject, RectangleObject, StreamObject)
 from pdf2image import convert_from_path
 from reportlab.pdfgen import canvas
+from reportlab.pdfgen.canvas import FILL_EVEN_ODD
 from reportlab.lib.pagesizes import letter
+from reportlab.lib.utils import ImageReader
+from reportlab.lib.rl_accel import fp_str
 
-def add_stamp_to_pdf(pdf_path, stamp_path, output_path, position=(0, 0), size=1.0):
-    """将印章图片添加到PDF指定位置（保持原始像素，仅按比例调整显示尺寸）"""
-    temp_pdf_path = None
+# ---------------------------------------------------------------------------
+# 耗时追踪：环境变量 STMP_TRACE=输出.json 或命令行 --trace 输出.json 启用，
+# 退出时写出 Chrome trace（chrome://tracing、Perfetto 可打开）并打印汇总表
+# ---------------------------------------------------------------------------
+
+class _Span:
+    __slots__ = ('tracer', 'name', 'args', 'start')
+    
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+    
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        self.tracer.events.append((self.name, self.start, time.perf_counter(), self.args,
+                                   os.getpid(), threading.get_ident()))
+        return False
+
+class _NullSpan:
+    __slots__ = ()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+class Tracer:
+    """耗时追踪：记录各阶段的时间段，未启用时 span() 返回共用的空对象，几乎无开销
+
+    用法: with TRACE.span("export.write", pages=10): ...
+    时间段可嵌套，按线程/进程分别显示；进程池中的事件由 drain()/merge() 汇总到主进程。
+    """
+    def __init__(self):
+        self.enabled = False
+        self.path = None
+        self.events = []  # [(名称, 开始秒, 结束秒, 参数, pid, tid)]
+        self._exit_registered = False
+    
+    def enable(self, path="stmp_trace.json"):
+        """启用追踪；path 不为 None 时在进程退出时写出追踪文件并打印汇总表"""
+        self.enabled = True
+        self.path = path
+        if path and not self._exit_registered:
+            self._exit_registered = True
+            atexit.register(self._finish)
+    
+    def span(self, name, **args):
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, args)
+    
+    def record(self, name, start, end, **args):
+        """记录一段已经结束的时间（如界面回调比预定时间晚到的间隔）"""
+        if self.enabled:
+            self.events.append((name, start, end, args, os.getpid(), threading.get_ident()))
+    
+    def drain(self):
+        """取出并清空已记录的事件（工作进程返回给主进程用）"""
+        events, self.events = self.events, []
+        return events
+    
+    def merge(self, events):
+        self.events.extend(events)
+    
+    def chrome_trace(self):
+        """Chrome trace 格式（完整事件 "X"，时间单位微秒）"""
+        return {
+            'displayTimeUnit': 'ms',
+            'traceEvents': [
+                {'name': name, 'cat': name.split('.', 1)[0], 'ph': 'X',
+                 'ts': round(start * 1e6, 3), 'dur': round((end - start) * 1e6, 3),
+                 'pid': pid, 'tid': tid, 'args': args}
+                for name, start, end, args, pid, tid in self.events],
+        }
+    
+    def export(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.chrome_trace(), f, ensure_ascii=False, default=str)
+    
+    def summary(self):
+        """按名称汇总的表格：次数、总耗时、平均、最大（毫秒），按总耗时降序"""
+        stats = {}
+        for name, start, end, _, _, _ in self.events:
+            elapsed = (end - start) * 1000
+            count, total, longest = stats.get(name, (0, 0.0, 0.0))
+            stats[name] = (count + 1, total + elapsed, max(longest, elapsed))
+        lines = [f"{'阶段':<28}{'次数':>8}{'总计ms':>12}{'平均ms':>10}{'最大ms':>10}"]
+        for name, (count, total, longest) in sorted(stats.items(), key=lambda item: -item[1][1]):
+            lines.append(f"{name:<30}{count:>8}{total:>12.1f}{total / count:>10.2f}{longest:>10.1f}")
+        return "\n".join(lines)
+    
+    def _finish(self):
+        if not self.events:
+            return
+        self.export(self.path)
+        print(self.summary(), file=sys.stderr)
+        print(f"追踪已写入 {self.path}", file=sys.stderr)
+
+TRACE = Tracer()
+if os.environ.get("STMP_TRACE"):
+    _trace_path = os.environ["STMP_TRACE"]
+    TRACE.enable("stmp_trace.json" if _trace_path.lower() in ("1", "true", "yes") else _trace_path)
+
+# 印章透明化/着色的默认参数（与原逐像素循环的阈值一致）
+STAMP_PROCESS_DEFAULTS = {
+    'white_threshold': 230,   # 白色背景阈值
+    'shadow_threshold': 180,  # 灰色阴影阈值
+    'alpha_gain': 2.0 * 0.7,  # 颜色强度→透明度的增益
+    'tint': (255, 30, 30),    # 印章着色（鲜艳红色）
+}
+
+def process_stamp_image(img, white_threshold=230, shadow_threshold=180,
+                        alpha_gain=2.0 * 0.7, tint=(255, 30, 30)):
+    """印章透明化和着色（向量化实现，预览与导出共用）
+
+    RGB三通道均高于阈值的像素（白底、灰色阴影）变为全透明，其余像素着色为
+    tint，透明度 = min(255, int((255 - 平均亮度) * alpha_gain))。
+    返回新的RGBA图像，不修改传入的图像。
+    """
+    rgb = np.asarray(img.convert("RGB"), dtype=np.uint8)
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    channel_min = np.minimum(np.minimum(r, g), b)
+    # 白色背景和灰色阴影都透明化
+    transparent = (channel_min > white_threshold) | (channel_min > shadow_threshold)
+    
+    # 透明度只取决于三通道之和（0-765），用查找表代替逐像素浮点运算，
+    # 查找表按原循环的运算顺序生成，保证结果逐像素一致
+    sums = np.arange(766, dtype=np.float64)
+    alpha_lut = np.minimum(255, ((255 - sums / 3) * alpha_gain).astype(np.int64)).astype(np.uint8)
+    channel_sum = r.astype(np.uint16) + g + b
+    alpha = np.where(transparent, 0, alpha_lut[channel_sum]).astype(np.uint8)
+    
+    out = np.empty(rgb.shape[:2] + (4,), dtype=np.uint8)
+    for i, value in enumerate(tint):
+        out[..., i] = np.where(transparent, 255, value)
+    out[..., 3] = alpha
+    return Image.fromarray(out, "RGBA")
+
+def image_digest(img):
+    """计算图像内容哈希（尺寸、模式和像素数据）"""
+    h = hashlib.sha1(f"{img.mode}:{img.width}x{img.height}:".encode())
+    h.update(img.tobytes())
+    return h.hexdigest()
+
+def file_digest(path, chunk_size=1 << 20):
+    """计算文件内容哈希（SHA-256）"""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+class ProcessedStampCache:
+    """处理后印章缓存，按（图像内容哈希, 处理参数）索引
+
+    超过 max_entries 项或 max_bytes 字节时淘汰最久未使用的项，因此印章或参数
+    变化后旧结果会被自动淘汰；默认只保留一项。
+    每项同时缓存导出用的 ImageReader，使多次导出共用同一份像素数据。
+    """
+    def __init__(self, max_entries=1, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._entries = OrderedDict()  # {键: [处理后图像, ImageReader或None]}
+    
+    @staticmethod
+    def make_key(digest, params):
+        return (digest, tuple(sorted(params.items())))
+    
+    def _entry(self, digest, img, params):
+        key = self.make_key(digest, params)
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        
+        with TRACE.span("stamp.process", width=img.width, height=img.height):
+            processed = process_stamp_image(img, **params)
+        entry = self._entries[key] = [processed, None]
+        self.total_bytes += processed.width * processed.height * 4
+        while len(self._entries) > 1 and (
+                len(self._entries) > self.max_entries
+                or (self.max_bytes is not None and self.total_bytes > self.max_bytes)):
+            self._drop(next(iter(self._entries)))
+        return entry
+    
+    def _drop(self, key):
+        processed = self._entries.pop(key)[0]
+        self.total_bytes -= processed.width * processed.height * 4
+    
+    def get(self, digest, img, params):
+        """返回处理后的印章图像，未命中时计算并缓存"""
+        return self._entry(digest, img, params)[0]
+    
+    def get_reader(self, digest, img, params):
+        """返回处理后印章的 ImageReader（导出用）"""
+        entry = self._entry(digest, img, params)
+        if entry[1] is None:
+            entry[1] = ImageReader(entry[0])
+        return entry[1]
+    
+    def evict(self, digest):
+        """淘汰某个印章的所有处理结果"""
+        for key in [key for key in self._entries if key[0] == digest]:
+            self._drop(key)
+    
+    def clear(self):
+        self._entries.clear()
+        self.total_bytes = 0
+
+class Seal:
+    """印章库中的一枚印章（原始图像保持不变）"""
+    __slots__ = ('id', 'path', 'image', 'digest', 'width', 'height')
+    
+    def __init__(self, seal_id, image, path=None):
+        self.id = seal_id
+        self.path = path
+        self.image = image
+        self.digest = image_digest(image)
+        self.width = image.width
+        self.height = image.height
+
+class SealLibrary:
+    """印章库：管理多枚印章，每枚印章的处理结果只计算一次并缓存
+
+    处理结果（预览与导出共用）缓存总量受 max_bytes 限制，移除印章时同时淘汰。
+    """
+    def __init__(self, params=None, max_bytes=256 * 1024 * 1024):
+        self.params = dict(STAMP_PROCESS_DEFAULTS if params is None else params)
+        self.cache = ProcessedStampCache(max_entries=64, max_bytes=max_bytes)
+        self._seals = OrderedDict()  # {印章ID: Seal}
     
+    def __len__(self):
+        return len(self._seals)
+    
+    def __contains__(self, seal_id):
+        return seal_id in self._seals
+    
+    def __iter__(self):
+        return iter(list(self._seals.values()))
+    
+    def ids(self):
+        return list(self._seals)
+    
+    def get(self, seal_id):
+        return self._seals.get(seal_id)
+    
+    def add(self, path, seal_id=None):
+        """从图片文件加载印章，返回 Seal；未指定ID时以文件名生成不重复的ID"""
+        with TRACE.span("stamp.open"):
+            image = Image.open(path).convert("RGBA")
+        if seal_id is None:
+            base = os.path.splitext(os.path.basename(path))[0] or "印章"
+            seal_id = base
+            suffix = 1
+            while seal_id in self._seals:
+                suffix += 1
+                seal_id = f"{base}-{suffix}"
+        return self.add_image(seal_id, image, path)
+    
+    def add_image(self, seal_id, image, path=None):
+        if seal_id in self._seals:
+            self.remove(seal_id)
+        with TRACE.span("stamp.digest"):
+            seal = self._seals[seal_id] = Seal(seal_id, image, path)
+        return seal
+    
+    def remove(self, seal_id):
+        seal = self._seals.pop(seal_id, None)
+        if seal is not None and not any(other.digest == seal.digest for other in self._seals.values()):
+            self.cache.evict(seal.digest)
+        return seal
+    
+    def processed(self, seal_id):
+        """处理后的印章图像（预览用）"""
+        seal = self._seals[seal_id]
+        return self.cache.get(seal.digest, seal.image, self.params)
+    
+    def export_image(self, seal_id):
+        """处理后印章的 ImageReader（导出用）"""
+        seal = self._seals[seal_id]
+        return self.cache.get_reader(seal.digest, seal.image, self.params)
+
+# 锚点：印章上与给定坐标对齐的点（按页面显示方向，0~1，原点在印章左下角）
+ANCHORS = {
+    'center': (0.5, 0.5),
+    'top-left': (0.0, 1.0), 'top': (0.5, 1.0), 'top-right': (1.0, 1.0),
+    'left': (0.0, 0.5), 'right': (1.0, 0.5),
+    'bottom-left': (0.0, 0.0), 'bottom': (0.5, 0.0), 'bottom-right': (1.0, 0.0),
+}
+
+class PageBox:
+    """页面的可见区域（CropBox，缺省为 MediaBox）与显示旋转（/Rotate）
+
+    “页面坐标”以页面按 /Rotate 旋转后显示时可见区域的左下角为原点，单位pt，
+    与阅读器中看到的页面一致；to_user 将其换算为PDF用户坐标。
+    """
+    __slots__ = ('left', 'bottom', 'box_width', 'box_height', 'rotation')
+    
+    def __init__(self, page):
+        # 直接读取页面字典（page.cropbox 会把缺省值写回页面，导致输出的每页多出 /CropBox）
+        box = RectangleObject(page["/CropBox"] if "/CropBox" in page else page["/MediaBox"])
+        self.left = float(box.left)
+        self.bottom = float(box.bottom)
+        self.box_width = float(box.width)
+        self.box_height = float(box.height)
+        self.rotation = int(round(page.rotation / 90.0)) * 90 % 360
+    
+    @property
+    def width(self):
+        """显示宽度"""
+        return self.box_height if self.rotation in (90, 270) else self.box_width
+    
+    @property
+    def height(self):
+        """显示高度"""
+        return self.box_width if self.rotation in (90, 270) else self.box_height
+    
+    def to_user(self, u, v):
+        """页面坐标 → PDF用户坐标"""
+        if self.rotation == 90:
+            x, y = self.box_width - v, u
+        elif self.rotation == 180:
+            x, y = self.box_width - u, self.box_height - v
+        elif self.rotation == 270:
+            x, y = v, self.box_height - u
+        else:
+            x, y = u, v
+        return self.left + x, self.bottom + y
+    
+    def from_user(self, x, y):
+        """PDF用户坐标 → 页面坐标（to_user 的逆变换）"""
+        x -= self.left
+        y -= self.bottom
+        if self.rotation == 90:
+            return y, self.box_width - x
+        if self.rotation == 180:
+            return self.box_width - x, self.box_height - y
+        if self.rotation == 270:
+            return self.box_height - y, x
+        return x, y
+    
+    def clamp(self, u, v, draw_width, draw_height):
+        """将印章中心 (u, v) 移到使整个印章位于可见区域内的最近位置（与界面导出一致）"""
+        half_width, half_height = draw_width / 2, draw_height / 2
+        if u - half_width < 0:
+            u = half_width
+        elif u + half_width > self.width:
+            u = self.width - half_width
+        if v - half_height < 0:
+            v = half_height
+        elif v + half_height > self.height:
+            v = self.height - half_height
+        return u, v
+    
+    def placement(self, u, v, draw_width, draw_height, seal_id=None, anchor="center"):
+        """页面坐标中的印章 → (x, y, draw_width, draw_height, seal_id, rotation)
+
+        返回值为 build_stamp_overlays 使用的位置：x/y 为印章中心的用户坐标，
+        rotation 为印章在用户坐标中逆时针旋转的角度，使其在显示时保持正向。
+        """
+        if anchor not in ANCHORS:
+            raise ValueError(f"未知的锚点: {anchor}（可选: {', '.join(ANCHORS)}）")
+        anchor_x, anchor_y = ANCHORS[anchor]
+        x, y = self.to_user(u + (0.5 - anchor_x) * draw_width,
+                            v + (0.5 - anchor_y) * draw_height)
+        return (x, y, draw_width, draw_height, seal_id, self.rotation)
+
+class SealEncoding:
+    """导出时印章图像的重采样与编码方式
+
+    dpi 为 None 时嵌入处理后的全部原始像素；否则按该印章在所有页面上的最大绘制
+    尺寸重采样到这一有效分辨率（只缩小，不放大）。format 为 "flate"（无损）、
+    "jpeg"（颜色用 JPEG，透明度仍为无损的 SMask，quality 为 JPEG 质量），或
+    "vector"（将印章描摹为单色填充路径，tolerance 为简化容差，见 VectorSeal）。
+    不指定编码（None）时保持 reportlab 的默认输出，与之前的版本一致。
+    """
+    __slots__ = ('dpi', 'format', 'quality', 'tolerance')
+    FORMATS = ("flate", "jpeg", "vector")
+    
+    def __init__(self, dpi=None, format="flate", quality=85, tolerance=1.0):
+        if format not in self.FORMATS:
+            raise ValueError(f"不支持的印章编码: {format}（可选: {', '.join(self.FORMATS)}）")
+        if dpi is not None and dpi <= 0:
+            raise ValueError(f"印章分辨率必须大于0: {dpi}")
+        self.dpi = dpi
+        self.format = format
+        self.quality = quality
+        self.tolerance = tolerance
+    
+    def __repr__(self):
+        return (f"SealEncoding(dpi={self.dpi!r}, format={self.format!r}, "
+                f"quality={self.quality!r}, tolerance={self.tolerance!r})")
+    
+    def resample(self, img, draw_width, draw_height):
+        """按最大绘制尺寸（pt）重采样；dpi 为 None 或图像已足够小时原样返回"""
+        if self.dpi is None:
+            return img
+        width = max(1, math.ceil(draw_width / 72 * self.dpi))
+        height = max(1, math.ceil(draw_height / 72 * self.dpi))
+        if width >= img.width and height >= img.height:
+            return img
+        width, height = min(width, img.width), min(height, img.height)
+        # 预乘透明度后缩放，避免透明区域的颜色渗到印章边缘
+        return img.convert("RGBa").resize((width, height), Image.LANCZOS).convert("RGBA")
+
+def _mask_outlines(mask):
+    """将二值掩码的边界连接为闭合轮廓，返回 [(N, 2) 整数格点坐标数组]（y 向下）
+
+    每条边界边都是相邻内外像素之间的一段单位边，方向取内部在右侧，因此每个格点的
+    出边与入边一样多，从任一条边出发总能走回起点。按奇偶规则填充全部轮廓即还原掩码
+    （对角相接处无论怎样连接都不影响奇偶性）。
+    """
+    height, width = mask.shape
+    padded = np.pad(mask, 1)
+    stride = width + 1
+    # 水平边：格线 y 上 x→x+1，上方像素 padded[y, x+1]，下方像素 padded[y+1, x+1]
+    above, below = padded[:-1, 1:-1], padded[1:, 1:-1]
+    ys, xs = np.nonzero(above != below)
+    down = below[ys, xs]  # 下方在内部：向 +x，否则向 -x
+    h_start = np.where(down, ys * stride + xs, ys * stride + xs + 1)
+    h_end = np.where(down, ys * stride + xs + 1, ys * stride + xs)
+    # 竖直边：格线 x 上 y→y+1，左侧像素 padded[y+1, x]，右侧像素 padded[y+1, x+1]
+    left, right = padded[1:-1, :-1], padded[1:-1, 1:]
+    ys, xs = np.nonzero(left != right)
+    inside_left = left[ys, xs]  # 左侧在内部：向 +y，否则向 -y
+    v_start = np.where(inside_left, ys * stride + xs, (ys + 1) * stride + xs)
+    v_end = np.where(inside_left, (ys + 1) * stride + xs, ys * stride + xs)
+    
+    outgoing = {}
+    for start, end in zip(np.concatenate([h_start, v_start]).tolist(),
+                          np.concatenate([h_end, v_end]).tolist()):
+        targets = outgoing.get(start)
+        if targets is None:
+            outgoing[start] = end
+        elif isinstance(targets, list):
+            targets.append(end)
+        else:
+            outgoing[start] = [targets, end]
+    
+    def take(vertex):
+        targets = outgoing[vertex]
+        if not isinstance(targets, list):
+            del outgoing[vertex]
+            return targets
+        end = targets.pop()
+        if len(targets) == 1:
+            outgoing[vertex] = targets[0]
+        return end
+    
+    outlines = []
+    while outgoing:
+        # popitem 取起点（从字典末尾取，不会反复扫描已删除的项）
+        start, targets = outgoing.popitem()
+        if isinstance(targets, list):
+            vertex = targets.pop()
+            outgoing[start] = targets if len(targets) > 1 else targets[0]
+        else:
+            vertex = targets
+        loop = [start]
+        while vertex != start:
+            loop.append(vertex)
+            vertex = take(vertex)
+        loop = np.array(loop)
+        outlines.append(np.stack([loop % stride, loop // stride], axis=1))
+    return outlines
+
+def _simplify_outline(points, tolerance):
+    """Ramer–Douglas–Peucker 简化闭合轮廓：去掉偏离不超过 tolerance 的点"""
+    # 先去掉共线点（像素边界上的直线段只保留端点）
+    direction = np.diff(points, axis=0, append=points[:1])
+    turn = np.any(direction != np.roll(direction, 1, axis=0), axis=1)
+    points = points[turn]
+    if len(points) <= 4 or tolerance <= 0:
+        return points
+    # 从首点和离首点最远的点断开，两段分别简化
+    far = int(np.argmax(np.hypot(*(points - points[0]).T)))
+    path = np.concatenate([points, points[:1]])
+    keep = np.zeros(len(path), dtype=bool)
+    keep[[0, far, len(path) - 1]] = True
+    stack = [(0, far), (far, len(path) - 1)]
+    while stack:
+        i, j = stack.pop()
+        if j <= i + 1:
+            continue
+        a, b = path[i], path[j]
+        segment = path[i + 1:j]
+        dx, dy = b - a
+        norm = math.hypot(dx, dy)
+        if norm == 0:
+            distances = np.hypot(*(segment - a).T)
+        else:
+            distances = np.abs(dx * (segment[:, 1] - a[1]) - dy * (segment[:, 0] - a[0])) / norm
+        k = int(np.argmax(distances))
+        if distances[k] > tolerance:
+            keep[i + 1 + k] = True
+            stack.append((i, i + 1 + k))
+            stack.append((i + 1 + k, j))
+    return path[:-1][keep[:-1]]
+
+class VectorSeal:
+    """描摹为单色填充路径的印章（与分辨率无关）
+
+    以透明度阈值得到印章掩码，在不超过 max_size 的描摹分辨率下把边界连成闭合
+    轮廓，以各段像素边的中点为顶点（斜边不再呈锯齿），再按 tolerance（描摹分辨率
+    下的像素）简化，按奇偶规则填充；颜色取印章不透明像素的中位数颜色。
+    中点坐标按 2 倍保存为整数，写入PDF时很紧凑。
+    """
+    def __init__(self, img, tolerance=1.0, max_size=1024, threshold=128):
+        img = _seal_pil_image(img)
+        scale = min(1.0, max_size / max(img.width, img.height))
+        if scale < 1.0:
+            img = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))),
+                             Image.BOX)
+        pixels = np.asarray(img)
+        mask = pixels[..., 3] >= threshold
+        self.width, self.height = img.width, img.height
+        self.tolerance = tolerance
+        opaque = pixels[..., :3][mask]
+        self.color = (tuple(float(value) / 255 for value in np.median(opaque, axis=0))
+                      if len(opaque) else (0.0, 0.0, 0.0))
+        self.outlines = []
+        for outline in _mask_outlines(mask):
+            midpoints = outline + np.roll(outline, -1, axis=0)  # 2 × 边中点
+            outline = _simplify_outline(midpoints, tolerance * 2)
+            if len(outline) >= 3:
+                self.outlines.append(outline)
+    
+    @property
+    def point_count(self):
+        return sum(len(outline) for outline in self.outlines)
+    
+    def draw(self, c):
+        """在 reportlab 画布的单位正方形（0~1）内绘制，供表单使用"""
+        c.saveState()
+        c.transform(0.5 / self.width, 0, 0, -0.5 / self.height, 0, 1)
+        c.setFillColorRGB(*self.color)
+        path = c.beginPath()
+        for outline in self.outlines:
+            points = outline.tolist()
+            path.moveTo(*points[0])
+            for x, y in points[1:]:
+                path.lineTo(x, y)
+            path.close()
+        c.drawPath(path, stroke=0, fill=1, fillMode=FILL_EVEN_ODD)
+        c.restoreState()
+
+# 描摹结果缓存：同一印章（同一图像对象或同一文件）按相同容差只描摹一次
+# PIL 图像不可哈希，按 id 索引并用弱引用确认对象未被替换，对象释放时移除
+_vector_seals = {}  # {id(图像对象): (弱引用, {容差: VectorSeal})}
+_vector_seal_files = OrderedDict()  # {(路径, 修改时间, 容差): VectorSeal}
+
+def vector_seal(source, tolerance=1.0):
+    """返回印章的描摹结果（按印章缓存）；source 为路径、PIL图像或 ImageReader"""
+    if isinstance(source, ImageReader):
+        source = source._image  # 同一图像包装成不同 ImageReader 时共用描摹结果
+    if isinstance(source, Image.Image):
+        key = id(source)
+        entry = _vector_seals.get(key)
+        if entry is None or entry[0]() is not source:
+            entry = _vector_seals[key] = (
+                weakref.ref(source, lambda _, key=key: _vector_seals.pop(key, None)), {})
+        traced = entry[1]
+        if tolerance not in traced:
+            with TRACE.span("overlay.trace", tolerance=tolerance):
+                traced[tolerance] = VectorSeal(source, tolerance)
+        return traced[tolerance]
+    key = (os.path.abspath(source), os.path.getmtime(source), tolerance)
+    if key not in _vector_seal_files:
+        with TRACE.span("overlay.trace", tolerance=tolerance):
+            _vector_seal_files[key] = VectorSeal(source, tolerance)
+        while len(_vector_seal_files) > 16:
+            _vector_seal_files.popitem(last=False)
+    _vector_seal_files.move_to_end(key)
+    return _vector_seal_files[key]
+
+def _seal_pil_image(source):
+    """drawImage 可接受的印章图像（路径、PIL图像或 ImageReader）→ RGBA PIL图像"""
+    if isinstance(source, ImageReader):
+        source = source._image
+    if not isinstance(source, Image.Image):
+        with Image.open(source) as img:
+            return img.convert("RGBA")
+    return source if source.mode == "RGBA" else source.convert("RGBA")
+
+def _set_image_stream(image, data, filter_name, size):
+    """就地替换叠加文档中图像XObject的数据与编码"""
+    image._data = data
+    if getattr(image, "decoded_self", None) is not None:
+        image.decoded_self = None
+    image[NameObject("/Filter")] = NameObject(filter_name)
+    image.pop(NameObject("/DecodeParms"), None)
+    image[NameObject("/Width")] = NumberObject(size[0])
+    image[NameObject("/Height")] = NumberObject(size[1])
+
+def _encode_seal_image(image, img, encoding):
+    """按 encoding 重写印章图像XObject：颜色为 Flate 或 JPEG，SMask 始终为 Flate"""
+    rgb = img.convert("RGB")
+    if encoding.format == "jpeg":
+        buffer = io.BytesIO()
+        rgb.save(buffer, format="JPEG", quality=encoding.quality)
+        _set_image_stream(image, buffer.getvalue(), "/DCTDecode", img.size)
+    else:
+        _set_image_stream(image, zlib.compress(rgb.tobytes()), "/FlateDecode", img.size)
+    if "/SMask" in image:
+        _set_image_stream(image["/SMask"].get_object(),
+                          zlib.compress(img.getchannel("A").tobytes()), "/FlateDecode", img.size)
+
+def _find_form_image(overlays, form_name):
+    """在叠加层页面资源中找到印章表单引用的图像XObject"""
+    for overlay in overlays:
+        form = overlay["/Resources"].get("/XObject", {}).get(f"/FormXob.{form_name}")
+        if form is None:
+            continue
+        for xobject in form.get_object()["/Resources"]["/XObject"].values():
+            xobject = xobject.get_object()
+            if xobject.get("/Subtype") == "/Image":
+                return xobject
+    return None
+
+# 并行生成叠加层时每个任务包含的叠加层数（不足两块时不启用进程池）；单个叠加层
+# 只需几十微秒，只有几千个不同叠加层的导出才值得启动工作进程
+OVERLAY_CHUNK_SIZE = 2048
+
+def _overlay_stream(placements, form_names):
+    """一个叠加层的内容流：每枚印章一个变换矩阵，引用单位尺寸的印章表单"""
+    operators = []
+    for x, y, draw_width, draw_height, seal_id, rotation in placements:
+        radians = math.radians(rotation)
+        cos, sin = math.cos(radians), math.sin(radians)
+        # 平移到中心 · 逆时针旋转 · 缩放到绘制尺寸并使单位正方形以原点为中心
+        matrix = fp_str(draw_width * cos, draw_width * sin, -draw_height * sin, draw_height * cos,
+                        x - (draw_width * cos - draw_height * sin) / 2,
+                        y - (draw_width * sin + draw_height * cos) / 2)
+        operators.append(f"q {matrix} cm /FormXob.{form_names[seal_id]} Do Q")
+    return "\n".join(operators).encode()
+
+def _overlay_bounds(page_width, page_height, placements):
+    """叠加层的范围：页面与全部印章（按旋转后的外接矩形）的并集"""
+    box = [0.0, 0.0, page_width, page_height]
+    for x, y, draw_width, draw_height, _, rotation in placements:
+        radians = math.radians(rotation)
+        half_x = (abs(draw_width * math.cos(radians)) + abs(draw_height * math.sin(radians))) / 2
+        half_y = (abs(draw_width * math.sin(radians)) + abs(draw_height * math.cos(radians))) / 2
+        box = [min(box[0], x - half_x), min(box[1], y - half_y),
+               max(box[2], x + half_x), max(box[3], y + half_y)]
+    return box
+
+def _overlay_streams(specs, form_names):
+    """生成一组叠加层 [(Flate 压缩的内容流, 范围), ...]（在工作进程中运行）"""
+    return [(zlib.compress(_overlay_stream(placements, form_names)),
+             _overlay_bounds(page_width, page_height, placements))
+            for page_width, page_height, placements in specs]
+
+def _iter_overlay_streams(specs, form_names, workers=None):
+    """按顺序产出各叠加层的 (内容流, 范围)
+
+    workers > 1 且叠加层不少于两块（OVERLAY_CHUNK_SIZE）时分块交给进程池，按提交
+    顺序取回结果；同时在途的块不超过 2 × workers，内存占用与总页数无关。
+    进程池用 spawn 启动：界面导出时调用方所在进程还有渲染/预取等线程，fork 出的子进程
+    可能继承其他线程持有的锁而死锁。
+    """
+    chunks = [specs[i:i + OVERLAY_CHUNK_SIZE] for i in range(0, len(specs), OVERLAY_CHUNK_SIZE)]
+    if not workers or workers <= 1 or len(chunks) < 2:
+        for chunk in chunks:
+            yield from _overlay_streams(chunk, form_names)
+        return
+    workers = min(workers, len(chunks))
+    with ProcessPoolExecutor(max_workers=workers,
+                             mp_context=multiprocessing.get_context("spawn")) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(_overlay_streams, chunk, form_names))
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+def build_stamp_overlays(page_specs, stamp_image, encoding=None, workers=None):
+    """生成所有需要盖章的页面的叠加层（不产生临时文件）
+
+    page_specs 为 [(page_width, page_height, placements), ...]，每项对应一页叠加层；
+    placements 为 [(x, y, draw_width, draw_height[, seal_id[, rotation]]), ...]，x/y 为
+    印章中心的PDF用户坐标，rotation 为逆时针旋转角度（见 PageBox.placement）；stamp_image 为 drawImage 可接受的图像（路径或 ImageReader），或
+    {seal_id: 图像} 形式的多枚印章（不带 seal_id 的位置使用键 None 对应的印章）。
+    每枚印章只用 reportlab 绘制一次到单位尺寸的表单中（图像含SMask只嵌入一次），
+    各叠加层的内容流只是引用这些表单的变换矩阵，直接生成而不再经 reportlab 绘制和
+    解析，合并后输出文件中印章图像也只保存一份。
+    几何完全相同（页面尺寸与全部印章位置一致）的页面只生成一次，共用同一个叠加层页面。
+    encoding（SealEncoding）指定时，印章图像按最大绘制尺寸重采样并按其格式编码。
+    workers > 1 时叠加层较多的导出在进程池中分块生成（见 _iter_overlay_streams）。
+    返回与 page_specs 一一对应的叠加层页面列表。
+    """
+    stamp_images = stamp_image if isinstance(stamp_image, dict) else {None: stamp_image}
+    
+    unique_specs = {}  # {几何: 叠加层序号}
+    spec_indexes = []
+    for page_width, page_height, placements in page_specs:
+        key = (float(page_width), float(page_height),
+               tuple((*placement[:4], placement[4] if len(placement) > 4 else None,
+                      placement[5] if len(placement) > 5 else 0)
+                     for placement in placements))
+        spec_indexes.append(unique_specs.setdefault(key, len(unique_specs)))
+    
+    buffer = io.BytesIO()
+    c = canvas.Canvas(buffer)
+    
+    # 每枚印章的图像只绘制一次到单位尺寸的表单中，各位置通过变换矩阵引用该表单，
+    # 避免 drawImage 每次调用都对整幅图像数据重新计算摘要
+    used_seals = {placement[4] for _, _, placements in unique_specs for placement in placements}
+    form_names = {}
+    encoded_images = {}  # {seal_id: 重采样后的 PIL 图像}
+    for seal_id in stamp_images:
+        if seal_id in used_seals:
+            form_names[seal_id] = f"Stamp{len(form_names)}"
+            with TRACE.span("overlay.seal_image", seal=seal_id):
+                image = stamp_images[seal_id]
+                if encoding is not None and encoding.format == "vector":
+                    c.beginForm(form_names[seal_id], 0, 0, 1, 1)
+                    vector_seal(image, encoding.tolerance).draw(c)
+                    c.endForm()
+                    continue
+                if encoding is not None:
+                    draw_sizes = [placement[2:4] for _, _, placements in unique_specs
+                                  for placement in placements if placement[4] == seal_id]
+                    img = encoding.resample(_seal_pil_image(image),
+                                            max(size[0] for size in draw_sizes),
+                                            max(size[1] for size in draw_sizes))
+                    encoded_images[seal_id] = img
+                    image = ImageReader(img)
+                c.beginForm(form_names[seal_id], 0, 0, 1, 1)
+                c.drawImage(image, 0, 0, width=1, height=1, mask='auto')
+                c.endForm()
+    
+    # 表单挂在一个载体页面的资源中，只为从解析结果中取得它们的引用
+    for form_name in form_names.values():
+        c.doForm(form_name)
+    c.showPage()
+    with TRACE.span("overlay.save"):
+        c.save()
+        buffer.seek(0)
+        carrier = PdfReader(buffer).pages[0]
+    for seal_id, img in encoded_images.items():
+        with TRACE.span("overlay.encode", seal=seal_id, format=encoding.format):
+            image = _find_form_image([carrier], form_names[seal_id])
+            if image is not None:
+                _encode_seal_image(image, img, encoding)
+    carrier_xobjects = carrier["/Resources"].get("/XObject", DictionaryObject())
+    resources = DictionaryObject({NameObject("/XObject"): DictionaryObject({
+        NameObject(f"/FormXob.{form_name}"): carrier_xobjects.raw_get(f"/FormXob.{form_name}")
+        for form_name in form_names.values()})})
+    
+    overlays = []
+    with TRACE.span("overlay.streams", overlays=len(unique_specs), workers=workers or 1):
+        streams = _iter_overlay_streams(list(unique_specs), form_names, workers)
+        for data, box in streams:
+            contents = EncodedStreamObject()
+            contents._data = data
+            contents[NameObject("/Filter")] = NameObject("/FlateDecode")
+            overlay = PageObject()
+            overlay[NameObject("/MediaBox")] = RectangleObject(box)
+            overlay[NameObject("/Resources")] = resources
+            overlay[NameObject("/Contents")] = contents
+            overlays.append(overlay)
+    return [overlays[index] for index in spec_indexes]
+
+def _overlay_form(overlay, copy):
+    """将叠加层页面包装为表单XObject，copy 用于把叠加文档中的对象复制到目标文档"""
+    form = copy(overlay["/Contents"].get_object())
+    form[NameObject("/Type")] = NameObject("/XObject")
+    form[NameObject("/Subtype")] = NameObject("/Form")
+    form[NameObject("/BBox")] = ArrayObject([FloatObject(value) for value in overlay.mediabox])
+    form[NameObject("/Resources")] = copy(overlay["/Resources"])
+    return form
+
+def _stamp_page_entries(page, form_ref, save_state_ref, draw_ref):
+    """盖章后页面的 (/Resources, /Contents)：原内容包在 q/Q 中，其后绘制印章表单
+
+    页面资源中以不与原有资源冲突的名称加入表单；draw_ref(名称) 返回
+    "Q q /名称 Do Q" 内容流的引用（同名的各页可共用同一个内容流）。
+    """
+    resources = page.get("/Resources")
+    resources = DictionaryObject(resources.get_object() if resources is not None else {})
+    xobjects = resources.get("/XObject")
+    xobjects = DictionaryObject(xobjects.get_object() if xobjects is not None else {})
+    name = "/StampOverlay"
+    suffix = 0
+    while name in xobjects:
+        suffix += 1
+        name = f"/StampOverlay{suffix}"
+    xobjects[NameObject(name)] = form_ref
+    resources[NameObject("/XObject")] = xobjects
+    
+    contents = page.get("/Contents")
+    contents = contents.get_object() if isinstance(contents, IndirectObject) else contents
+    if contents is None:
+        original_contents = []
+    elif isinstance(contents, ArrayObject):
+        original_contents = list(contents)
+    else:
+        original_contents = [page.raw_get("/Contents")]
+    return resources, ArrayObject([save_state_ref] + original_contents + [draw_ref(name)])
+
+def _draw_form_stream(name):
+    stream = DecodedStreamObject()
+    stream.set_data(f"\nQ\nq {name} Do Q\n".encode())
+    return stream
+
+def _save_state_stream():
+    stream = DecodedStreamObject()
+    stream.set_data(b"q\n")
+    return stream
+
+class ExportCancelled(Exception):
+    """导出被取消"""
+
+def write_stamped_pdf(pdf_reader, page_placements, stamp_image, output,
+                      progress=None, cancel_event=None, encoding=None, workers=None,
+                      compact=False):
+    """将印章叠加到各页并写出PDF
+
+    page_placements 为 {页码(从0开始): [(x, y, draw_width, draw_height[, seal_id[, rotation]]), ...]}
+    （PDF用户坐标，见 build_stamp_overlays；页面坐标可用 PageBox.placement 换算），
+    stamp_image 为单枚印章或 {seal_id: 印章}；
+    output 为输出路径或可写的二进制文件对象。输出为路径时先写入同目录下的
+    临时文件，完成后再替换，失败或取消时不会留下不完整的输出。
+    progress(已处理页数, 总页数) 在每页合并后调用；cancel_event（threading.Event）
+    被设置时抛出 ExportCancelled。encoding 为印章图像的编码方式（SealEncoding），
+    默认嵌入处理后的全部原始像素。workers 为生成叠加层的进程数（见 build_stamp_overlays）。
+    compact 为 True 时去重、压缩并以对象流和交叉引用流写出（见 write_compact_pdf）。
+    """
+    total_pages = len(pdf_reader.pages)
+    stamped_pages = [page_num for page_num in sorted(page_placements)
+                     if page_placements[page_num] and page_num < total_pages]
+    page_specs = []
+    for page_num in stamped_pages:
+        page = pdf_reader.pages[page_num]
+        page_specs.append((float(page.mediabox.width), float(page.mediabox.height),
+                           page_placements[page_num]))
+    
+    # 所有叠加层绘制在同一文档中，印章图像在输出PDF中只嵌入一次
+    with TRACE.span("export.overlays", pages=len(stamped_pages)):
+        overlays = dict(zip(stamped_pages, build_stamp_overlays(page_specs, stamp_image,
+                                                                encoding, workers)))
+    
+    # 每个叠加层包装为一个表单XObject，几何相同的页面引用同一个表单；
+    # 页面只追加一条绘制表单的内容流，不解析、不改写原内容
+    pdf_writer = PdfWriter()
+    forms = {}  # {id(叠加层): 表单引用}
+    draw_refs = {}  # {表单名称: 内容流引用}
+    save_state_ref = None
+    
+    def draw_ref(name):
+        if name not in draw_refs:
+            draw_refs[name] = pdf_writer._add_object(_draw_form_stream(name))
+        return draw_refs[name]
+    
+    for page_num in range(total_pages):
+        if cancel_event is not None and cancel_event.is_set():
+            raise ExportCancelled()
+        with TRACE.span("export.page", page=page_num):
+            page = pdf_writer.add_page(pdf_reader.pages[page_num])
+            overlay = overlays.get(page_num)
+            if overlay is not None:
+                if id(overlay) not in forms:
+                    form = _overlay_form(overlay, lambda obj: obj.clone(pdf_writer))
+                    forms[id(overlay)] = (getattr(form, "indirect_reference", None)
+                                         or pdf_writer._add_object(form))
+                if save_state_ref is None:
+                    save_state_ref = pdf_writer._add_object(_save_state_stream())
+                resources, contents = _stamp_page_entries(page, forms[id(overlay)],
+                                                          save_state_ref, draw_ref)
+                page[NameObject("/Resources")] = resources
+                page[NameObject("/Contents")] = contents
+        if progress:
+            progress(page_num + 1, total_pages)
+    
+    write = (lambda f: write_compact_pdf(pdf_writer, f)) if compact else pdf_writer.write
+    if not isinstance(output, (str, os.PathLike)):
+        with TRACE.span("export.write", compact=compact):
+            write(output)
+        return
+    
+    partial_path = f"{os.fspath(output)}.part"
     try:
-        # 获取原始印章图像尺寸（不加载像素数据，仅获取元信息）
-        with Image.open(stamp_path) as stamp_img:
-            original_width = stamp_img.width
-            original_height = stamp_img.height
-        
-        # 计算显示尺寸（原始尺寸×比例，不修改像素）
-        draw_width = int(original_width * size)
-        draw_height = int(original_height * size)
-        
-        # 创建临时PDF文件存储印章
-        with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as temp_pdf_file:
-            temp_pdf_path = temp_pdf_file.name
+        with open(partial_path, "wb") as f, TRACE.span("export.write", compact=compact):
+            write(f)
+        if cancel_event is not None and cancel_event.is_set():
+            raise ExportCancelled()
+        os.replace(partial_path, output)
+    except BaseException:
+        if os.path.exists(partial_path):
+            try:
+                os.remove(partial_path)
+            except OSError:
+                pass
+        raise
+
+def _find_startxref(f):
+    """读取文件末尾 startxref 指向的最后一个交叉引用表偏移"""
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    f.seek(max(0, size - 4096))
+    tail = f.read()
+    pos = tail.rfind(b"startxref")
+    if pos < 0:
+        raise ValueError("未找到 startxref，无法增量保存")
+    return int(tail[pos + len(b"startxref"):].split()[0])
+
+def append_stamped_pdf(pdf_path, page_placements, stamp_image, output,
+                       progress=None, cancel_event=None, pdf_reader=None, encoding=None,
+                       workers=None):
+    """以增量更新方式保存：原文件字节原样保留，印章作为新对象追加在文件末尾
+
+    追加内容包括印章叠加层（表单XObject，引用只嵌入一次的印章图像）、
+    盖章页面的新版本页面对象、新的交叉引用段和指向原交叉引用的 /Prev。
+    原文件使用交叉引用流时追加交叉引用流，否则追加传统交叉引用表。
+    output 与 pdf_path 相同时直接在原文件末尾追加；否则先复制原文件再追加。
+    参数含义同 write_stamped_pdf（pdf_reader 可传入已打开的同一文件），
+    返回追加的字节数。当前 PyPDF2 版本缺少所需内部属性时改为完整重写
+    （write_stamped_pdf），返回写出的字节数。
+    """
+    if pdf_reader is None:
+        pdf_reader = PdfReader(pdf_path)
+    if pdf_reader.is_encrypted:
+        raise ValueError("加密的PDF不支持增量保存")
+    missing = missing_pypdf2_internals(pdf_reader, _READER_INTERNALS)
+    if missing:
+        _warn_pypdf2_fallback("增量保存", missing)
+        write_stamped_pdf(pdf_reader, page_placements, stamp_image, output, progress=progress,
+                          cancel_event=cancel_event, encoding=encoding, workers=workers)
+        return os.path.getsize(output)
+    
+    total_pages = len(pdf_reader.pages)
+    stamped_pages = [page_num for page_num in sorted(page_placements)
+                     if page_placements[page_num] and page_num < total_pages]
+    page_specs = []
+    for page_num in stamped_pages:
+        page = pdf_reader.pages[page_num]
+        page_specs.append((float(page.mediabox.width), float(page.mediabox.height),
+                           page_placements[page_num]))
+    with TRACE.span("export.overlays", pages=len(stamped_pages)):
+        overlays = build_stamp_overlays(page_specs, stamp_image, encoding, workers)
+    
+    objects = {}  # {对象号: (代号, 对象)} 需要追加的对象
+    # 新对象号从原文件最大对象号之后开始
+    known_numbers = [number for numbers in pdf_reader.xref.values() for number in numbers]
+    known_numbers.extend(pdf_reader.xref_objStm)
+    next_number = [max([int(pdf_reader.trailer.get("/Size", 0))]
+                       + [number + 1 for number in known_numbers])]
+    
+    def allocate(obj=None):
+        number = next_number[0]
+        next_number[0] += 1
+        objects[number] = (0, obj)
+        return number
+    
+    imported = {}  # {叠加文档中的对象号: 新对象号}
+    
+    def import_object(obj):
+        """将叠加文档中的对象（递归）复制为新编号的对象"""
+        if isinstance(obj, IndirectObject):
+            if obj.idnum not in imported:
+                number = imported[obj.idnum] = allocate()
+                objects[number] = (0, import_object(obj.get_object()))
+            return IndirectObject(imported[obj.idnum], 0, None)
+        if isinstance(obj, StreamObject):
+            copy = type(obj)()
+            copy._data = obj._data
+            for key, value in obj.items():
+                if key != "/Length":
+                    copy[NameObject(key)] = import_object(value)
+            return copy
+        if isinstance(obj, DictionaryObject):
+            return DictionaryObject({NameObject(key): import_object(value)
+                                     for key, value in obj.items()})
+        if isinstance(obj, ArrayObject):
+            return ArrayObject([import_object(value) for value in obj])
+        return obj
+    
+    # 所有盖章页共用的 "q" 内容流：保护原页面的图形状态
+    save_state_ref = IndirectObject(allocate(_save_state_stream()), 0, None)
+    forms = {}  # {id(叠加层): 表单引用}，几何相同的页面共用一个表单
+    draw_refs = {}  # {表单名称: 内容流引用}
+    
+    def draw_ref(name):
+        if name not in draw_refs:
+            draw_refs[name] = IndirectObject(allocate(_draw_form_stream(name)), 0, None)
+        return draw_refs[name]
+    
+    for index, (page_num, overlay) in enumerate(zip(stamped_pages, overlays)):
+        if cancel_event is not None and cancel_event.is_set():
+            raise ExportCancelled()
+        with TRACE.span("export.page", page=page_num):
+            page = pdf_reader.pages[page_num]
             
-            # 获取原始PDF的页面尺寸
-            pdf_reader = PdfReader(pdf_path)
-            page = pdf_reader.pages[0]
-            page_width = float(page.mediabox.width)
-            page_height = float(page.mediabox.height)
+            # 叠加层页面包装为表单XObject
+            if id(overlay) not in forms:
+                form = _overlay_form(overlay, import_object)
+                forms[id(overlay)] = IndirectObject(allocate(form), 0, None)
+            resources, contents = _stamp_page_entries(page, forms[id(overlay)],
+                                                      save_state_ref, draw_ref)
             
-            # 绘制印章（使用原始图像，仅指定显示尺寸）
-            c = canvas.Canvas(temp_pdf_path, pagesize=(page_width, page_height))
-            x = position[0] - (draw_width / 2)  # 居中对齐
-            y = position[1] - (draw_height / 2)
-            # 关键：drawImage使用原始图像路径，通过width/height控制显示大小（不改变像素）
-            c.drawImage(stamp_path, x, y, 
-                       width=draw_width, height=draw_height, mask='auto')
-            c.save()
-        
-        # 合并印章到PDF
-        pdf_reader = PdfReader(pdf_path)
-        stamp_reader = PdfReader(temp_pdf_path)
-        pdf_writer = PdfWriter()
+            new_page = DictionaryObject(page)
+            new_page[NameObject("/Contents")] = contents
+            new_page[NameObject("/Resources")] = resources
+            page_ref = page.indirect_reference
+            objects[page_ref.idnum] = (page_ref.generation, new_page)
         
-        stamp_page = stamp_reader.pages[0]
-        for page_num in range(len(pdf_reader.pages)):
-            page = pdf_reader.pages[page_num]
-            page.merge_page(stamp_page)
-            pdf_writer.add_page(page)
+        if progress:
+            progress(index + 1, len(stamped_pages))
+    
+    trailer = DictionaryObject()
+    for key in ("/Root", "/Info", "/ID"):
+        if key in pdf_reader.trailer:
+            trailer[NameObject(key)] = pdf_reader.trailer.raw_get(key)
+    
+    in_place = (isinstance(output, (str, os.PathLike))
+                and os.path.abspath(output) == os.path.abspath(pdf_path))
+    target_path = os.fspath(output) if in_place else f"{os.fspath(output)}.part"
+    try:
+        if not in_place:
+            with TRACE.span("export.copy"):
+                shutil.copyfile(pdf_path, target_path)
+        with open(target_path, "r+b") as f:
+            f.seek(0, os.SEEK_END)
+            original_size = f.tell()
+            try:
+                with TRACE.span("export.write", objects=len(objects)):
+                    _write_incremental_update(f, objects, trailer, next_number[0])
+                appended = f.tell() - original_size
+                if cancel_event is not None and cancel_event.is_set():
+                    raise ExportCancelled()
+            except BaseException:
+                # 原地追加失败时截断回原始长度
+                if in_place:
+                    f.truncate(original_size)
+                raise
+    except BaseException:
+        if not in_place and os.path.exists(target_path):
+            os.remove(target_path)
+        raise
+    
+    if not in_place:
+        os.replace(target_path, output)
+    return appended
+
+def _write_incremental_update(f, objects, trailer, size):
+    """在文件末尾写出增量更新段：对象、交叉引用（表或流）和文件尾
+
+    objects 为 {对象号: (代号, 对象)}；trailer 为需要沿用的 /Root、/Info、/ID；
+    size 为新的 /Size（不含交叉引用流对象）。
+    """
+    previous_xref = _find_startxref(f)
+    f.seek(previous_xref)
+    xref_stream = f.read(4) != b"xref"
+    
+    f.seek(-1, os.SEEK_END)
+    if f.read(1) not in (b"\n", b"\r"):
+        f.write(b"\n")
+    
+    offsets = {}
+    for number in sorted(objects):
+        generation, obj = objects[number]
+        offsets[number] = f.tell()
+        f.write(f"{number} {generation} obj\n".encode())
+        obj.write_to_stream(f, None)
+        f.write(b"\nendobj\n")
+    
+    trailer = DictionaryObject(trailer)
+    trailer[NameObject("/Prev")] = NumberObject(previous_xref)
+    
+    if xref_stream:
+        # 原文件使用交叉引用流：追加交叉引用流（自身也需要登记）
+        xref_number = size
+        xref_offset = offsets[xref_number] = f.tell()
+        numbers = sorted(offsets)
+        rows = b"".join(
+            bytes([1]) + offsets[number].to_bytes(4, "big")
+            + (objects[number][0] if number in objects else 0).to_bytes(2, "big")
+            for number in numbers)
+        index = ArrayObject()
+        for start, count in _number_ranges(numbers):
+            index.extend([NumberObject(start), NumberObject(count)])
+        
+        xref = DecodedStreamObject()
+        xref._data = zlib.compress(rows)
+        xref.update(trailer)
+        xref[NameObject("/Type")] = NameObject("/XRef")
+        xref[NameObject("/Filter")] = NameObject("/FlateDecode")
+        xref[NameObject("/Size")] = NumberObject(size + 1)
+        xref[NameObject("/W")] = ArrayObject([NumberObject(1), NumberObject(4), NumberObject(2)])
+        xref[NameObject("/Index")] = index
+        f.write(f"{xref_number} 0 obj\n".encode())
+        xref.write_to_stream(f, None)
+        f.write(b"\nendobj\n")
+    else:
+        # 传统交叉引用表，每行固定20字节
+        xref_offset = f.tell()
+        f.write(b"xref\n")
+        numbers = sorted(offsets)
+        position = 0
+        for start, count in _number_ranges(numbers):
+            f.write(f"{start} {count}\n".encode())
+            for number in numbers[position:position + count]:
+                f.write(f"{offsets[number]:010d} {objects[number][0]:05d} n \n".encode())
+            position += count
+        trailer[NameObject("/Size")] = NumberObject(size)
+        f.write(b"trailer\n")
+        trailer.write_to_stream(f, None)
+        f.write(b"\n")
+    f.write(f"startxref\n{xref_offset}\n%%EOF\n".encode())
+
+def _number_ranges(numbers):
+    """将有序对象号列表分为连续区间 [(起始号, 数量), ...]"""
+    ranges = []
+    for number in numbers:
+        if ranges and ranges[-1][0] + ranges[-1][1] == number:
+            ranges[-1][1] += 1
+        else:
+            ranges.append([number, 1])
+    return [tuple(item) for item in ranges]
+
+# 对象种类按类型缓存：PyPDF2 的对象类经 typing 的 isinstance 较慢，大文件中需判断数十万次
+_REFERENCE, _DICTIONARY, _ARRAY, _OTHER = range(4)
+_object_kinds = {}
+
+def _object_kind(item):
+    kind = _object_kinds.get(type(item))
+    if kind is None:
+        if isinstance(item, IndirectObject):
+            kind = _REFERENCE
+        elif isinstance(item, DictionaryObject):
+            kind = _DICTIONARY
+        elif isinstance(item, ArrayObject):
+            kind = _ARRAY
+        else:
+            kind = _OTHER
+        _object_kinds[type(item)] = kind
+    return kind
+
+def _walk_references(obj):
+    """对象中直接包含的全部间接引用（不展开引用本身）"""
+    stack = [obj]
+    while stack:
+        item = stack.pop()
+        kind = _object_kind(item)
+        if kind == _REFERENCE:
+            yield item
+        elif kind == _DICTIONARY:
+            stack.extend(item.values())
+        elif kind == _ARRAY:
+            stack.extend(item)
+
+def _remap_references(obj, numbers, pdf, visited):
+    """就地将对象中的间接引用按 numbers {旧对象号: 新对象号} 改写
+
+    多个对象可能共用同一个直接字典/数组（如各页浅拷贝的 /Resources 中的 /Font），
+    visited 记录本轮已改写的容器（id），同一轮中每个容器只改写一次，避免重复换号。
+    """
+    stack = [obj]
+    while stack:
+        item = stack.pop()
+        if id(item) in visited:
+            continue
+        visited.add(id(item))
+        kind = _object_kind(item)
+        if kind == _DICTIONARY:
+            entries = list(item.items())
+        elif kind == _ARRAY:
+            entries = list(enumerate(item))
+        else:
+            continue
+        for key, value in entries:
+            value_kind = _object_kind(value)
+            if value_kind == _REFERENCE:
+                if value.idnum in numbers:
+                    item[key] = IndirectObject(numbers[value.idnum], 0, pdf)
+            elif value_kind != _OTHER:
+                stack.append(value)
+
+def _serialize(obj):
+    buffer = io.BytesIO()
+    obj.write_to_stream(buffer, None)
+    return buffer.getvalue()
+
+def _reachable(objects, roots):
+    """从 roots（对象号）出发可达的对象号，按首次到达的顺序"""
+    order = []
+    seen = set()
+    pending = deque(roots)
+    while pending:
+        number = pending.popleft()
+        if number in seen or not 0 < number <= len(objects) or objects[number - 1] is None:
+            continue
+        seen.add(number)
+        order.append(number)
+        pending.extend(ref.idnum for ref in _walk_references(objects[number - 1]))
+    return order
+
+# 紧凑输出中每个对象流最多容纳的对象数
+OBJECT_STREAM_SIZE = 200
+
+# 紧凑输出与增量保存直接读写 PyPDF2 的内部属性（已在 3.0.x 上验证）；
+# 其他版本缺少这些属性时先检查出来并改用普通方式写出，而不是在写出中途出错
+PYPDF2_VERIFIED = "3.0.x"
+_WRITER_INTERNALS = ("_objects", "_root", "_root_object", "_info", "_add_object",
+                     "_sweep_indirect_references")
+_READER_INTERNALS = ("xref", "xref_objStm", "trailer")
+
+def missing_pypdf2_internals(obj, names):
+    """obj 上缺少的 PyPDF2 内部属性（以及流对象的 _data），都存在时为空列表"""
+    missing = [name for name in names if not hasattr(obj, name)]
+    if not hasattr(DecodedStreamObject(), "_data"):
+        missing.append("StreamObject._data")
+    return missing
+
+def _warn_pypdf2_fallback(feature, missing):
+    print(f"警告: PyPDF2 {PYPDF2_VERSION} 缺少 {', '.join(missing)}"
+          f"（已验证版本 {PYPDF2_VERIFIED}），{feature}改为普通方式写出", file=sys.stderr)
+
+def write_compact_pdf(pdf_writer, f):
+    """以紧凑方式写出 PdfWriter 的内容（写出后 pdf_writer 不应再使用）
+
+    1. 未压缩的流（页面内容、表单等）以 Flate 压缩（压缩后更小时）；
+    2. 内容完全相同的对象只保留一份（反复合并，直到引用它们的对象也不再重复），
+       页面、页面树、文档目录与文档信息除外；不可达的对象不写出；
+    3. 对象按可达顺序重新编号，非流对象每 OBJECT_STREAM_SIZE 个打包为一个对象流，
+       最后写交叉引用流（PDF 1.5）。
+    加密的文档，或当前 PyPDF2 版本缺少所需内部属性时，按 PdfWriter 的默认方式写出。
+    """
+    missing = missing_pypdf2_internals(pdf_writer, _WRITER_INTERNALS)
+    if missing:
+        _warn_pypdf2_fallback("紧凑输出", missing)
+    if missing or getattr(pdf_writer, "_encrypt", None) is not None:
+        pdf_writer.write(f)
+        return
+    if not pdf_writer._root:
+        pdf_writer._root = pdf_writer._add_object(pdf_writer._root_object)
+    with TRACE.span("compact.sweep"):
+        pdf_writer._sweep_indirect_references(pdf_writer._root)
+    objects = pdf_writer._objects
+    root_number = pdf_writer._root.idnum
+    info_number = pdf_writer._info.idnum if pdf_writer._info is not None else None
+    roots = [root_number] + ([info_number] if info_number else [])
+    
+    with TRACE.span("compact.streams"):
+        for index, obj in enumerate(objects):
+            if not isinstance(obj, StreamObject) or "/Filter" in obj:
+                continue
+            data = obj.get_data()
+            compressed = zlib.compress(data)
+            if len(compressed) + 20 >= len(data):
+                continue
+            # 另建流对象，不改动可能与读取的文档共用的原对象
+            stream = EncodedStreamObject()
+            stream.update(obj)
+            stream._data = compressed
+            stream[NameObject("/Filter")] = NameObject("/FlateDecode")
+            stream.indirect_reference = obj.indirect_reference
+            objects[index] = stream
+    
+    with TRACE.span("compact.dedupe"):
+        live = _reachable(objects, roots)
+        fixed = set(roots)
+        for number in live:
+            obj = objects[number - 1]
+            if isinstance(obj, DictionaryObject) and obj.get("/Type") in ("/Page", "/Pages"):
+                fixed.add(number)
+        while True:
+            canonical = {}  # {内容摘要: 对象号}
+            duplicates = {}  # {重复对象号: 保留的对象号}
+            for number in live:
+                if number in fixed:
+                    continue
+                digest = hashlib.sha256(_serialize(objects[number - 1])).digest()
+                kept = canonical.setdefault(digest, number)
+                if kept != number:
+                    duplicates[number] = kept
+            if not duplicates:
+                break
+            live = [number for number in live if number not in duplicates]
+            visited = set()
+            for number in live:
+                _remap_references(objects[number - 1], duplicates, pdf_writer, visited)
+    
+    # 按可达顺序重新编号（同时去掉合并后不再被引用的对象）
+    live = _reachable(objects, roots)
+    numbers = {old: new for new, old in enumerate(live, 1)}
+    visited = set()
+    for number in live:
+        _remap_references(objects[number - 1], numbers, pdf_writer, visited)
+    
+    with TRACE.span("compact.write", objects=len(live)):
+        version = pdf_writer.pdf_header[5:].decode("ascii", "replace")
+        f.write(pdf_writer.pdf_header if version >= "1.5" else b"%PDF-1.5")
+        f.write(b"\n%\xE2\xE3\xCF\xD3\n")
+        entries = {0: (0, 0, 65535)}  # {对象号: (类型, 字段2, 字段3)}
+        packed = []  # 放入对象流的 (新对象号, 对象)
+        for old in live:
+            obj = objects[old - 1]
+            new = numbers[old]
+            if isinstance(obj, StreamObject):
+                entries[new] = (1, f.tell(), 0)
+                f.write(f"{new} 0 obj\n".encode())
+                obj.write_to_stream(f, None)
+                f.write(b"\nendobj\n")
+            else:
+                packed.append((new, obj))
         
-        with open(output_path, "wb") as f:
-            pdf_writer.write(f)
+        next_number = len(live) + 1
+        for start in range(0, len(packed), OBJECT_STREAM_SIZE):
+            chunk = packed[start:start + OBJECT_STREAM_SIZE]
+            stream_number = next_number
+            next_number += 1
+            offsets = []
+            body = io.BytesIO()
+            for index, (new, obj) in enumerate(chunk):
+                offsets.append(f"{new} {body.tell()}")
+                obj.write_to_stream(body, None)
+                body.write(b"\n")
+                entries[new] = (2, stream_number, index)
+            header = " ".join(offsets).encode() + b"\n"
+            object_stream = DecodedStreamObject()
+            object_stream._data = zlib.compress(header + body.getvalue())
+            object_stream[NameObject("/Type")] = NameObject("/ObjStm")
+            object_stream[NameObject("/N")] = NumberObject(len(chunk))
+            object_stream[NameObject("/First")] = NumberObject(len(header))
+            object_stream[NameObject("/Filter")] = NameObject("/FlateDecode")
+            entries[stream_number] = (1, f.tell(), 0)
+            f.write(f"{stream_number} 0 obj\n".encode())
+            object_stream.write_to_stream(f, None)
+            f.write(b"\nendobj\n")
+        
+        # 交叉引用流（自身也需要登记）
+        xref_number = next_number
+        xref_offset = f.tell()
+        entries[xref_number] = (1, xref_offset, 0)
+        width = max(1, (max(entry[1] for entry in entries.values()).bit_length() + 7) // 8)
+        rows = b"".join(bytes([kind]) + field.to_bytes(width, "big") + extra.to_bytes(2, "big")
+                        for kind, field, extra in (entries[number]
+                                                   for number in range(xref_number + 1)))
+        xref = DecodedStreamObject()
+        xref._data = zlib.compress(rows)
+        xref[NameObject("/Type")] = NameObject("/XRef")
+        xref[NameObject("/Filter")] = NameObject("/FlateDecode")
+        xref[NameObject("/Size")] = NumberObject(xref_number + 1)
+        xref[NameObject("/W")] = ArrayObject([NumberObject(1), NumberObject(width), NumberObject(2)])
+        xref[NameObject("/Root")] = IndirectObject(numbers[root_number], 0, pdf_writer)
+        if info_number in numbers:
+            xref[NameObject("/Info")] = IndirectObject(numbers[info_number], 0, pdf_writer)
+        if hasattr(pdf_writer, "_ID"):
+            xref[NameObject("/ID")] = pdf_writer._ID
+        f.write(f"{xref_number} 0 obj\n".encode())
+        xref.write_to_stream(f, None)
+        f.write(f"\nendobj\nstartxref\n{xref_offset}\n%%EOF\n".encode())
+
+def describe_size_change(input_size, output_size):
+    """“原文件 1.2 MB → 输出 0.8 MB（-33%）”形式的大小对比"""
+    def megabytes(size):
+        return f"{size / 2**20:.2f} MB" if size >= 2**20 else f"{size / 1024:.0f} KB"
+    change = (output_size - input_size) / input_size * 100 if input_size else 0.0
+    return f"原文件 {megabytes(input_size)} → 输出 {megabytes(output_size)}（{change:+.0f}%）"
+
+def _seal_source(seals, seal_id):
+    """返回 (drawImage 可用的印章图像, 像素宽, 像素高)"""
+    if isinstance(seals, SealLibrary):
+        seal = seals.get(seal_id)
+        if seal is None:
+            raise ValueError(f"未定义的印章: {seal_id}")
+        return seals.export_image(seal_id), seal.width, seal.height
+    if seal_id not in seals:
+        raise ValueError(f"未定义的印章: {seal_id}")
+    source = seals[seal_id]
+    if isinstance(source, Image.Image):
+        return ImageReader(source), source.width, source.height
+    if isinstance(source, ImageReader):
+        return (source, *source.getSize())
+    # 图片路径：只读取文件头获取尺寸，绘制时使用原始图片
+    with Image.open(source) as img:
+        return source, img.width, img.height
+
+def stamp_pdf(pdf, placements, seals, output=None, progress=None, cancel_event=None,
+              encoding=None, workers=None, compact=False):
+    """一次读取、一次写出，为PDF批量盖章（供程序调用，单次可处理成千上万个位置）
+
+    pdf 为PDF路径、bytes、可读的二进制文件对象或已打开的 PdfReader。
+    placements 为可迭代的印章位置，每项为字典 {"page", "x", "y", "size", "seal", "anchor"}
+    或同顺序的元组（后三项可省略）：
+        page    页码（从0开始）
+        x, y    页面坐标（pt，按 /Rotate 旋转后可见区域的左下角为原点，见 PageBox）
+        size    缩放比例，显示尺寸 = 印章原始像素尺寸 × size（默认 1.0）
+        seal    印章ID（默认 None）
+        anchor  x/y 对应印章上的哪一点，见 ANCHORS（默认 "center"）
+    字典也可以用 "text" 代替 page/x/y，盖在该文字出现处（同布局中的按文字定位，见
+    layout_to_placements，可带 "pages"/"occurrence"/"dx"/"dy"），找不到时不盖章；
+    pdf 为路径或 bytes 时文字位置索引按内容哈希缓存（TextIndexCache）。
+    每页按自己的 CropBox/MediaBox 与旋转换算，印章在显示时保持正向。
+    seals 为 SealLibrary（使用处理后的印章）、{seal_id: 图片路径/PIL图像/ImageReader}，
+    或单枚印章（对应 seal 为 None）。
+    output 为 None 时返回输出PDF的 bytes；否则写入路径或文件对象并返回 None。
+    progress/cancel_event/encoding/workers/compact 同 write_stamped_pdf。
+    """
+    if not isinstance(seals, (SealLibrary, dict)):
+        seals = {None: seals}
+    if isinstance(pdf, PdfReader):
+        pdf_reader = pdf
+    else:
+        with TRACE.span("export.read"):
+            pdf_reader = PdfReader(io.BytesIO(pdf) if isinstance(pdf, (bytes, bytearray)) else pdf)
+    total_pages = len(pdf_reader.pages)
+    
+    sources = {}  # {seal_id: (图像, 宽, 高)}
+    boxes = {}  # {页码: PageBox}
+    page_placements = {}
+    text_index = None
+    for item in placements:
+        if isinstance(item, dict):
+            size = item.get("size", 1.0)
+            seal_id = item.get("seal")
+            anchor = item.get("anchor", "center")
+            if "text" in item:
+                if text_index is None:
+                    if isinstance(pdf, (str, bytes, bytearray)):
+                        cache = text_index_cache()
+                        text_index = cache.index(pdf_reader, cache.document_key(pdf))
+                    else:
+                        text_index = TextIndex(pdf_reader)
+                positions = resolve_anchor_text(
+                    text_index, item["text"],
+                    parse_page_spec(item.get("pages", "all"), total_pages),
+                    item.get("occurrence", "all"),
+                    (float(item.get("dx", 0)), float(item.get("dy", 0))))
+            else:
+                positions = [(item["page"], item["x"], item["y"])]
+        else:
+            positions = [tuple(item[:3])]
+            size = item[3] if len(item) > 3 else 1.0
+            seal_id = item[4] if len(item) > 4 else None
+            anchor = item[5] if len(item) > 5 else "center"
+        if seal_id not in sources:
+            sources[seal_id] = _seal_source(seals, seal_id)
+        _, stamp_width, stamp_height = sources[seal_id]
+        for page_num, x, y in positions:
+            if not 0 <= page_num < total_pages:
+                raise ValueError(f"页码超出范围: {page_num}（共 {total_pages} 页，从0开始）")
+            if page_num not in boxes:
+                boxes[page_num] = PageBox(pdf_reader.pages[page_num])
+            page_placements.setdefault(page_num, []).append(boxes[page_num].placement(
+                float(x), float(y), stamp_width * float(size), stamp_height * float(size),
+                seal_id, anchor))
+    if text_index is not None:
+        text_index_cache().save(text_index)
+    
+    stamp_images = {seal_id: source[0] for seal_id, source in sources.items()}
+    target = io.BytesIO() if output is None else output
+    write_stamped_pdf(pdf_reader, page_placements, stamp_images, target,
+                      progress=progress, cancel_event=cancel_event, encoding=encoding,
+                      workers=workers, compact=compact)
+    return target.getvalue() if output is None else None
+
+def add_stamp_to_pdf(pdf_path, stamp_path, output_path, position=(0, 0), size=1.0,
+                     anchor_text=None, compact=False):
+    """将印章图片添加到PDF每一页的同一位置（保持原始像素，仅按比例调整显示尺寸）
+
+    position 为印章中心的页面坐标（见 stamp_pdf），各页按自身尺寸与旋转换算。
+    指定 anchor_text 时改为盖在该文字的每处出现位置，position 为相对文字中心的
+    偏移；找不到该文字时报错。compact 为 True 时紧凑输出（见 write_compact_pdf）
+    并打印输入与输出的大小。
+    """
+    try:
+        with TRACE.span("add_stamp_to_pdf", pdf=os.path.basename(pdf_path)):
+            with TRACE.span("export.read"):
+                pdf_reader = PdfReader(pdf_path)
+            if anchor_text is None:
+                placements = [(page_num, position[0], position[1], size)
+                              for page_num in range(len(pdf_reader.pages))]
+            else:
+                cache = text_index_cache()
+                text_index = cache.index(pdf_reader, cache.document_key(pdf_path))
+                placements = [(page_num, x, y, size) for page_num, x, y in resolve_anchor_text(
+                    text_index, anchor_text, range(len(pdf_reader.pages)), offset=position)]
+                cache.save(text_index)
+                if not placements:
+                    raise ValueError(f"未找到定位文字: {anchor_text}")
+            stamp_pdf(pdf_reader, placements, stamp_path, output_path, compact=compact)
+        if compact:
+            print(describe_size_change(os.path.getsize(pdf_path), os.path.getsize(output_path)))
         
         return True
         
@@ -66,13 +1543,640 @@ def add_stamp_to_pdf(pdf_path, stamp_path, output_path, position=(0, 0), size=1.
             except:
                 pass
         raise e
-    finally:
-        # 清理临时文件
+
+def render_page_region(pdf_path, page_num, dpi, x, y, width, height):
+    """只渲染页面的一块区域，返回 PIL 图像
+
+    x、y、width、height 为按 dpi 渲染后可见区域（CropBox，已按 /Rotate 旋转）中的
+    像素坐标，超出页面的部分由 pdftoppm 截掉。pdf2image 不提供裁剪参数，
+    这里直接调用 pdftoppm 的 -x/-y/-W/-H，poppler 只光栅化这一块区域。
+    """
+    page = str(page_num + 1)
+    command = ["pdftoppm", "-f", page, "-l", page, "-r", f"{dpi:.2f}", "-cropbox",
+               "-x", str(int(x)), "-y", str(int(y)), "-W", str(int(width)), "-H", str(int(height)),
+               pdf_path]
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0))
+    if result.returncode != 0 or not result.stdout:
+        raise RuntimeError(f"pdftoppm 渲染失败: {result.stderr.decode(errors='replace').strip()}")
+    img = Image.open(io.BytesIO(result.stdout))
+    img.load()
+    return img
+
+class RenderCache:
+    """磁盘上的渲染缓存：按（PDF内容哈希, 名称）保存渲染好的页面和缩略图
+
+    同一份PDF（内容相同，与路径无关）再次打开时直接读取 PNG，不再调用 poppler。
+    总大小超过 max_bytes 时按最近使用时间（文件 mtime，命中时更新）淘汰最旧的
+    文件，直到低于上限的 90%。读写失败一律当作未命中，不影响渲染。
+    """
+    def __init__(self, directory, max_bytes=512 * 2**20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._index = None  # {文件名: [字节数, 最近使用时间]}，首次使用时扫描目录
+        self._total = 0
+        self._digests = {}  # {(路径, 大小, 修改时间): 内容哈希}
+    
+    @classmethod
+    def default(cls):
+        """按环境变量创建：STMP_RENDER_CACHE 为目录（0/off 禁用），STMP_RENDER_CACHE_MB 为上限"""
+        directory = os.environ.get("STMP_RENDER_CACHE")
+        if directory and directory.lower() in ("0", "off", "no", "false"):
+            return None
+        if not directory:
+            base = os.environ.get("LOCALAPPDATA") or os.path.join(os.path.expanduser("~"), ".cache")
+            directory = os.path.join(base, "stmp", "renders")
+        max_mb = float(os.environ.get("STMP_RENDER_CACHE_MB", 512))
+        return cls(directory, int(max_mb * 2**20))
+    
+    def document_key(self, pdf_path):
+        """PDF内容哈希（按路径、大小和修改时间记住，同一文件只计算一次）"""
+        stat = os.stat(pdf_path)
+        key = (os.path.abspath(pdf_path), stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            digest = self._digests.get(key)
+        if digest is None:
+            with TRACE.span("render_cache.digest", bytes=stat.st_size):
+                digest = file_digest(pdf_path)
+            with self._lock:
+                self._digests[key] = digest
+        return digest
+    
+    def _load_index(self):
+        """扫描缓存目录（需持有锁）"""
+        if self._index is not None:
+            return
+        self._index = {}
+        self._total = 0
         try:
-            if temp_pdf_path and os.path.exists(temp_pdf_path):
-                os.remove(temp_pdf_path)
-        except Exception as e:
-            print(f"清理临时文件时出错: {str(e)}")
+            entries = list(os.scandir(self.directory))
+        except OSError:
+            entries = []
+        for entry in entries:
+            if entry.name.endswith(".png") and entry.is_file():
+                stat = entry.stat()
+                self._index[entry.name] = [stat.st_size, stat.st_mtime]
+                self._total += stat.st_size
+    
+    def _filename(self, document_key, name):
+        return f"{document_key}-{name}.png"
+    
+    def get(self, document_key, name):
+        """返回缓存的图像，未命中返回 None"""
+        filename = self._filename(document_key, name)
+        path = os.path.join(self.directory, filename)
+        with self._lock:
+            self._load_index()
+            entry = self._index.get(filename)
+            if entry is None:
+                return None
+            entry[1] = time.time()
+        try:
+            with TRACE.span("render_cache.read"):
+                img = Image.open(path)
+                img.load()
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                entry = self._index.pop(filename, None)
+                if entry is not None:
+                    self._total -= entry[0]
+            return None
+        return img
+    
+    def put(self, document_key, name, img):
+        """保存图像（先写临时文件再替换，避免留下不完整的文件）"""
+        filename = self._filename(document_key, name)
+        path = os.path.join(self.directory, filename)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".part")
+            try:
+                with TRACE.span("render_cache.write"):
+                    with os.fdopen(fd, 'wb') as f:
+                        img.save(f, format="PNG", compress_level=1)
+                os.replace(tmp_path, path)
+            except BaseException:
+                # 写入失败（磁盘已满、图像无法编码等）时不在缓存目录中留下临时文件
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+                raise
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        with self._lock:
+            self._load_index()
+            old = self._index.get(filename)
+            if old is not None:
+                self._total -= old[0]
+            self._index[filename] = [size, time.time()]
+            self._total += size
+            if self._total > self.max_bytes:
+                self._evict(int(self.max_bytes * 0.9))
+    
+    def _evict(self, target):
+        """按最近使用时间淘汰，直到总大小不超过 target（需持有锁）"""
+        for filename, (size, _) in sorted(self._index.items(), key=lambda item: item[1][1]):
+            if self._total <= target:
+                break
+            try:
+                os.remove(os.path.join(self.directory, filename))
+            except FileNotFoundError:
+                pass
+            except OSError:
+                continue
+            del self._index[filename]
+            self._total -= size
+
+class PageRenderer:
+    """按需渲染PDF页面：LRU缓存已渲染页面，并在后台预取相邻页面
+
+    页数直接从PDF读取，不渲染任何页面；每页只在需要时用 first_page/last_page
+    单独渲染。渲染范围为可见区域（CropBox）并按 /Rotate 旋转，与阅读器显示一致
+    （见 PageBox）。缓存中的图像供多处共用，调用方不得就地修改。
+
+    放大预览时不按高 dpi 渲染整页，而是按 tile_size 见方的图块渲染可见区域
+    （render_page_region），图块另有一个 LRU 缓存。
+    
+    指定 disk_cache（RenderCache）时，渲染结果同时保存到磁盘，再次打开同一
+    PDF时直接从磁盘读取。
+    """
+    def __init__(self, pdf_path, dpi=72, cache_size=8, tile_size=512, tile_cache_size=48,
+                 disk_cache=None):
+        self.pdf_path = pdf_path
+        self.dpi = dpi
+        self.cache_size = cache_size
+        self.tile_size = tile_size
+        self.tile_cache_size = tile_cache_size
+        self.disk_cache = disk_cache
+        self.document_key = disk_cache.document_key(pdf_path) if disk_cache else None
+        with TRACE.span("pdf.page_count"):
+            self.page_count = len(PdfReader(pdf_path).pages)
+        self._cache = OrderedDict()  # {页码: PIL图像}
+        self._inflight = {}  # {页码: Future} 正在后台渲染的页面
+        self._tiles = OrderedDict()  # {(页码, dpi, 列, 行): PIL图像}
+        self._tile_inflight = {}  # {(页码, dpi, 列, 行): Future}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+    
+    def _render(self, page_num):
+        name = f"page{page_num}-{self.dpi}dpi"
+        try:
+            img = self.disk_cache.get(self.document_key, name) if self.disk_cache else None
+            if img is None:
+                with TRACE.span("pdf.render_page", page=page_num, dpi=self.dpi):
+                    img = convert_from_path(self.pdf_path, dpi=self.dpi, use_cropbox=True,
+                                            first_page=page_num + 1, last_page=page_num + 1)[0]
+                if self.disk_cache:
+                    self.disk_cache.put(self.document_key, name, img)
+        except Exception:
+            with self._lock:
+                self._inflight.pop(page_num, None)
+            raise
+        with self._lock:
+            self._cache[page_num] = img
+            self._cache.move_to_end(page_num)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            self._inflight.pop(page_num, None)
+        return img
+    
+    def get(self, page_num):
+        """返回指定页面图像（命中缓存或等待后台渲染，否则立即渲染）"""
+        with self._lock:
+            if page_num in self._cache:
+                self._cache.move_to_end(page_num)
+                return self._cache[page_num]
+            future = self._inflight.get(page_num)
+        if future is not None:
+            return future.result()
+        return self._render(page_num)
+    
+    def prefetch(self, page_nums):
+        """在后台渲染尚未缓存的页面"""
+        with self._lock:
+            for page_num in page_nums:
+                if (0 <= page_num < self.page_count and page_num not in self._cache
+                        and page_num not in self._inflight):
+                    self._inflight[page_num] = self._executor.submit(self._render, page_num)
+    
+    def _render_tile(self, key):
+        page_num, dpi, col, row = key
+        size = self.tile_size
+        try:
+            with TRACE.span("pdf.render_tile", page=page_num, dpi=dpi):
+                img = render_page_region(self.pdf_path, page_num, dpi,
+                                         col * size, row * size, size, size)
+        except Exception:
+            with self._lock:
+                self._tile_inflight.pop(key, None)
+            raise
+        with self._lock:
+            self._tiles[key] = img
+            self._tiles.move_to_end(key)
+            while len(self._tiles) > self.tile_cache_size:
+                self._tiles.popitem(last=False)
+            self._tile_inflight.pop(key, None)
+        return img
+    
+    def tile(self, page_num, dpi, col, row):
+        """返回按 dpi 渲染的页面中第 (col, row) 个图块的 Future（已缓存时为已完成的 Future）
+
+        不再需要的图块可以直接 cancel()，尚未开始的渲染会被跳过。
+        """
+        key = (page_num, dpi, col, row)
+        with self._lock:
+            img = self._tiles.get(key)
+            if img is not None:
+                self._tiles.move_to_end(key)
+                future = Future()
+                future.set_result(img)
+                return future
+            future = self._tile_inflight.get(key)
+            if future is None or future.cancelled():
+                future = self._executor.submit(self._render_tile, key)
+                self._tile_inflight[key] = future
+            return future
+    
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+class ThumbnailRenderer:
+    """后台线程生成低分辨率缩略图，可见页面优先
+
+    request() 给出当前可见的页码范围，工作线程先渲染这些页面，再按与可见范围
+    的距离向两侧扩展（最多 cache_size 页，避免长文档反复淘汰）。每次调用
+    pdftoppm 渲染一段连续的未缓存页面（最多 batch 页），处理完的页码放入 ready
+    队列，由界面线程轮询取用；缩略图只在这里保存 PIL 图像，不创建 PhotoImage。
+    指定 disk_cache（RenderCache）时先从磁盘读取，只渲染磁盘上没有的页面。
+    """
+    def __init__(self, pdf_path, page_count, width=96, batch=8, cache_size=1000,
+                 disk_cache=None):
+        self.pdf_path = pdf_path
+        self.page_count = page_count
+        self.width = width
+        self.batch = batch
+        self.cache_size = cache_size
+        self.disk_cache = disk_cache
+        self.document_key = disk_cache.document_key(pdf_path) if disk_cache else None
+        self.ready = queue.Queue()  # 已处理完的页码（渲染失败的页面 get() 返回 None）
+        self._cache = OrderedDict()  # {页码: PIL图像}
+        self._failed = set()  # 渲染失败的页码，不再重试
+        self._order = deque()  # 待生成页码（按优先顺序）
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+    
+    def get(self, page_num):
+        """返回已生成的缩略图，尚未生成时返回 None"""
+        with self._cond:
+            img = self._cache.get(page_num)
+            if img is not None:
+                self._cache.move_to_end(page_num)
+            return img
+    
+    def request(self, first, last):
+        """设置可见范围 [first, last]，重新排列生成顺序"""
+        first = max(0, first)
+        last = min(self.page_count - 1, last)
+        order = list(range(first, last + 1))
+        below = iter(range(last + 1, self.page_count))
+        above = iter(range(first - 1, -1, -1))
+        while len(order) < self.cache_size:
+            added = [page for page in (next(below, None), next(above, None)) if page is not None]
+            if not added:
+                break
+            order.extend(added)
+        with self._cond:
+            self._order = deque(order[:self.cache_size])
+            self._cond.notify()
+    
+    def _missing(self, page_num):
+        return (0 <= page_num < self.page_count and page_num not in self._cache
+                and page_num not in self._failed)
+    
+    def _next_chunk(self):
+        """取下一段连续的未生成页面 (first, last)，没有则返回 None（需持有锁）"""
+        while self._order:
+            page_num = self._order.popleft()
+            if not self._missing(page_num):
+                continue
+            first = last = page_num
+            while last - first + 1 < self.batch and self._missing(last + 1):
+                last += 1
+            while last - first + 1 < self.batch and self._missing(first - 1):
+                first -= 1
+            return first, last
+        return None
+    
+    def _run(self):
+        while True:
+            with self._cond:
+                chunk = self._next_chunk()
+                while chunk is None and not self._closed:
+                    self._cond.wait()
+                    chunk = self._next_chunk()
+                if self._closed:
+                    return
+            first, last = chunk
+            images = {}
+            if self.disk_cache:
+                for page_num in range(first, last + 1):
+                    img = self.disk_cache.get(self.document_key, self._cache_name(page_num))
+                    if img is not None:
+                        images[page_num] = img
+            missing = [page_num for page_num in range(first, last + 1) if page_num not in images]
+            if missing:
+                try:
+                    with TRACE.span("pdf.render_thumbnails", first=missing[0], last=missing[-1]):
+                        rendered = convert_from_path(self.pdf_path, size=(self.width, None),
+                                                     use_cropbox=True, first_page=missing[0] + 1,
+                                                     last_page=missing[-1] + 1)
+                except Exception:
+                    rendered = []
+                for page_num, img in zip(range(missing[0], missing[-1] + 1), rendered):
+                    if page_num not in images and self.disk_cache:
+                        self.disk_cache.put(self.document_key, self._cache_name(page_num), img)
+                    images[page_num] = img
+            with self._cond:
+                for page_num in range(first, last + 1):
+                    if page_num in images:
+                        self._cache[page_num] = images[page_num]
+                        self._cache.move_to_end(page_num)
+                    else:
+                        self._failed.add(page_num)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+            for page_num in range(first, last + 1):
+                self.ready.put(page_num)
+    
+    def _cache_name(self, page_num):
+        return f"thumb{page_num}-{self.width}w"
+    
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+
+class StampPlacement:
+    """单个印章位置（预览坐标，x/y 为印章中心，width/height 为预览显示尺寸，
+    seal_id 为印章库中的印章）
+
+    pages 不为 None 时为页码规则（见 parse_page_spec），同一位置作用于规则
+    覆盖的所有页面，此时 page 为 None。
+    """
+    __slots__ = ('id', 'page', 'x', 'y', 'size', 'width', 'height', 'seal_id', 'pages')
+    
+    def __init__(self, stamp_id, page, x, y, size, width, height, seal_id=None, pages=None):
+        self.id = stamp_id
+        self.page = page
+        self.pages = pages
+        self.x = x
+        self.y = y
+        self.size = size
+        self.width = width
+        self.height = height
+        self.seal_id = seal_id
+    
+    @property
+    def position(self):
+        return (self.x, self.y)
+    
+    @property
+    def is_rule(self):
+        return self.pages is not None
+    
+    def contains(self, x, y):
+        return abs(x - self.x) <= self.width // 2 and abs(y - self.y) <= self.height // 2
+
+class StampLayout:
+    """印章布局：稳定的印章ID、按ID O(1) 查找、每页网格索引用于点击测试
+
+    ID 单调递增且删除后不复用，同时表示叠放顺序（ID 越大越靠上）。
+    页码规则（"all"、"odd"、"3-200" 等）只保存一条记录，按页展开时才计算，
+    总是绘制在该页单独添加的印章之下；展开需要文档页数，见 set_page_count。
+    """
+    def __init__(self, cell_size=64):
+        self.cell_size = cell_size
+        self.page_count = 0
+        self._next_id = 0
+        self._by_id = {}  # {印章ID: StampPlacement}（单页印章）
+        self._pages = {}  # {页码: {印章ID: StampPlacement}}（按添加顺序）
+        self._grids = {}  # {页码: {(列, 行): {印章ID, ...}}}
+        self._rules = {}  # {印章ID: StampPlacement}（页码规则，按添加顺序）
+        self._rule_pages = {}  # {印章ID: 规则覆盖的页码集合}（按当前页数展开的缓存）
+    
+    def __len__(self):
+        return len(self._by_id) + len(self._rules)
+    
+    def __bool__(self):
+        return bool(self._by_id) or bool(self._rules)
+    
+    def __contains__(self, stamp_id):
+        return stamp_id in self._by_id or stamp_id in self._rules
+    
+    def __iter__(self):
+        return iter(list(self._rules.values()) + list(self._by_id.values()))
+    
+    def set_page_count(self, page_count):
+        """设置文档页数（页码规则按此展开）"""
+        if page_count != self.page_count:
+            self.page_count = page_count
+            self._rule_pages.clear()
+    
+    def rule_pages(self, rule_id):
+        """页码规则覆盖的页码集合（从0开始）"""
+        pages = self._rule_pages.get(rule_id)
+        if pages is None:
+            rule = self._rules[rule_id]
+            pages = self._rule_pages[rule_id] = frozenset(
+                parse_page_spec(rule.pages, self.page_count))
+        return pages
+    
+    def page_rules(self, page):
+        """作用于某页的页码规则（由下到上）"""
+        return [rule for rule in self._rules.values() if page in self.rule_pages(rule.id)]
+    
+    def _cells(self, stamp):
+        cell = self.cell_size
+        half_width = stamp.width // 2
+        half_height = stamp.height // 2
+        x0 = int((stamp.x - half_width) // cell)
+        x1 = int((stamp.x + half_width) // cell)
+        y0 = int((stamp.y - half_height) // cell)
+        y1 = int((stamp.y + half_height) // cell)
+        return [(cx, cy) for cx in range(x0, x1 + 1) for cy in range(y0, y1 + 1)]
+    
+    def _index(self, stamp):
+        grid = self._grids.setdefault(stamp.page, {})
+        for key in self._cells(stamp):
+            grid.setdefault(key, set()).add(stamp.id)
+    
+    def _unindex(self, stamp):
+        grid = self._grids.get(stamp.page, {})
+        for key in self._cells(stamp):
+            ids = grid.get(key)
+            if ids is not None:
+                ids.discard(stamp.id)
+                if not ids:
+                    del grid[key]
+    
+    def add(self, page, x, y, size, width, height, seal_id=None):
+        """添加印章，返回新的 StampPlacement"""
+        stamp = StampPlacement(self._next_id, page, x, y, size, width, height, seal_id)
+        self._next_id += 1
+        self._by_id[stamp.id] = stamp
+        self._pages.setdefault(page, {})[stamp.id] = stamp
+        self._index(stamp)
+        return stamp
+    
+    def add_many(self, items):
+        """批量添加 [(page, x, y, size, width, height[, seal_id]), ...]，返回新印章列表"""
+        return [self.add(*item) for item in items]
+    
+    def add_rule(self, pages, x, y, size, width, height, seal_id=None):
+        """添加页码规则印章，返回新的 StampPlacement（页码规格无效时抛出 ValueError）"""
+        parse_page_spec(pages, 1)
+        rule = StampPlacement(self._next_id, None, x, y, size, width, height, seal_id, pages)
+        self._next_id += 1
+        self._rules[rule.id] = rule
+        return rule
+    
+    def set_rule_pages(self, stamp_id, pages):
+        """将印章改为作用于 pages 的页码规则（单页印章会转为规则，ID 不变）"""
+        parse_page_spec(pages, 1)
+        stamp = self._rules.get(stamp_id)
+        if stamp is None:
+            stamp = self.remove(stamp_id)
+            if stamp is None:
+                raise KeyError(stamp_id)
+            stamp.page = None
+        stamp.pages = pages
+        self._rules[stamp_id] = stamp
+        self._rules = dict(sorted(self._rules.items()))
+        self._rule_pages.pop(stamp_id, None)
+        return stamp
+    
+    def get(self, stamp_id):
+        stamp = self._by_id.get(stamp_id)
+        return stamp if stamp is not None else self._rules.get(stamp_id)
+    
+    def remove(self, stamp_id):
+        rule = self._rules.pop(stamp_id, None)
+        if rule is not None:
+            self._rule_pages.pop(stamp_id, None)
+            return rule
+        stamp = self._by_id.pop(stamp_id, None)
+        if stamp is None:
+            return None
+        self._unindex(stamp)
+        page_stamps = self._pages[stamp.page]
+        del page_stamps[stamp_id]
+        if not page_stamps:
+            del self._pages[stamp.page]
+            self._grids.pop(stamp.page, None)
+        return stamp
+    
+    def remove_many(self, stamp_ids):
+        for stamp_id in list(stamp_ids):
+            self.remove(stamp_id)
+    
+    def clear_page(self, page):
+        for stamp in self._pages.pop(page, {}).values():
+            del self._by_id[stamp.id]
+        self._grids.pop(page, None)
+    
+    def clear(self):
+        self._by_id.clear()
+        self._pages.clear()
+        self._grids.clear()
+        self._rules.clear()
+        self._rule_pages.clear()
+    
+    def remove_seal(self, seal_id):
+        """删除引用某枚印章的所有位置（含页码规则），返回删除数量"""
+        stamp_ids = [stamp.id for stamp in self if stamp.seal_id == seal_id]
+        self.remove_many(stamp_ids)
+        return len(stamp_ids)
+    
+    def move(self, stamp_id, x, y):
+        stamp = self._rules.get(stamp_id)
+        if stamp is not None:
+            stamp.x, stamp.y = x, y
+            return stamp
+        stamp = self._by_id[stamp_id]
+        self._unindex(stamp)
+        stamp.x, stamp.y = x, y
+        self._index(stamp)
+        return stamp
+    
+    def resize(self, stamp_id, size, width, height):
+        stamp = self._rules.get(stamp_id)
+        if stamp is not None:
+            stamp.size, stamp.width, stamp.height = size, width, height
+            return stamp
+        stamp = self._by_id[stamp_id]
+        self._unindex(stamp)
+        stamp.size, stamp.width, stamp.height = size, width, height
+        self._index(stamp)
+        return stamp
+    
+    def page_stamps(self, page):
+        """返回某页的印章（由下到上：先页码规则，后单页印章）"""
+        return self.page_rules(page) + list(self._pages.get(page, {}).values())
+    
+    def has_page(self, page):
+        """某页是否有单独添加的印章（不含页码规则）"""
+        return page in self._pages
+    
+    def pages(self):
+        return sorted(self._pages)
+    
+    def hit_test(self, page, x, y):
+        """返回点 (x, y) 处最上层的印章，没有则返回 None"""
+        grid = self._grids.get(page)
+        if grid:
+            key = (int(x // self.cell_size), int(y // self.cell_size))
+            for stamp_id in sorted(grid.get(key, ()), reverse=True):
+                stamp = self._by_id[stamp_id]
+                if stamp.contains(x, y):
+                    return stamp
+        for rule in reversed(self.page_rules(page)):
+            if rule.contains(x, y):
+                return rule
+        return None
+    
+    def snapshot(self):
+        """返回 {页码: [(x, y, size, seal_id), ...]}，供导出线程使用的只读副本（不含页码规则）"""
+        return {page: [(stamp.x, stamp.y, stamp.size, stamp.seal_id) for stamp in stamps.values()]
+                for page, stamps in self._pages.items()}
+    
+    def rule_snapshot(self):
+        """返回页码规则 [(pages, x, y, size, seal_id), ...]（由下到上），导出时再按页展开"""
+        return [(rule.pages, rule.x, rule.y, rule.size, rule.seal_id)
+                for rule in self._rules.values()]
+    
+    def layout_items(self, preview_size):
+        """导出为布局文件的 placements（页面比例坐标 rx/ry，见 layout_to_placements）
+
+        页码规则在前、单页印章按页在后，展开后与 compute_page_placements 的叠放顺序一致；
+        预览坐标只在这里按预览尺寸换算一次，之后与预览无关。
+        """
+        preview_width, preview_height = preview_size
+        
+        def item(pages, stamp):
+            return {"pages": pages, "rx": stamp.x / preview_width,
+                    "ry": 1 - stamp.y / preview_height, "size": stamp.size,
+                    "seal": stamp.seal_id}
+        
+        items = [item(rule.pages, rule) for rule in self._rules.values()]
+        for page in sorted(self._pages):
+            items.extend(item(page + 1, stamp) for stamp in self._pages[page].values())
+        return items
 
 class StampApp:
     def __init__(self, root):
@@ -85,27 +2189,68 @@ class StampApp:
         
         # 初始化变量
         self.pdf_path = ""
-        self.stamp_path = ""
         self.output_path = ""
-        self.stamp_img = None  # 预览用缩放图像
-        self.original_stamp_img = None  # 原始印章图像（保留像素）
-        self.original_stamp_width = 0  # 原始印章宽度
-        self.original_stamp_height = 0  # 原始印章高度
+        self.seals = SealLibrary()  # 印章库（原始图像 + 处理结果缓存，预览与导出共用）
+        self.current_seal_id = None  # 新添加印章使用的印章
         self.default_scale = 0.2  # 默认缩放比例
+        self.stamp_photo_cache = OrderedDict()  # 预览印章图缓存 {(印章, 宽, 高): PhotoImage}
+        self.stamp_photo_cache_size = 32
+        self.stamp_photos = []  # 当前画布上显示的印章图
+        self.stamp_items = {}  # 当前页画布项 {印章ID: 画布项}
+        self.selection_rect = None  # 选中框画布项
         self.dragging = False
         
         # 多页PDF相关变量
-        self.pdf_pages = []  # 存储所有页面的图片
+        self.page_renderer = None  # 按需渲染页面（LRU缓存 + 相邻页预取）
+        self.page_cache_size = 8  # 预览页面缓存数量
+        self.render_cache = RenderCache.default()  # 磁盘渲染缓存（再次打开同一PDF时不调用 poppler）
+        self.text_indexes = TextIndexCache.default()  # 文字位置索引（按文字定位，按内容哈希缓存）
         self.current_page = 0  # 当前显示的页面索引
         self.total_pages = 0  # 总页数
-        self.page_stamps = {}  # 存储每页的印章信息 {page_num: [(position, size), ...]}
+        self.layout = StampLayout()  # 所有页面的印章布局（稳定ID + 点击测试索引）
         self.selected_stamp_id = None  # 当前选中的印章ID
+        self.stamp_list_ids = []  # 印章列表各行对应的印章ID
         
         # 预览相关变量
         self.pdf_photo = None
         self.preview_height = 0
         self.preview_width = 0
         
+        # 缩放相关变量：布局坐标始终是 100% 预览坐标，画布坐标 = 布局坐标 × zoom；
+        # 放大时只渲染可见区域的高分辨率图块
+        self.zoom_levels = (1.0, 1.5, 2.0, 3.0, 4.0)
+        self.zoom = 1.0
+        self.preview_scale = 1.0  # 100% 预览相对 72dpi 渲染图的缩放比例
+        self.page_image = None  # 当前页 72dpi 渲染图（图块渲染完成前放大显示作占位）
+        self.placeholder_photo = None
+        self.tile_items = {}  # 画布上的图块 {(页码, dpi, 列, 行): (画布项, PhotoImage)}
+        self.tile_futures = {}  # 等待中的图块 {(页码, dpi, 列, 行): Future}
+        self.tile_update_id = None
+        self.tile_poll_id = None
+        
+        # 缩略图导航：只为可见的缩略图创建 PhotoImage
+        self.thumb_renderer = None  # 后台生成缩略图
+        self.thumb_width = 96
+        self.thumb_slot_height = 160  # 每页占用的高度（缩略图 + 页码）
+        self.thumb_items = {}  # 可见缩略图 {页码: [边框项, 图像项, PhotoImage]}
+        self.thumb_poll_id = None
+        
+        # 导出相关变量（导出在工作线程中进行）
+        self.export_thread = None
+        self.export_queue = None
+        self.export_cancel = None
+        self.incremental_save = tk.BooleanVar(value=False)
+        self.compact_output = tk.BooleanVar(value=False)
+        # 导出印章图像的编码方式（默认嵌入原始像素）
+        self.seal_encodings = {
+            "原始像素": None,
+            "300dpi 无损": SealEncoding(dpi=300),
+            "300dpi JPEG": SealEncoding(dpi=300, format="jpeg"),
+            "150dpi JPEG": SealEncoding(dpi=150, format="jpeg"),
+            "矢量路径": SealEncoding(format="vector"),
+        }
+        self.seal_encoding = tk.StringVar(value="原始像素")
+        
         # 创建UI
         self.create_widgets()
     
@@ -134,6 +2279,15 @@ class StampApp:
         ttk.Button(btn_frame, text="选择PDF文件", command=self.select_pdf).pack(side=tk.LEFT, padx=5)
         ttk.Button(btn_frame, text="选择印章图片", command=self.select_stamp).pack(side=tk.LEFT, padx=5)
         ttk.Button(btn_frame, text="保存盖章PDF", command=self.save_pdf).pack(side=tk.LEFT, padx=5)
+        ttk.Button(btn_frame, text="保存布局", command=self.save_layout_file).pack(side=tk.LEFT, padx=5)
+        ttk.Button(btn_frame, text="加载布局", command=self.load_layout_file).pack(side=tk.LEFT, padx=5)
+        ttk.Checkbutton(btn_frame, text="增量保存（原文件内容不变，只追加印章）",
+                        variable=self.incremental_save).pack(side=tk.LEFT, padx=5)
+        ttk.Checkbutton(btn_frame, text="紧凑输出（去重、压缩、对象流）",
+                        variable=self.compact_output).pack(side=tk.LEFT, padx=5)
+        ttk.Label(btn_frame, text="印章图像:").pack(side=tk.LEFT)
+        ttk.Combobox(btn_frame, textvariable=self.seal_encoding, width=11, state="readonly",
+                     values=list(self.seal_encodings)).pack(side=tk.LEFT, padx=5)
         
         # 页面导航控制
         nav_frame = ttk.Frame(control_frame)
@@ -145,10 +2299,22 @@ class StampApp:
         self.page_label = ttk.Label(nav_frame, text="页面: 0/0")
         self.page_label.pack(side=tk.LEFT, padx=10)
         
+        ttk.Button(nav_frame, text="缩小", command=self.zoom_out).pack(side=tk.LEFT, padx=5)
+        self.zoom_label = ttk.Label(nav_frame, text="100%", width=5)
+        self.zoom_label.pack(side=tk.LEFT)
+        ttk.Button(nav_frame, text="放大", command=self.zoom_in).pack(side=tk.LEFT, padx=5)
+        ttk.Button(nav_frame, text="适应页面", command=lambda: self.set_zoom(1.0)).pack(side=tk.LEFT, padx=5)
+        
         # 印章控制区域
         stamp_frame = ttk.Frame(control_frame)
         stamp_frame.pack(fill=tk.X, pady=5)
         
+        ttk.Label(stamp_frame, text="印章:").pack(side=tk.LEFT)
+        self.seal_combo = ttk.Combobox(stamp_frame, width=10, state="readonly")
+        self.seal_combo.pack(side=tk.LEFT, padx=5)
+        self.seal_combo.bind("<<ComboboxSelected>>", self.on_seal_select)
+        ttk.Button(stamp_frame, text="移除印章", command=self.remove_current_seal).pack(side=tk.LEFT, padx=5)
+        
         ttk.Label(stamp_frame, text="印章大小(0.01-1.0):").pack(side=tk.LEFT)
         self.size_entry = ttk.Entry(stamp_frame, width=5)
         self.size_entry.insert(0, str(self.default_scale))
@@ -162,15 +2328,58 @@ class StampApp:
         ttk.Button(stamp_frame, text="删除选中印章", command=self.delete_selected_stamp).pack(side=tk.LEFT, padx=5)
         ttk.Button(stamp_frame, text="清空当前页印章", command=self.clear_current_page_stamps).pack(side=tk.LEFT, padx=5)
         
+        # 页码规则：选中的印章按规则作用于多页（如 all、odd、even、last、3-200、every 2）
+        ttk.Label(stamp_frame, text="页码规则:").pack(side=tk.LEFT)
+        self.rule_entry = ttk.Entry(stamp_frame, width=10)
+        self.rule_entry.insert(0, "all")
+        self.rule_entry.pack(side=tk.LEFT, padx=5)
+        ttk.Button(stamp_frame, text="应用到页码", command=self.apply_page_rule).pack(side=tk.LEFT, padx=5)
+        
+        # 按文字定位：在所有页面中该文字出现处添加印章（如“盖章处”“甲方（盖章）”）
+        anchor_frame = ttk.Frame(control_frame)
+        anchor_frame.pack(fill=tk.X, pady=5)
+        
+        ttk.Label(anchor_frame, text="定位文字:").pack(side=tk.LEFT)
+        self.anchor_entry = ttk.Entry(anchor_frame, width=20)
+        self.anchor_entry.pack(side=tk.LEFT, padx=5)
+        self.anchor_entry.bind('<Return>', lambda event: self.add_stamps_at_text())
+        ttk.Button(anchor_frame, text="按文字添加印章", command=self.add_stamps_at_text).pack(side=tk.LEFT, padx=5)
+        
         # 左侧预览画布 + 右侧印章列表（布局与原逻辑一致）
         content_frame = ttk.Frame(main_frame)
         content_frame.pack(fill=tk.BOTH, expand=True, pady=10)
         
+        # 左侧缩略图导航（虚拟化：只绘制可见页面）
+        thumb_frame = ttk.Frame(content_frame)
+        thumb_frame.pack(side=tk.LEFT, fill=tk.Y, padx=(0, 10))
+        self.thumb_canvas = tk.Canvas(thumb_frame, width=self.thumb_width + 16, bg='#e0e0e0',
+                                      highlightthickness=0)
+        thumb_scroll = ttk.Scrollbar(thumb_frame, orient=tk.VERTICAL, command=self.on_thumb_scroll)
+        self.thumb_canvas.config(yscrollcommand=thumb_scroll.set)
+        thumb_scroll.pack(side=tk.RIGHT, fill=tk.Y)
+        self.thumb_canvas.pack(side=tk.LEFT, fill=tk.Y)
+        self.thumb_canvas.bind("<Button-1>", self.on_thumb_click)
+        self.thumb_canvas.bind("<Configure>", lambda event: self.update_thumbnails())
+        self.thumb_canvas.bind("<MouseWheel>", self.on_thumb_wheel)
+        self.thumb_canvas.bind("<Button-4>", self.on_thumb_wheel)
+        self.thumb_canvas.bind("<Button-5>", self.on_thumb_wheel)
+        
         canvas_frame = ttk.Frame(content_frame)
         canvas_frame.pack(side=tk.LEFT, fill=tk.BOTH, expand=True, padx=(0, 10))
         
         self.canvas = tk.Canvas(canvas_frame, width=600, height=800, bg='white', bd=2, relief=tk.SUNKEN)
+        x_scroll = ttk.Scrollbar(canvas_frame, orient=tk.HORIZONTAL, command=self.on_scroll_x)
+        y_scroll = ttk.Scrollbar(canvas_frame, orient=tk.VERTICAL, command=self.on_scroll_y)
+        self.canvas.config(xscrollcommand=x_scroll.set, yscrollcommand=y_scroll.set)
+        y_scroll.pack(side=tk.RIGHT, fill=tk.Y)
+        x_scroll.pack(side=tk.BOTTOM, fill=tk.X)
         self.canvas.pack(fill=tk.BOTH, expand=True)
+        self.canvas.bind("<MouseWheel>", self.on_mouse_wheel)
+        self.canvas.bind("<Shift-MouseWheel>", self.on_mouse_wheel)
+        self.canvas.bind("<Control-MouseWheel>", self.on_mouse_wheel)
+        for button in ("<Button-4>", "<Button-5>", "<Shift-Button-4>", "<Shift-Button-5>",
+                       "<Control-Button-4>", "<Control-Button-5>"):
+            self.canvas.bind(button, self.on_mouse_wheel)
         self.canvas.bind("<Button-1>", self.on_canvas_click)
         self.canvas.bind("<B1-Motion>", self.on_drag)
         self.canvas.bind("<ButtonRelease-1>", self.stop_drag)
@@ -201,214 +2410,730 @@ class StampApp:
         if self.pdf_path:
             self.load_pdf_pages()
             self.current_page = 0
-            self.page_stamps = {}
+            self.layout.clear()
+            self.layout.set_page_count(self.total_pages)
+            self.selected_stamp_id = None
+            self.reset_thumbnails()
             self.update_page_display()
             self.update_stamp_list()
     
     def select_stamp(self):
-        self.stamp_path = filedialog.askopenfilename(
+        stamp_path = filedialog.askopenfilename(
             title="选择印章图片", 
             filetypes=[("图片文件", "*.png *.jpg *.jpeg")]
         )
-        if self.stamp_path:
-            self.load_stamp()  # 加载原始图像并保存
+        if stamp_path:
+            self.load_stamp(stamp_path)  # 加入印章库并设为当前印章
     
-    def load_stamp(self):
-        """加载印章图像（同时保存原始图像和预览用缩放图像）"""
+    def load_stamp(self, stamp_path):
+        """加载印章图像到印章库（原始图像保持不变，处理结果缓存供预览与导出共用）"""
         try:
-            # 保存原始图像（保留完整像素数据）
-            self.original_stamp_img = Image.open(self.stamp_path).convert("RGBA")
-            self.original_stamp_width = self.original_stamp_img.width
-            self.original_stamp_height = self.original_stamp_img.height
-            
-            # 处理透明度和颜色（仅用于预览，不修改原始图像）
-            preview_img = self.original_stamp_img.copy()
-            datas = preview_img.getdata()
-            new_data = []
-            for item in datas:
-                # 白色背景透明化
-                if item[0] > 230 and item[1] > 230 and item[2] > 230:
-                    new_data.append((255, 255, 255, 0))
-                # 灰色阴影透明化
-                elif item[0] > 180 and item[1] > 180 and item[2] > 180:
-                    new_data.append((255, 255, 255, 0))
-                # 印章内容增强
-                else:
-                    color_intensity = 255 - ((item[0] + item[1] + item[2]) / 3)
-                    alpha = min(255, int(color_intensity * 2.0 * 0.7))
-                    new_data.append((255, 30, 30, alpha))  # 鲜艳红色带透明度
-            
-            preview_img.putdata(new_data)
-            self.stamp_img = preview_img  # 预览用图像
-            self.update_stamp_display()  # 更新预览显示
+            with TRACE.span("load_stamp", path=os.path.basename(stamp_path)):
+                seal = self.seals.add(stamp_path)
+                self.seals.processed(seal.id)
         except Exception as e:
             messagebox.showerror("错误", f"加载印章图片失败: {str(e)}")
+            return
+        self.current_seal_id = seal.id
+        self.update_seal_choices()
+    
+    def update_seal_choices(self):
+        """刷新印章下拉框"""
+        self.seal_combo.config(values=self.seals.ids())
+        self.seal_combo.set(self.current_seal_id or "")
+    
+    def on_seal_select(self, event=None):
+        """切换当前印章（之后添加的印章使用该印章）"""
+        seal_id = self.seal_combo.get()
+        if seal_id in self.seals:
+            self.current_seal_id = seal_id
+    
+    def remove_current_seal(self):
+        """从印章库移除当前印章，同时删除引用它的印章位置并淘汰其缓存"""
+        seal_id = self.current_seal_id
+        if seal_id is None:
+            return
+        in_use = sum(1 for stamp in self.layout if stamp.seal_id == seal_id)
+        if in_use and not messagebox.askyesno(
+                "确认", f"印章“{seal_id}”已盖在{in_use}处，移除后这些位置也会删除，是否继续？"):
+            return
+        self.layout.remove_seal(seal_id)
+        self.seals.remove(seal_id)
+        for key in [key for key in self.stamp_photo_cache if key[0] == seal_id]:
+            del self.stamp_photo_cache[key]
+        if self.layout.get(self.selected_stamp_id) is None:
+            self.selected_stamp_id = None
+        ids = self.seals.ids()
+        self.current_seal_id = ids[-1] if ids else None
+        self.update_seal_choices()
+        self.show_current_page_stamps()
+        self.update_stamp_list()
     
     def load_pdf_pages(self):
-        """加载PDF所有页面（与原逻辑一致）"""
+        """打开PDF（只读取页数，页面在显示时按需渲染）"""
+        if self.page_renderer:
+            self.page_renderer.close()
         try:
-            self.pdf_pages = convert_from_path(self.pdf_path, dpi=72)
-            self.total_pages = len(self.pdf_pages)
+            with TRACE.span("load_pdf_pages", path=os.path.basename(self.pdf_path)):
+                self.page_renderer = PageRenderer(self.pdf_path, dpi=72,
+                                                  cache_size=self.page_cache_size,
+                                                  disk_cache=self.render_cache)
+            self.total_pages = self.page_renderer.page_count
             messagebox.showinfo("成功", f"已加载PDF文件，共{self.total_pages}页")
         except Exception as e:
             messagebox.showerror("错误", f"加载PDF失败: {str(e)}")
-            self.pdf_pages = []
+            self.page_renderer = None
             self.total_pages = 0
     
     def update_page_display(self):
-        """更新当前页面显示（与原逻辑一致）"""
-        if not self.pdf_pages:
+        """更新当前页面显示（按需渲染当前页，后台预取前后页）"""
+        if not self.page_renderer:
             return
             
         self.canvas.delete("all")
+        self.clear_tiles()
         self.page_label.config(text=f"页面: {self.current_page + 1}/{self.total_pages}")
         
-        if 0 <= self.current_page < len(self.pdf_pages):
-            img = self.pdf_pages[self.current_page]
+        if 0 <= self.current_page < self.total_pages:
+            try:
+                img = self.page_renderer.get(self.current_page)
+            except Exception as e:
+                messagebox.showerror("错误", f"渲染页面失败: {str(e)}")
+                return
             max_width = self.canvas.winfo_width() or 600
             max_height = self.canvas.winfo_height() or 800
             
             self.original_preview_width = img.width
             self.original_preview_height = img.height
+            self.page_image = img
             
-            img.thumbnail((max_width, max_height))
-            self.pdf_photo = ImageTk.PhotoImage(img)
-            
-            self.preview_width = self.pdf_photo.width()
-            self.preview_height = self.pdf_photo.height()
+            # 100% 预览：缩放副本用于显示，缓存中的页面图像保持不变
+            display_img = img.copy()
+            display_img.thumbnail((max_width, max_height))
+            self.preview_width = display_img.width
+            self.preview_height = display_img.height
+            self.preview_scale = display_img.width / img.width
             
-            self.canvas.create_image(0, 0, image=self.pdf_photo, anchor=tk.NW)
+            if self.zoom == 1.0:
+                self.pdf_photo = ImageTk.PhotoImage(display_img)
+                self.canvas.create_image(0, 0, image=self.pdf_photo, anchor=tk.NW)
+            else:
+                self.pdf_photo = None
+            self.canvas.config(scrollregion=(0, 0, self.preview_width * self.zoom,
+                                             self.preview_height * self.zoom))
             self.show_current_page_stamps()
+            self.update_tiles()
+            
+            self.page_renderer.prefetch([self.current_page + 1, self.current_page - 1])
+    
+    def tile_dpi(self):
+        """当前缩放下图块的渲染 dpi（该 dpi 下渲染图的像素坐标即画布坐标）"""
+        return round(self.page_renderer.dpi * self.preview_scale * self.zoom, 2)
+    
+    def clear_tiles(self):
+        """移除画布上的图块并取消等待中的渲染"""
+        for future in self.tile_futures.values():
+            future.cancel()
+        self.tile_futures = {}
+        for item, _ in self.tile_items.values():
+            self.canvas.delete(item)
+        self.tile_items = {}
+        self.canvas.delete("placeholder")
+        self.placeholder_photo = None
+    
+    def schedule_tile_update(self):
+        """滚动时合并短时间内的多次更新"""
+        if self.tile_update_id is not None:
+            self.root.after_cancel(self.tile_update_id)
+        self.tile_update_id = self.root.after(40, self.update_tiles)
+    
+    def update_tiles(self):
+        """放大时只渲染可见区域：已缓存的图块立即显示，其余在后台渲染
+
+        图块渲染完成前，先把 72dpi 页面图中对应的一块放大作为占位；
+        画布上只保留可见的图块，内存占用与视口大小相当。
+        """
+        self.tile_update_id = None
+        if not self.page_renderer or self.page_image is None or self.zoom == 1.0:
+            return
+        size = self.page_renderer.tile_size
+        dpi = self.tile_dpi()
+        zoomed_width = self.preview_width * self.zoom
+        zoomed_height = self.preview_height * self.zoom
+        left = max(0, self.canvas.canvasx(0))
+        top = max(0, self.canvas.canvasy(0))
+        right = min(zoomed_width, left + self.canvas.winfo_width())
+        bottom = min(zoomed_height, top + self.canvas.winfo_height())
+        if right <= left or bottom <= top:
+            return
+        
+        # 占位：72dpi 渲染图中可见区域的一块，放大到视口大小
+        scale = self.preview_scale * self.zoom
+        region = self.page_image.crop((int(left / scale), int(top / scale),
+                                       math.ceil(right / scale), math.ceil(bottom / scale)))
+        region = region.resize((max(1, int(region.width * scale)), max(1, int(region.height * scale))))
+        self.placeholder_photo = ImageTk.PhotoImage(region)
+        self.canvas.delete("placeholder")
+        placeholder = self.canvas.create_image(int(left / scale) * scale, int(top / scale) * scale,
+                                               image=self.placeholder_photo, anchor=tk.NW,
+                                               tags="placeholder")
+        self.canvas.tag_lower(placeholder)
+        
+        wanted = {(self.current_page, dpi, col, row)
+                  for col in range(int(left // size), math.ceil(right / size))
+                  for row in range(int(top // size), math.ceil(bottom / size))}
+        for key in [key for key in self.tile_items if key not in wanted]:
+            self.canvas.delete(self.tile_items.pop(key)[0])
+        for key in [key for key in self.tile_futures if key not in wanted]:
+            self.tile_futures.pop(key).cancel()
+        for key in wanted:
+            if key not in self.tile_items and key not in self.tile_futures:
+                self.tile_futures[key] = self.page_renderer.tile(*key)
+        # 立即放上已完成的图块；先取消尚未触发的轮询，始终只有一个轮询循环
+        if self.tile_poll_id is not None:
+            self.root.after_cancel(self.tile_poll_id)
+        self.poll_tiles()
+    
+    def poll_tiles(self):
+        """把渲染完成的图块放到画布上（位于印章之下、占位图之上）"""
+        self.tile_poll_id = None
+        size = self.page_renderer.tile_size if self.page_renderer else 0
+        for key, future in list(self.tile_futures.items()):
+            if not future.done():
+                continue
+            del self.tile_futures[key]
+            if future.cancelled() or future.exception() is not None:
+                continue
+            _, _, col, row = key
+            photo = ImageTk.PhotoImage(future.result())
+            item = self.canvas.create_image(col * size, row * size, image=photo,
+                                            anchor=tk.NW, tags="tile")
+            self.canvas.tag_lower(item)
+            self.canvas.tag_lower("placeholder")
+            self.tile_items[key] = (item, photo)
+        if self.tile_futures:
+            self.tile_poll_id = self.root.after(30, self.poll_tiles)
+    
+    def set_zoom(self, zoom):
+        """切换缩放比例，保持视口中心对应的页面位置不变"""
+        if zoom == self.zoom or not self.page_renderer:
+            return
+        width = self.canvas.winfo_width()
+        height = self.canvas.winfo_height()
+        center_x = (self.canvas.canvasx(0) + width / 2) / self.zoom
+        center_y = (self.canvas.canvasy(0) + height / 2) / self.zoom
+        self.zoom = zoom
+        self.zoom_label.config(text=f"{zoom:.0%}")
+        self.update_page_display()
+        zoomed_width = self.preview_width * zoom
+        zoomed_height = self.preview_height * zoom
+        if zoomed_width > 0 and zoomed_height > 0:
+            self.canvas.xview_moveto(max(0, center_x * zoom - width / 2) / zoomed_width)
+            self.canvas.yview_moveto(max(0, center_y * zoom - height / 2) / zoomed_height)
+        self.schedule_tile_update()
+    
+    def zoom_in(self):
+        larger = [level for level in self.zoom_levels if level > self.zoom]
+        if larger:
+            self.set_zoom(larger[0])
+    
+    def zoom_out(self):
+        smaller = [level for level in self.zoom_levels if level < self.zoom]
+        if smaller:
+            self.set_zoom(smaller[-1])
+    
+    def on_scroll_x(self, *args):
+        self.canvas.xview(*args)
+        self.schedule_tile_update()
+    
+    def on_scroll_y(self, *args):
+        self.canvas.yview(*args)
+        self.schedule_tile_update()
+    
+    def on_mouse_wheel(self, event):
+        """滚轮上下滚动，Shift+滚轮左右滚动，Ctrl+滚轮缩放"""
+        step = -1 if getattr(event, "delta", 0) > 0 or event.num == 4 else 1
+        if event.state & 0x4:
+            if step < 0:
+                self.zoom_in()
+            else:
+                self.zoom_out()
+        elif event.state & 0x1:
+            self.on_scroll_x("scroll", step, "units")
+        else:
+            self.on_scroll_y("scroll", step, "units")
+    
+    def canvas_position(self, event):
+        """画布事件坐标 → 布局坐标（100% 预览坐标）"""
+        return self.canvas.canvasx(event.x) / self.zoom, self.canvas.canvasy(event.y) / self.zoom
+    
+    def go_to_page(self, page_num):
+        """跳转到指定页面，并在缩略图导航中标出"""
+        if not (0 <= page_num < self.total_pages):
+            return
+        previous = self.current_page
+        self.current_page = page_num
+        self.update_page_display()
+        self.update_stamp_list()
+        
+        for page in (previous, page_num):
+            if page in self.thumb_items:
+                self.thumb_canvas.itemconfig(self.thumb_items[page][0], **self.thumb_outline(page))
+        # 当前页不在可见范围内时滚动缩略图
+        first, last = self.visible_thumbnails()
+        if not (first <= page_num <= last) and self.total_pages:
+            self.thumb_canvas.yview_moveto(page_num / self.total_pages)
+            self.update_thumbnails()
     
     def prev_page(self):
-        if self.current_page > 0:
-            self.current_page -= 1
-            self.update_page_display()
-            self.update_stamp_list()
+        self.go_to_page(self.current_page - 1)
     
     def next_page(self):
-        if self.current_page < self.total_pages - 1:
-            self.current_page += 1
-            self.update_page_display()
-            self.update_stamp_list()
+        self.go_to_page(self.current_page + 1)
+    
+    def reset_thumbnails(self):
+        """打开新的PDF时重新开始生成缩略图"""
+        if self.thumb_renderer:
+            self.thumb_renderer.close()
+            self.thumb_renderer = None
+        self.thumb_canvas.delete("all")
+        self.thumb_items = {}
+        self.thumb_canvas.config(scrollregion=(0, 0, self.thumb_width + 16,
+                                               self.total_pages * self.thumb_slot_height))
+        self.thumb_canvas.yview_moveto(0)
+        if self.page_renderer:
+            self.thumb_renderer = ThumbnailRenderer(self.pdf_path, self.total_pages,
+                                                    width=self.thumb_width,
+                                                    disk_cache=self.render_cache)
+        self.update_thumbnails()
+        if self.thumb_poll_id is None:
+            self.thumb_poll_id = self.root.after(100, self.poll_thumbnails)
+    
+    def thumb_outline(self, page_num):
+        if page_num == self.current_page:
+            return {'outline': 'red', 'width': 2}
+        return {'outline': '#a0a0a0', 'width': 1}
+    
+    def visible_thumbnails(self):
+        """可见的缩略图页码范围 (first, last)"""
+        top = self.thumb_canvas.canvasy(0)
+        height = self.thumb_canvas.winfo_height() or 600
+        first = max(0, int(top // self.thumb_slot_height))
+        last = min(self.total_pages - 1, int((top + height) // self.thumb_slot_height))
+        return first, last
+    
+    def update_thumbnails(self):
+        """只为可见页面（及上下各一页）保留画布项和 PhotoImage"""
+        if not self.thumb_renderer:
+            return
+        first, last = self.visible_thumbnails()
+        shown = range(max(0, first - 1), min(self.total_pages, last + 2))
+        for page_num in [page for page in self.thumb_items if page not in shown]:
+            self.thumb_canvas.delete(f"thumb{page_num}")
+            del self.thumb_items[page_num]
+        
+        slot = self.thumb_slot_height
+        left = 8
+        for page_num in shown:
+            if page_num in self.thumb_items:
+                continue
+            top = page_num * slot + 4
+            tag = f"thumb{page_num}"
+            rect = self.thumb_canvas.create_rectangle(
+                left - 2, top - 2, left + self.thumb_width + 2, top + slot - 26,
+                fill='white', tags=tag, **self.thumb_outline(page_num))
+            self.thumb_canvas.create_text(left + self.thumb_width // 2, top + slot - 16,
+                                          text=str(page_num + 1), tags=tag)
+            self.thumb_items[page_num] = [rect, None, None]
+            self.show_thumbnail(page_num)
+        self.thumb_renderer.request(first, last)
+    
+    def show_thumbnail(self, page_num):
+        """缩略图已生成且页面可见时显示"""
+        entry = self.thumb_items.get(page_num)
+        if entry is None or entry[1] is not None:
+            return
+        img = self.thumb_renderer.get(page_num)
+        if img is None:
+            return
+        display_img = img.copy()
+        display_img.thumbnail((self.thumb_width, self.thumb_slot_height - 32))
+        photo = ImageTk.PhotoImage(display_img)
+        entry[1] = self.thumb_canvas.create_image(
+            8 + self.thumb_width // 2, page_num * self.thumb_slot_height + 4,
+            image=photo, anchor=tk.N, tags=f"thumb{page_num}")
+        entry[2] = photo
+    
+    def poll_thumbnails(self):
+        """取出后台生成完成的缩略图（不阻塞界面线程）"""
+        self.thumb_poll_id = None
+        if not self.thumb_renderer:
+            return
+        try:
+            while True:
+                self.show_thumbnail(self.thumb_renderer.ready.get_nowait())
+        except queue.Empty:
+            pass
+        self.thumb_poll_id = self.root.after(100, self.poll_thumbnails)
+    
+    def on_thumb_scroll(self, *args):
+        self.thumb_canvas.yview(*args)
+        self.update_thumbnails()
+    
+    def on_thumb_wheel(self, event):
+        step = -1 if getattr(event, "delta", 0) > 0 or event.num == 4 else 1
+        self.on_thumb_scroll("scroll", step * 3, "units")
+    
+    def on_thumb_click(self, event):
+        self.go_to_page(int(self.thumb_canvas.canvasy(event.y) // self.thumb_slot_height))
     
     def add_stamp_to_current_page(self):
         """添加印章到当前页（使用原始尺寸计算）"""
-        if not self.stamp_path:
+        if self.current_seal_id is None:
             messagebox.showerror("错误", "请先选择印章图片")
             return
-        if not self.pdf_pages:
+        if not self.page_renderer:
             messagebox.showerror("错误", "请先选择PDF文件")
             return
         
+        size = self.get_stamp_size()
+        if size is None:
+            return
+        
+        # 页面中心添加印章
+        center_x = self.preview_width // 2
+        center_y = self.preview_height // 2
+        
+        width, height = self.stamp_extent(self.current_seal_id, size)
+        self.layout.add(self.current_page, center_x, center_y, size, width, height,
+                        self.current_seal_id)
+        self.show_current_page_stamps()
+        self.update_stamp_list()
+    
+    def get_stamp_size(self):
+        """读取印章大小输入框，无效时提示并返回 None"""
         try:
             size = float(self.size_entry.get())
             if not (0.01 <= size <= 1.0):
                 messagebox.showerror("错误", "请输入0.01到1.0之间的数值")
-                return
+                return None
         except ValueError:
             messagebox.showerror("错误", "请输入有效的数字")
+            return None
+        return size
+    
+    def add_stamps_at_text(self):
+        """在所有页面中定位文字出现处添加印章（文字每页只提取一次，按PDF内容哈希缓存）"""
+        if self.current_seal_id is None:
+            messagebox.showerror("错误", "请先选择印章图片")
+            return
+        if not self.page_renderer:
+            messagebox.showerror("错误", "请先选择PDF文件")
+            return
+        text = self.anchor_entry.get().strip()
+        if not text:
+            messagebox.showwarning("提示", "请输入定位文字")
+            return
+        size = self.get_stamp_size()
+        if size is None:
             return
         
-        # 页面中心添加印章
-        center_x = self.preview_width // 2
-        center_y = self.preview_height // 2
-        
-        if self.current_page not in self.page_stamps:
-            self.page_stamps[self.current_page] = []
-        
-        stamp_info = {
-            'position': (center_x, center_y),
-            'size': size,
-            'id': len(self.page_stamps[self.current_page])
-        }
+        self.root.config(cursor="watch")
+        self.root.update_idletasks()
+        try:
+            with TRACE.span("anchor_text", text=text):
+                pdf_reader = PdfReader(self.pdf_path)
+                text_index = self.text_indexes.index(
+                    pdf_reader, self.text_indexes.document_key(self.pdf_path))
+                positions = resolve_anchor_text(text_index, text, range(self.total_pages))
+                self.text_indexes.save(text_index)
+        except Exception as e:
+            messagebox.showerror("错误", f"查找文字失败: {str(e)}")
+            return
+        finally:
+            self.root.config(cursor="")
+        if not positions:
+            messagebox.showinfo("提示", f"未找到文字“{text}”")
+            return
         
-        self.page_stamps[self.current_page].append(stamp_info)
+        width, height = self.stamp_extent(self.current_seal_id, size)
+        boxes = {}
+        items = []
+        for page_num, x, y in positions:
+            if page_num not in boxes:
+                boxes[page_num] = PageBox(pdf_reader.pages[page_num])
+            items.append((page_num, *self.page_to_preview(boxes[page_num], x, y),
+                          size, width, height, self.current_seal_id))
+        self.layout.add_many(items)
+        pages = sorted(boxes)
+        if self.current_page in boxes:
+            self.show_current_page_stamps()
+            self.update_stamp_list()
+        else:
+            self.go_to_page(pages[0])
+        messagebox.showinfo("完成", f"已在{len(pages)}页的{len(items)}处添加印章")
+    
+    def page_to_preview(self, box, x, y):
+        """页面坐标 → 预览坐标（compute_page_placements 的逆变换，各页共用同一预览尺寸）"""
+        return (x * self.preview_width / box.width,
+                (box.height - y) * self.preview_height / box.height)
+    
+    def save_layout_file(self):
+        """保存全部印章位置为布局文件：页面比例坐标、印章图片路径与源PDF哈希
+
+        布局与预览尺寸无关，可在界面中对同一文件或修订后的文件重新加载，也可直接
+        用于 batch/serve 命令行无界面套用（python stmp.py batch 新版.pdf --layout 布局.json）。
+        """
+        if not self.page_renderer:
+            messagebox.showerror("错误", "请先选择PDF文件")
+            return
+        if not self.layout:
+            messagebox.showwarning("提示", "没有可保存的印章")
+            return
+        seals = {}
+        for stamp in self.layout:
+            seal = self.seals.get(stamp.seal_id)
+            if seal.path is None:
+                messagebox.showerror("错误", f"印章“{seal.id}”没有图片文件，无法保存到布局")
+                return
+            seals[seal.id] = os.path.abspath(seal.path)
+        path = filedialog.asksaveasfilename(
+            title="保存布局",
+            defaultextension=".json",
+            initialfile=f"{os.path.splitext(os.path.basename(self.pdf_path))[0]}_layout.json",
+            filetypes=[("布局文件", "*.json")]
+        )
+        if not path:
+            return
+        try:
+            with TRACE.span("save_layout", stamps=len(self.layout)):
+                save_layout(path, {
+                    "source": pdf_source_info(self.pdf_path),
+                    "seals": seals,
+                    "placements": self.layout.layout_items((self.preview_width, self.preview_height)),
+                })
+        except Exception as e:
+            messagebox.showerror("错误", f"保存布局失败: {str(e)}")
+            return
+        messagebox.showinfo("成功", f"已保存{len(self.layout)}个印章位置到:\n{path}")
+    
+    def load_layout_file(self):
+        """加载布局文件到当前PDF（只读取页面尺寸，不渲染页面）
+
+        界面保存的比例坐标按当前预览尺寸换算；手写布局中的 x/y 与按文字定位的位置
+        换算为各页的单页印章。源PDF哈希与当前文件不同时先确认。
+        """
+        if not self.page_renderer:
+            messagebox.showerror("错误", "请先选择PDF文件")
+            return
+        path = filedialog.askopenfilename(title="加载布局", filetypes=[("布局文件", "*.json")])
+        if not path:
+            return
+        try:
+            layout = load_layout(path)
+            source = layout.get("source") or {}
+            if source.get("sha256") and source["sha256"] != file_digest(self.pdf_path):
+                if not messagebox.askyesno(
+                        "确认", f"布局保存自“{source.get('name', '')}”，与当前PDF内容不同"
+                                f"（可能是修订版），是否仍然套用？"):
+                    return
+            if self.layout and messagebox.askyesno("确认", "是否先清空当前所有印章？"):
+                self.layout.clear()
+                self.selected_stamp_id = None
+            with TRACE.span("load_layout", placements=len(layout.get("placements", []))):
+                added = self.apply_layout(layout)
+        except Exception as e:
+            messagebox.showerror("错误", f"加载布局失败: {str(e)}")
+            return
+        self.update_seal_choices()
         self.show_current_page_stamps()
         self.update_stamp_list()
+        messagebox.showinfo("成功", f"已加载{added}个印章位置")
+    
+    def apply_layout(self, layout):
+        """将布局加入印章库与 self.layout，返回添加的印章数"""
+        # 布局中的印章 → 印章库中的印章ID（同一图片文件复用，否则加入印章库，ID 被占用时另起）
+        library_paths = {os.path.abspath(seal.path): seal.id for seal in self.seals if seal.path}
+        seal_ids = {}
+        for seal_id, seal_path in layout_seal_paths(layout).items():
+            library_id = library_paths.get(os.path.abspath(seal_path))
+            if library_id is None:
+                seal = self.seals.add(seal_path, seal_id if seal_id not in self.seals else None)
+                self.seals.processed(seal.id)
+                library_id = library_paths[os.path.abspath(seal_path)] = seal.id
+            seal_ids[seal_id] = library_id
+        if self.current_seal_id is None and seal_ids:
+            self.current_seal_id = next(iter(seal_ids.values()))
+        
+        pdf_reader = None
+        text_index = None
+        boxes = {}
+        added = 0
+        for item in layout.get("placements", []):
+            seal_id = item.get("seal")
+            if seal_id not in seal_ids:
+                raise ValueError(f"布局引用了未定义的印章: {seal_id}")
+            seal_id = seal_ids[seal_id]
+            size = float(item.get("size", 1.0))
+            width, height = self.stamp_extent(seal_id, size)
+            pages = item.get("pages", "all")
+            if "rx" in item and "text" not in item:
+                x = float(item["rx"]) * self.preview_width
+                y = (1 - float(item["ry"])) * self.preview_height
+                if isinstance(pages, int):
+                    if 1 <= pages <= self.total_pages:
+                        self.layout.add(pages - 1, x, y, size, width, height, seal_id)
+                        added += 1
+                elif isinstance(pages, str):
+                    self.layout.add_rule(pages, x, y, size, width, height, seal_id)
+                    added += 1
+                else:
+                    for page_num in parse_page_spec(pages, self.total_pages):
+                        self.layout.add(page_num, x, y, size, width, height, seal_id)
+                        added += 1
+                continue
+            
+            # 页面坐标（pt）或按文字定位：按各页尺寸换算为单页印章
+            if pdf_reader is None:
+                pdf_reader = PdfReader(self.pdf_path)
+            page_nums = parse_page_spec(pages, self.total_pages)
+            if "text" in item:
+                if text_index is None:
+                    text_index = self.text_indexes.index(
+                        pdf_reader, self.text_indexes.document_key(self.pdf_path))
+                positions = resolve_anchor_text(
+                    text_index, item["text"], page_nums, item.get("occurrence", "all"),
+                    (float(item.get("dx", 0)), float(item.get("dy", 0))))
+            else:
+                positions = [(page_num, float(item["x"]), float(item["y"])) for page_num in page_nums]
+            anchor = item.get("anchor", "center")
+            if anchor not in ANCHORS:
+                raise ValueError(f"未知的锚点: {anchor}（可选: {', '.join(ANCHORS)}）")
+            anchor_x, anchor_y = ANCHORS[anchor]
+            seal = self.seals.get(seal_id)
+            for page_num, x, y in positions:
+                if page_num not in boxes:
+                    boxes[page_num] = PageBox(pdf_reader.pages[page_num])
+                x += (0.5 - anchor_x) * seal.width * size
+                y += (0.5 - anchor_y) * seal.height * size
+                self.layout.add(page_num, *self.page_to_preview(boxes[page_num], x, y),
+                                size, width, height, seal_id)
+                added += 1
+        if text_index is not None:
+            self.text_indexes.save(text_index)
+        return added
+    
+    def stamp_extent(self, seal_id, size):
+        """印章在预览中的显示尺寸（印章原始尺寸×比例）"""
+        seal = self.seals.get(seal_id)
+        return int(seal.width * size), int(seal.height * size)
     
     def delete_selected_stamp(self):
-        """删除选中的印章（与原逻辑一致）"""
+        """删除选中的印章（其余印章ID保持不变）"""
         if self.selected_stamp_id is None:
             messagebox.showwarning("提示", "请先选择要删除的印章")
             return
         
-        if self.current_page in self.page_stamps:
-            stamps = self.page_stamps[self.current_page]
-            self.page_stamps[self.current_page] = [s for s in stamps if s['id'] != self.selected_stamp_id]
-            
-            # 重新分配ID
-            for i, stamp in enumerate(self.page_stamps[self.current_page]):
-                stamp['id'] = i
-            
-            self.selected_stamp_id = None
-            self.show_current_page_stamps()
-            self.update_stamp_list()
+        self.layout.remove(self.selected_stamp_id)
+        self.selected_stamp_id = None
+        self.show_current_page_stamps()
+        self.update_stamp_list()
     
     def clear_current_page_stamps(self):
         """清空当前页印章（与原逻辑一致）"""
-        if self.current_page in self.page_stamps:
-            del self.page_stamps[self.current_page]
+        if self.layout.has_page(self.current_page):
+            self.layout.clear_page(self.current_page)
             self.selected_stamp_id = None
             self.show_current_page_stamps()
             self.update_stamp_list()
     
+    def apply_page_rule(self):
+        """将选中的印章改为按页码规则作用于多页（规则只保存一条，导出时再展开）"""
+        if self.selected_stamp_id is None:
+            messagebox.showwarning("提示", "请先选择要应用到多页的印章")
+            return
+        pages = self.rule_entry.get().strip()
+        try:
+            if not parse_page_spec(pages, self.total_pages):
+                messagebox.showerror("错误", f"页码规则“{pages}”不包含任何页面")
+                return
+            self.layout.set_rule_pages(self.selected_stamp_id, pages)
+        except ValueError:
+            messagebox.showerror("错误", f"无效的页码规则: {pages}")
+            return
+        self.show_current_page_stamps()
+        self.update_stamp_list()
+    
     def update_stamp_list(self):
-        """更新印章列表（与原逻辑一致）"""
+        """更新印章列表（页码规则印章标注其规则）"""
         self.stamp_listbox.delete(0, tk.END)
-        if self.current_page in self.page_stamps:
-            for i, stamp in enumerate(self.page_stamps[self.current_page]):
-                pos = stamp['position']
-                size = stamp['size']
-                self.stamp_listbox.insert(tk.END, f"印章{i+1}: ({pos[0]:.0f},{pos[1]:.0f}) 大小:{size:.2f}")
+        self.stamp_list_ids = []
+        for i, stamp in enumerate(self.layout.page_stamps(self.current_page)):
+            rule = f" [{stamp.pages}]" if stamp.is_rule else ""
+            self.stamp_listbox.insert(
+                tk.END, f"{stamp.seal_id}{i+1}{rule}: ({stamp.x:.0f},{stamp.y:.0f}) 大小:{stamp.size:.2f}")
+            self.stamp_list_ids.append(stamp.id)
+            if stamp.id == self.selected_stamp_id:
+                self.stamp_listbox.selection_set(i)
     
     def on_stamp_select(self, event):
         """选择印章列表项（与原逻辑一致）"""
         selection = self.stamp_listbox.curselection()
-        if selection:
-            self.selected_stamp_id = selection[0]
-            if self.current_page in self.page_stamps:
-                stamps = self.page_stamps[self.current_page]
-                if self.selected_stamp_id < len(stamps):
-                    selected_stamp = stamps[self.selected_stamp_id]
-                    self.size_entry.delete(0, tk.END)
-                    self.size_entry.insert(0, str(selected_stamp['size']))
+        if selection and selection[0] < len(self.stamp_list_ids):
+            self.selected_stamp_id = self.stamp_list_ids[selection[0]]
+            selected_stamp = self.layout.get(self.selected_stamp_id)
+            self.size_entry.delete(0, tk.END)
+            self.size_entry.insert(0, str(selected_stamp.size))
             self.show_current_page_stamps()
     
+    def get_stamp_photo(self, seal_id, size, zoom=1.0):
+        """返回指定印章和缩放比例的预览图（按（印章, 预览尺寸）缓存，避免重复缩放）"""
+        preview_width, preview_height = self.stamp_extent(seal_id, size)
+        preview_width = max(1, int(preview_width * zoom))
+        preview_height = max(1, int(preview_height * zoom))
+        key = (seal_id, preview_width, preview_height)
+        
+        stamp_photo = self.stamp_photo_cache.get(key)
+        if stamp_photo is not None:
+            self.stamp_photo_cache.move_to_end(key)
+            return stamp_photo
+        
+        # 预览时缩放（仅为显示，原始图像不变）
+        processed = self.seals.processed(seal_id)
+        resized = processed.resize((preview_width, preview_height), Image.LANCZOS)
+        stamp_photo = ImageTk.PhotoImage(resized)
+        self.stamp_photo_cache[key] = stamp_photo
+        while len(self.stamp_photo_cache) > self.stamp_photo_cache_size:
+            self.stamp_photo_cache.popitem(last=False)
+        return stamp_photo
+    
     def show_current_page_stamps(self):
         """显示当前页印章（预览用缩放，不影响原始像素）"""
         self.canvas.delete("stamp")
         self.canvas.delete("selected_stamp")
+        self.stamp_items = {}
+        self.selection_rect = None
         
-        if hasattr(self, 'stamp_photos'):
-            self.stamp_photos.clear()
-        else:
-            self.stamp_photos = []
-        
-        if self.current_page not in self.page_stamps or not self.stamp_img:
-            return
+        # 保持当前显示图像的引用（缓存淘汰后画布上的图像仍然有效）
+        self.stamp_photos = []
         
-        for stamp in self.page_stamps[self.current_page]:
-            pos = stamp['position']
-            size = stamp['size']
-            
-            # 预览时缩放（仅为显示，原始图像不变）
-            preview_width = int(self.original_stamp_width * size)
-            preview_height = int(self.original_stamp_height * size)
-            resized = self.stamp_img.resize((preview_width, preview_height), Image.LANCZOS)
-            stamp_photo = ImageTk.PhotoImage(resized)
+        for stamp in self.layout.page_stamps(self.current_page):
+            pos = (stamp.position[0] * self.zoom, stamp.position[1] * self.zoom)
+            stamp_photo = self.get_stamp_photo(stamp.seal_id, stamp.size, self.zoom)
+            preview_width = stamp_photo.width()
+            preview_height = stamp_photo.height()
             
             # 标记选中状态
             tag = "stamp"
-            if stamp['id'] == self.selected_stamp_id:
+            if stamp.id == self.selected_stamp_id:
                 tag = "selected_stamp"
-                self.canvas.create_rectangle(
+                self.selection_rect = self.canvas.create_rectangle(
                     pos[0] - preview_width//2 - 2, pos[1] - preview_height//2 - 2,
                     pos[0] + preview_width//2 + 2, pos[1] + preview_height//2 + 2,
                     outline="red", width=2, tags="selected_stamp"
                 )
             
-            self.canvas.create_image(
+            self.stamp_items[stamp.id] = self.canvas.create_image(
                 pos[0], pos[1], 
                 image=stamp_photo, 
                 anchor=tk.CENTER, 
@@ -422,51 +3147,30 @@ class StampApp:
             size = float(self.size_entry.get())
             if 0.01 <= size <= 1.0:
                 self.default_scale = size
-                if (self.selected_stamp_id is not None and 
-                    self.current_page in self.page_stamps):
-                    for stamp in self.page_stamps[self.current_page]:
-                        if stamp['id'] == self.selected_stamp_id:
-                            stamp['size'] = size
-                            break
+                stamp = self.layout.get(self.selected_stamp_id)
+                if stamp is not None:
+                    width, height = self.stamp_extent(stamp.seal_id, size)
+                    self.layout.resize(stamp.id, size, width, height)
                     self.show_current_page_stamps()
                     self.update_stamp_list()
         except ValueError:
             pass
     
-    def update_stamp_display(self):
-        """更新印章预览（仅缩放显示，原始图像不变）"""
-        if self.stamp_img:
-            preview_width = int(self.original_stamp_width * self.default_scale)
-            preview_height = int(self.original_stamp_height * self.default_scale)
-            resized = self.stamp_img.resize((preview_width, preview_height), Image.LANCZOS)
-            self.stamp_photo = ImageTk.PhotoImage(resized)
-    
     def on_canvas_click(self, event):
         """画布点击事件（与原逻辑一致）"""
-        if not self.stamp_img or not self.pdf_pages:
+        if self.current_seal_id is None or not self.page_renderer:
             return
         
-        x, y = event.x, event.y
-        clicked_stamp = None
-        
-        if self.current_page in self.page_stamps:
-            for stamp in self.page_stamps[self.current_page]:
-                pos = stamp['position']
-                size = stamp['size']
-                width = int(self.original_stamp_width * size)
-                height = int(self.original_stamp_height * size)
-                
-                if (abs(x - pos[0]) <= width // 2 and 
-                    abs(y - pos[1]) <= height // 2):
-                    clicked_stamp = stamp
-                    break
+        x, y = self.canvas_position(event)
+        clicked_stamp = self.layout.hit_test(self.current_page, x, y)
         
         if clicked_stamp:
-            self.selected_stamp_id = clicked_stamp['id']
+            self.selected_stamp_id = clicked_stamp.id
             self.stamp_listbox.selection_clear(0, tk.END)
-            self.stamp_listbox.selection_set(clicked_stamp['id'])
+            if clicked_stamp.id in self.stamp_list_ids:
+                self.stamp_listbox.selection_set(self.stamp_list_ids.index(clicked_stamp.id))
             self.size_entry.delete(0, tk.END)
-            self.size_entry.insert(0, str(clicked_stamp['size']))
+            self.size_entry.insert(0, str(clicked_stamp.size))
             self.show_current_page_stamps()
         else:
             try:
@@ -478,12 +3182,8 @@ class StampApp:
                 messagebox.showerror("错误", "请输入有效的数字")
                 return
             
-            if self.current_page not in self.page_stamps:
-                self.page_stamps[self.current_page] = []
-            
             # 边界检查：确保新添加的印章不超出预览区域
-            stamp_width = int(self.original_stamp_width * size)
-            stamp_height = int(self.original_stamp_height * size)
+            stamp_width, stamp_height = self.stamp_extent(self.current_seal_id, size)
             half_width = stamp_width // 2
             half_height = stamp_height // 2
             
@@ -499,63 +3199,65 @@ class StampApp:
             elif y + half_height > self.preview_height:
                 y = self.preview_height - half_height
             
-            stamp_info = {
-                'position': (x, y),
-                'size': size,
-                'id': len(self.page_stamps[self.current_page])
-            }
-            
-            self.page_stamps[self.current_page].append(stamp_info)
+            self.layout.add(self.current_page, x, y, size, stamp_width, stamp_height,
+                            self.current_seal_id)
             self.show_current_page_stamps()
             self.update_stamp_list()
     
     def on_drag(self, event):
         """拖拽印章（添加边界检查）"""
-        if self.selected_stamp_id is not None and self.current_page in self.page_stamps:
-            for stamp in self.page_stamps[self.current_page]:
-                if stamp['id'] == self.selected_stamp_id:
-                    # 获取印章尺寸
-                    size = stamp['size']
-                    stamp_width = int(self.original_stamp_width * size)
-                    stamp_height = int(self.original_stamp_height * size)
-                    
-                    # 边界检查：确保印章不超出预览区域
-                    x = event.x
-                    y = event.y
-                    half_width = stamp_width // 2
-                    half_height = stamp_height // 2
-                    
-                    # 限制X坐标范围
-                    if x - half_width < 0:
-                        x = half_width
-                    elif x + half_width > self.preview_width:
-                        x = self.preview_width - half_width
-                        
-                    # 限制Y坐标范围
-                    if y - half_height < 0:
-                        y = half_height
-                    elif y + half_height > self.preview_height:
-                        y = self.preview_height - half_height
-                    
-                    stamp['position'] = (x, y)
-                    break
+        stamp = self.layout.get(self.selected_stamp_id)
+        if stamp is None or (not stamp.is_rule and stamp.page != self.current_page):
+            return
+        
+        # 边界检查：确保印章不超出预览区域
+        x, y = self.canvas_position(event)
+        half_width = stamp.width // 2
+        half_height = stamp.height // 2
+        
+        # 限制X坐标范围
+        if x - half_width < 0:
+            x = half_width
+        elif x + half_width > self.preview_width:
+            x = self.preview_width - half_width
             
+        # 限制Y坐标范围
+        if y - half_height < 0:
+            y = half_height
+        elif y + half_height > self.preview_height:
+            y = self.preview_height - half_height
+        
+        self.layout.move(stamp.id, x, y)
+        
+        # 直接移动已有的画布项，不重建页面上的印章；列表在拖拽结束时更新
+        item = self.stamp_items.get(stamp.id)
+        if item is None:
             self.show_current_page_stamps()
-            self.update_stamp_list()
-            self.canvas.update_idletasks()
+        else:
+            zoom = self.zoom
+            self.canvas.coords(item, x * zoom, y * zoom)
+            if self.selection_rect is not None:
+                self.canvas.coords(
+                    self.selection_rect,
+                    (x - half_width) * zoom - 2, (y - half_height) * zoom - 2,
+                    (x + half_width) * zoom + 2, (y + half_height) * zoom + 2)
+        self.dragging = True
     
     def stop_drag(self, event):
-        pass
+        """拖拽结束时再刷新印章列表"""
+        if self.dragging:
+            self.dragging = False
+            self.update_stamp_list()
     
     def save_pdf(self):
         """保存盖章后的PDF（核心改进：使用原始印章像素）"""
         if not self.pdf_path:
             messagebox.showerror("错误", "请先选择PDF文件")
             return
-        if not self.stamp_path:
+        if not self.seals:
             messagebox.showerror("错误", "请先选择印章图片")
             return
-        if not self.page_stamps:
+        if not self.layout:
             messagebox.showwarning("提示", "没有添加任何印章")
             return
         
@@ -570,122 +3272,1106 @@ class StampApp:
         )
         
         if self.output_path:
-            try:
-                progress = ttk.Progressbar(self.root, mode="indeterminate")
-                progress.pack(pady=5, fill=tk.X, padx=10)
-                progress.start()
-                self.root.after(100, lambda: self._save_pdf_async(progress))
-            except Exception as e:
-                progress.stop()
-                progress.destroy()
-                messagebox.showerror("错误", f"发生错误: {str(e)}")
+            self._start_export()
+    
+    def _start_export(self):
+        """在工作线程中导出，界面通过队列接收逐页进度，可随时取消"""
+        if self.export_thread and self.export_thread.is_alive():
+            messagebox.showwarning("提示", "正在导出，请稍候")
+            return
+        
+        # 在主线程中准备导出所需数据，工作线程不访问界面状态
+        # 每枚用到的印章只处理一次（通常直接命中预览时的缓存），一次导出渲染所有印章
+        page_stamps = self.layout.snapshot()
+        page_rules = self.layout.rule_snapshot()
+        used_seals = {seal_id for stamps in page_stamps.values() for *_, seal_id in stamps}
+        used_seals.update(seal_id for *_, seal_id in page_rules)
+        try:
+            stamp_images = {seal_id: self.seals.export_image(seal_id) for seal_id in used_seals}
+        except Exception as e:
+            messagebox.showerror("错误", f"发生错误: {str(e)}")
+            return
+        job = {
+            'pdf_path': self.pdf_path,
+            'output_path': self.output_path,
+            'page_stamps': page_stamps,
+            'page_rules': page_rules,
+            'preview_size': (self.preview_width, self.preview_height),
+            'seal_sizes': {seal_id: (self.seals.get(seal_id).width, self.seals.get(seal_id).height)
+                           for seal_id in used_seals},
+            'stamp_images': stamp_images,
+            'incremental': self.incremental_save.get(),
+            'compact': self.compact_output.get(),
+            'encoding': self.seal_encodings[self.seal_encoding.get()],
+            'workers': os.cpu_count(),  # 叠加层较多时才启用进程池
+        }
+        
+        self.export_queue = job['queue'] = queue.Queue()
+        self.export_cancel = job['cancel_event'] = threading.Event()
+        
+        self.export_frame = ttk.Frame(self.root)
+        self.export_frame.pack(pady=5, fill=tk.X, padx=10)
+        self.export_progress = ttk.Progressbar(self.export_frame, mode="determinate")
+        self.export_progress.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        self.export_status = ttk.Label(self.export_frame, text="准备导出...")
+        self.export_status.pack(side=tk.LEFT, padx=5)
+        ttk.Button(self.export_frame, text="取消", command=self.cancel_export).pack(side=tk.LEFT)
+        
+        self.export_thread = threading.Thread(target=self._save_pdf_async, args=(job,), daemon=True)
+        self.export_thread.start()
+        self._poll_export(time.perf_counter())
+    
+    def cancel_export(self):
+        if self.export_cancel is not None:
+            self.export_cancel.set()
+            self.export_status.config(text="正在取消...")
     
-    def _save_pdf_async(self, progress):
-        """异步保存PDF（关键改进：使用原始印章尺寸计算显示大小）"""
+    def _poll_export(self, scheduled_at):
+        """处理工作线程发来的消息（在Tk主线程中轮询）"""
+        # 记录事件循环延迟：本次回调比预定时间晚了多久（追踪汇总中的最大值即界面最大响应延迟）
+        TRACE.record("ui.poll_delay", scheduled_at, time.perf_counter())
+        finished = None
         try:
-            pdf_reader = PdfReader(self.pdf_path)
-            pdf_writer = PdfWriter()
+            while True:
+                message = self.export_queue.get_nowait()
+                if message[0] == 'progress':
+                    done, total = message[1], message[2]
+                    self.export_progress.config(maximum=total, value=done)
+                    self.export_status.config(text=f"{done}/{total} 页")
+                elif message[0] == 'writing':
+                    self.export_status.config(text="正在写入文件...")
+                else:
+                    finished = message
+        except queue.Empty:
+            pass
+        
+        if finished is None:
+            interval = 0.05
+            self.root.after(int(interval * 1000), self._poll_export,
+                            time.perf_counter() + interval)
+            return
+        
+        self.export_frame.destroy()
+        self.export_thread = None
+        self.export_cancel = None
+        if finished[0] == 'done':
+            message = f"盖章完成，文件已保存到:\n{finished[1]}"
+            if finished[2]:
+                message += f"\n{finished[2]}"
+            messagebox.showinfo("成功", message)
+        elif finished[0] == 'cancelled':
+            messagebox.showinfo("提示", "已取消导出")
+        else:
+            messagebox.showerror("错误", f"发生错误: {finished[1]}")
+    
+    @staticmethod
+    def compute_page_placements(pdf_reader, page_stamps, preview_size, seal_sizes, page_rules=()):
+        """将预览坐标中的印章转换为PDF坐标 {页码: [(x, y, draw_width, draw_height, seal_id, rotation), ...]}
+
+        page_stamps 为 StampLayout.snapshot() 的结果 {页码: [(x, y, size, seal_id), ...]}；
+        page_rules 为 StampLayout.rule_snapshot() 的结果，在此按页展开，位于该页单独
+        添加的印章之下；seal_sizes 为 {seal_id: (原始宽度, 原始高度)}。
+        预览显示的是按 /Rotate 旋转后的可见区域，经 PageBox 换算为用户坐标。
+        相同页面几何下的同一印章只换算一次，各页得到相同的位置元组，
+        几何相同的页面在 build_stamp_overlays 中共用一个叠加层。
+        """
+        preview_width, preview_height = preview_size
+        total_pages = len(pdf_reader.pages)
+        rule_pages = [frozenset(parse_page_spec(rule[0], total_pages)) for rule in page_rules]
+        converted = {}  # {(页面几何, 预览中的印章): PDF坐标中的位置}
+        
+        def convert(box, stamp):
+            key = (box.left, box.bottom, box.box_width, box.box_height, box.rotation, stamp)
+            if key in converted:
+                return converted[key]
+            page_width, page_height = box.width, box.height
+            preview_x, preview_y, size, seal_id = stamp
+            stamp_width, stamp_height = seal_sizes[seal_id]
             
-            for page_num in range(len(pdf_reader.pages)):
-                page = pdf_reader.pages[page_num]
-                page_width = float(page.mediabox.width)
-                page_height = float(page.mediabox.height)
-                
-                if page_num in self.page_stamps:
-                    # 计算PDF与预览的尺寸比例（用于坐标转换）
-                    preview_width = self.preview_width
-                    preview_height = self.preview_height
-                    ratio_x = page_width / preview_width
-                    ratio_y = page_height / preview_height
-                    
-                    # 为当前页的每个印章创建临时PDF
-                    for stamp in self.page_stamps[page_num]:
-                        pos = stamp['position']
-                        size = stamp['size']
-                        
-                        # 转换坐标（预览坐标→PDF实际坐标）
-                        x = pos[0] * ratio_x
-                        y = page_height - (pos[1] * ratio_y)  # 翻转Y轴
-                        
-                        # 计算显示尺寸（原始印章尺寸×比例，不修改像素）
-                        draw_width = self.original_stamp_width * size
-                        draw_height = self.original_stamp_height * size
-                        
-                        # 边界检查：确保印章不超出页面范围
-                        half_width = draw_width / 2
-                        half_height = draw_height / 2
-                        
-                        # 限制X坐标范围
-                        if x - half_width < 0:
-                            x = half_width
-                        elif x + half_width > page_width:
-                            x = page_width - half_width
-                            
-                        # 限制Y坐标范围
-                        if y - half_height < 0:
-                            y = half_height
-                        elif y + half_height > page_height:
-                            y = page_height - half_height
-                        
-                        # 创建临时印章PDF（使用原始图像）
-                        with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as temp_pdf:
-                            temp_pdf_path = temp_pdf.name
-                            
-                            # 处理印章透明度（直接使用原始图像处理后的数据）
-                            processed_stamp = self.original_stamp_img.copy()
-                            datas = processed_stamp.getdata()
-                            new_data = []
-                            for item in datas:
-                                if item[0] > 230 and item[1] > 230 and item[2] > 230:
-                                    new_data.append((255, 255, 255, 0))
-                                elif item[0] > 180 and item[1] > 180 and item[2] > 180:
-                                    new_data.append((255, 255, 255, 0))
-                                else:
-                                    color_intensity = 255 - ((item[0] + item[1] + item[2]) / 3)
-                                    alpha = min(255, int(color_intensity * 2.0 * 0.7))
-                                    new_data.append((255, 30, 30, alpha))
-                            
-                            processed_stamp.putdata(new_data)
-                            
-                            # 保存原始尺寸的处理后印章（不缩放）
-                            with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as temp_img:
-                                processed_stamp.save(temp_img, format='PNG', dpi=(300, 300))
-                                temp_img_path = temp_img.name
-                            
-                            # 绘制印章（使用原始尺寸图像，指定显示宽高）
-                            c = canvas.Canvas(temp_pdf_path, pagesize=(page_width, page_height))
-                            stamp_x = x - (draw_width / 2)
-                            stamp_y = y - (draw_height / 2)
-                            c.drawImage(temp_img_path, stamp_x, stamp_y,
-                                       width=draw_width, height=draw_height, mask='auto')
-                            c.save()
-                            
-                            # 合并印章到当前页
-                            stamp_reader = PdfReader(temp_pdf_path)
-                            stamp_page = stamp_reader.pages[0]
-                            page.merge_page(stamp_page)
-                            
-                            # 清理临时文件
-                            try:
-                                os.remove(temp_img_path)
-                                os.remove(temp_pdf_path)
-                            except:
-                                pass
-                
-                pdf_writer.add_page(page)
+            # 计算PDF与预览的尺寸比例（用于坐标转换）
+            ratio_x = page_width / preview_width
+            ratio_y = page_height / preview_height
+            
+            # 转换坐标（预览坐标→页面坐标）
+            x = preview_x * ratio_x
+            y = page_height - (preview_y * ratio_y)  # 翻转Y轴
             
-            with open(self.output_path, "wb") as f:
-                pdf_writer.write(f)
+            # 计算显示尺寸（原始印章尺寸×比例，不修改像素）
+            draw_width = stamp_width * size
+            draw_height = stamp_height * size
             
-            progress.stop()
-            progress.destroy()
-            messagebox.showinfo("成功", f"盖章完成，文件已保存到:\n{self.output_path}")
+            # 边界检查：确保印章不超出页面范围
+            x, y = box.clamp(x, y, draw_width, draw_height)
+            
+            placement = converted[key] = box.placement(x, y, draw_width, draw_height, seal_id)
+            return placement
+        
+        page_placements = {}
+        for page_num in range(total_pages):
+            stamps = [tuple(rule[1:]) for rule, pages in zip(page_rules, rule_pages)
+                      if page_num in pages]
+            stamps.extend(tuple(stamp) for stamp in page_stamps.get(page_num, ()))
+            if not stamps:
+                continue
+            box = PageBox(pdf_reader.pages[page_num])
+            page_placements[page_num] = [convert(box, stamp) for stamp in stamps]
+        return page_placements
+    
+    def _save_pdf_async(self, job):
+        """导出工作线程：合并印章并写出PDF，通过队列报告进度和结果"""
+        post = job['queue'].put
+        try:
+            with TRACE.span("save_pdf", incremental=job['incremental']):
+                with TRACE.span("export.read"):
+                    pdf_reader = PdfReader(job['pdf_path'])
+                with TRACE.span("export.placements"):
+                    page_placements = self.compute_page_placements(
+                        pdf_reader, job['page_stamps'], job['preview_size'], job['seal_sizes'],
+                        job['page_rules'])
+                
+                def report(done, total):
+                    post(('progress', done, total))
+                    if done == total:
+                        post(('writing',))
+                
+                if job['incremental']:
+                    append_stamped_pdf(job['pdf_path'], page_placements, job['stamp_images'],
+                                       job['output_path'], progress=report,
+                                       cancel_event=job['cancel_event'], pdf_reader=pdf_reader,
+                                       encoding=job.get('encoding'), workers=job.get('workers'))
+                else:
+                    # 紧凑输出只用于完整重写；增量保存须保留原文件字节不变
+                    write_stamped_pdf(pdf_reader, page_placements, job['stamp_images'],
+                                      job['output_path'], progress=report,
+                                      cancel_event=job['cancel_event'],
+                                      encoding=job.get('encoding'), workers=job.get('workers'),
+                                      compact=job.get('compact', False))
+            size_note = None
+            if job.get('compact') and not job['incremental']:
+                size_note = describe_size_change(os.path.getsize(job['pdf_path']),
+                                                 os.path.getsize(job['output_path']))
+            post(('done', job['output_path'], size_note))
+        except ExportCancelled:
+            post(('cancelled',))
         except Exception as e:
-            progress.stop()
-            progress.destroy()
-            messagebox.showerror("错误", f"发生错误: {str(e)}")
+            post(('error', str(e)))
 
-if __name__ == "__main__":
+# ---------------------------------------------------------------------------
+# 按文字定位：每页只提取一次带位置的文字，按PDF内容哈希缓存文字位置索引，
+# 将“盖在某段文字处”的规则（如 {"text": "盖章处"}）解析为页面坐标
+# ---------------------------------------------------------------------------
+
+_TEXT_SHOW_OPERATORS = (b"Tj", b"TJ", b"'", b'"')
+
+def _char_advance(char):
+    """估计字符宽度（em）：全角字符 1，换行 0，空格 0.25，其余 0.5"""
+    if char in "\r\n":
+        return 0.0
+    if char.isspace():
+        return 0.25
+    return 1.0 if unicodedata.east_asian_width(char) in ("W", "F") else 0.5
+
+def _normalize_text(text):
+    """查找用的规范形式：NFKC（全角括号、冒号等归一）并去掉全部空白"""
+    return "".join(unicodedata.normalize("NFKC", text).split())
+
+def _matrix_multiply(m, n):
+    """PDF 矩阵 [a b c d e f] 相乘（先 m 后 n）"""
+    return [m[0] * n[0] + m[1] * n[2], m[0] * n[1] + m[1] * n[3],
+            m[2] * n[0] + m[3] * n[2], m[2] * n[1] + m[3] * n[3],
+            m[4] * n[0] + m[5] * n[2] + n[4], m[4] * n[1] + m[5] * n[3] + n[5]]
+
+def extract_text_runs(page):
+    """提取页面文字及其位置 [[文字, x, y, dx, dy, 字号], ...]（页面坐标，见 PageBox）
+
+    x/y 为这段文字起点的基线位置，(dx, dy) 为书写方向的单位向量，字号为页面坐标中
+    1em 的长度。PyPDF2 的 visitor_text 在换行、换字体等时机才交出累积的文字，此时
+    文字矩阵已移到下一行，因此起点取这段文字中第一个显示文字操作之前的 cm/tm。
+    没有 ToUnicode 的 CID 字体（如预置的 UniGB-UCS2-H）PyPDF2 无法解码，其中的文字查找不到。
+    """
+    box = PageBox(page)
+    runs = []
+    start = []  # 当前这段文字第一个显示文字操作之前的 (cm, tm)
+    
+    def before(operator, operands, cm, tm):
+        if operator in _TEXT_SHOW_OPERATORS and not start:
+            start.append((list(cm), list(tm)))
+    
+    def visit(text, cm, tm, font_dict, font_size):
+        if not start:
+            return
+        cm, tm = start.pop()
+        if not text.strip() or not font_size:
+            return
+        m = _matrix_multiply(tm, cm)
+        x, y = box.from_user(m[4], m[5])
+        end_x, end_y = box.from_user(m[4] + m[0] * font_size, m[5] + m[1] * font_size)
+        size = math.hypot(end_x - x, end_y - y)
+        if size == 0:
+            return
+        runs.append([text, round(x, 2), round(y, 2), round((end_x - x) / size, 4),
+                     round((end_y - y) / size, 4), round(size, 2)])
+    
+    page.extract_text(visitor_operand_before=before, visitor_text=visit)
+    return runs
+
+class TextIndex:
+    """一份PDF的文字位置索引：每页在首次查找时提取一次（extract_text_runs）
+
+    pages 为 {页码: 文字段列表}，可由 TextIndexCache 保存到磁盘并恢复；
+    dirty 表示有新提取的页面尚未保存。
+    """
+    def __init__(self, pdf_reader=None, key=None, pages=None):
+        self.pdf_reader = pdf_reader
+        self.key = key
+        self.pages = dict(pages or {})
+        self.dirty = False
+        self._lock = threading.Lock()
+        self._chars = {}  # {页码: (规范化文字, 各字符的 (起点, 终点, 方向, 字号))}
+    
+    def runs(self, page_num):
+        """该页的文字段（未提取过时提取）"""
+        with self._lock:
+            runs = self.pages.get(page_num)
+            if runs is None:
+                if self.pdf_reader is None:
+                    raise ValueError(f"文字索引中没有第 {page_num + 1} 页，且未关联PDF")
+                with TRACE.span("text_index.extract", page=page_num):
+                    runs = extract_text_runs(self.pdf_reader.pages[page_num])
+                self.pages[page_num] = runs
+                self.dirty = True
+            return runs
+    
+    def _page_chars(self, page_num):
+        chars = self._chars.get(page_num)
+        if chars is not None:
+            return chars
+        text, geometry = [], []
+        for run, x, y, dx, dy, size in self.runs(page_num):
+            offset = 0.0
+            for char in run:
+                advance = _char_advance(char) * size
+                for normalized in _normalize_text(char):
+                    text.append(normalized)
+                    geometry.append((x + dx * offset, y + dy * offset,
+                                     x + dx * (offset + advance), y + dy * (offset + advance),
+                                     dx, dy, size))
+                offset += advance
+        chars = self._chars[page_num] = ("".join(text), geometry)
+        return chars
+    
+    def find(self, text, pages):
+        """文字在各页出现处的中心 [(页码, x, y, 字号), ...]（页面坐标，按页码和出现顺序）
+
+        忽略空白并按 NFKC 比较，可跨越同一页中相邻的文字段；中心为首字起点与末字
+        终点的中点，再沿书写方向的法向上移 0.35em（约为字身中线）。
+        """
+        needle = _normalize_text(text)
+        if not needle:
+            raise ValueError("定位文字不能为空")
+        matches = []
+        for page_num in pages:
+            chars, geometry = self._page_chars(page_num)
+            position = chars.find(needle)
+            while position >= 0:
+                first, last = geometry[position], geometry[position + len(needle) - 1]
+                _, _, _, _, dx, dy, size = first
+                matches.append((page_num,
+                                (first[0] + last[2]) / 2 - dy * 0.35 * size,
+                                (first[1] + last[3]) / 2 + dx * 0.35 * size,
+                                size))
+                position = chars.find(needle, position + len(needle))
+        return matches
+
+def resolve_anchor_text(text_index, text, pages, occurrence="all", offset=(0, 0)):
+    """按文字定位 → [(页码, x, y), ...]（页面坐标）
+
+    occurrence 为 "all"（每处）、"first"、"last"，或整数 N（全文第 N 处，从1开始，
+    负数从末尾数）；offset 为相对文字中心的偏移（pt，页面坐标）。找不到时返回空列表。
+    """
+    matches = text_index.find(text, pages)
+    if occurrence in ("first", "last"):
+        occurrence = 1 if occurrence == "first" else -1
+    if occurrence != "all":
+        occurrence = int(occurrence)
+        if occurrence == 0:
+            raise ValueError("occurrence 从1开始计数")
+        index = occurrence - 1 if occurrence > 0 else occurrence
+        matches = [matches[index]] if -len(matches) <= index < len(matches) else []
+    dx, dy = offset
+    return [(page_num, x + dx, y + dy) for page_num, x, y, _ in matches]
+
+class TextIndexCache:
+    """文字位置索引缓存：内存中保留最近使用的 max_entries 份，并按内容哈希存为JSON
+
+    同一份PDF（内容相同，与路径无关）再次打开时不再提取文字；directory 为 None
+    时只用内存缓存。磁盘上超过 max_files 个索引时按修改时间淘汰最旧的，读写失败
+    一律当作未命中。
+    """
+    VERSION = 1
+    
+    def __init__(self, directory=None, max_entries=16, max_files=2000):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_files = max_files
+        self._lock = threading.Lock()
+        self._indexes = OrderedDict()  # {内容哈希: TextIndex}
+        self._digests = {}  # {(路径, 大小, 修改时间): 内容哈希}
+    
+    @classmethod
+    def default(cls):
+        """按环境变量创建：STMP_TEXT_CACHE 为目录（0/off 时只用内存缓存）"""
+        directory = os.environ.get("STMP_TEXT_CACHE")
+        if directory and directory.lower() in ("0", "off", "no", "false"):
+            return cls(None)
+        if not directory:
+            base = os.environ.get("LOCALAPPDATA") or os.path.join(os.path.expanduser("~"), ".cache")
+            directory = os.path.join(base, "stmp", "text")
+        return cls(directory)
+    
+    def document_key(self, pdf):
+        """PDF内容哈希：pdf 为路径（按路径、大小和修改时间记住）或 bytes"""
+        if isinstance(pdf, (bytes, bytearray)):
+            return hashlib.sha256(pdf).hexdigest()
+        stat = os.stat(pdf)
+        key = (os.path.abspath(pdf), stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            digest = self._digests.get(key)
+        if digest is None:
+            digest = file_digest(pdf)
+            with self._lock:
+                self._digests[key] = digest
+        return digest
+    
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+    
+    def index(self, pdf_reader, key):
+        """返回内容哈希为 key 的文字索引（内存 → 磁盘 → 新建），关联到 pdf_reader"""
+        with self._lock:
+            text_index = self._indexes.get(key)
+            if text_index is not None:
+                self._indexes.move_to_end(key)
+        if text_index is None:
+            pages = None
+            if self.directory:
+                try:
+                    with TRACE.span("text_index.load"):
+                        with open(self._path(key), "r", encoding="utf-8") as f:
+                            data = json.load(f)
+                    if data.get("version") == self.VERSION:
+                        pages = {int(page_num): runs for page_num, runs in data["pages"].items()}
+                except (OSError, ValueError, KeyError):
+                    pages = None
+            text_index = TextIndex(pdf_reader, key, pages)
+            with self._lock:
+                text_index = self._indexes.setdefault(key, text_index)
+                while len(self._indexes) > self.max_entries:
+                    self._indexes.popitem(last=False)
+        text_index.pdf_reader = pdf_reader
+        return text_index
+    
+    def save(self, text_index):
+        """将新提取的页面写入磁盘（先写临时文件再替换）"""
+        if not text_index.dirty or not self.directory or text_index.key is None:
+            return
+        with text_index._lock:
+            data = {"version": self.VERSION,
+                    "pages": {str(page_num): runs for page_num, runs in text_index.pages.items()}}
+            text_index.dirty = False
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".part")
+            try:
+                with TRACE.span("text_index.save"):
+                    with os.fdopen(fd, "w", encoding="utf-8") as f:
+                        json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+                os.replace(tmp_path, self._path(text_index.key))
+            except BaseException:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+                raise
+            self._evict()
+        except OSError:
+            text_index.dirty = True
+    
+    def _evict(self):
+        entries = [entry for entry in os.scandir(self.directory)
+                   if entry.name.endswith(".json") and entry.is_file()]
+        if len(entries) <= self.max_files:
+            return
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in entries[:len(entries) - self.max_files]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+# 进程内共用的文字索引缓存（批量与服务模式的工作进程各自一份，磁盘缓存共享）
+_text_index_cache = None
+
+def text_index_cache():
+    global _text_index_cache
+    if _text_index_cache is None:
+        _text_index_cache = TextIndexCache.default()
+    return _text_index_cache
+
+def layout_text_index(layout, pdf_reader, pdf):
+    """布局中有按文字定位的位置时返回缓存的文字索引，否则返回 None；pdf 为路径或 bytes"""
+    if not any("text" in item for item in layout.get("placements", [])):
+        return None
+    cache = text_index_cache()
+    return cache.index(pdf_reader, cache.document_key(pdf))
+
+# ---------------------------------------------------------------------------
+# 命令行批量模式：python stmp.py batch 输入... --layout 布局.json --out-dir 输出目录
+# ---------------------------------------------------------------------------
+
+def parse_page_spec(spec, total_pages):
+    """解析页码规格，返回从0开始的页码列表
+
+    支持 "all"、"odd"、"even"、"last"、"every N"（每N页一次，从第1页起）、
+    页码整数（从1开始）、"1,3,5-9" 形式的字符串（范围可带步长，如 "3-200/2"、
+    "5-/3"），以及由以上各项组成的列表。
+    """
+    if isinstance(spec, (list, tuple)):
+        pages = []
+        for item in spec:
+            pages.extend(parse_page_spec(item, total_pages))
+        return sorted(set(pages))
+    if isinstance(spec, int):
+        return [spec - 1] if 1 <= spec <= total_pages else []
+    
+    spec = str(spec).strip().lower()
+    if spec == "all":
+        return list(range(total_pages))
+    if spec == "odd":
+        return list(range(0, total_pages, 2))
+    if spec == "even":
+        return list(range(1, total_pages, 2))
+    if spec == "last":
+        return [total_pages - 1] if total_pages else []
+    if spec.startswith("every"):
+        spec = f"1-/{spec[len('every'):].strip()}"
+    
+    pages = set()
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        step = 1
+        if "/" in part:
+            part, step = part.split("/", 1)
+            step = int(step)
+            if step < 1:
+                raise ValueError(f"页码步长必须为正整数: {step}")
+            if "-" not in part:
+                part += "-"
+        if "-" in part:
+            start, end = part.split("-", 1)
+            start = int(start) if start.strip() else 1
+            end = int(end) if end.strip() else total_pages
+            pages.update(range(max(start, 1) - 1, min(end, total_pages), step))
+        else:
+            page = int(part)
+            if 1 <= page <= total_pages:
+                pages.add(page - 1)
+    return sorted(pages)
+
+def layout_to_placements(layout, pdf_reader, seal_sizes, text_index=None):
+    """将布局规格展开为 {页码: [(x, y, draw_width, draw_height, seal_id, rotation), ...]}
+
+    布局格式（x/y 为页面坐标，单位pt，原点在页面显示时可见区域的左下角，见 PageBox）：
+        {"stamp": "默认印章.png", "seals": {"合同章": "contract.png", ...},
+         "placements": [{"pages": "all", "x": 300, "y": 200, "size": 0.2,
+                         "seal": "合同章", "anchor": "center"},
+                        {"text": "盖章处", "occurrence": "all", "dx": 0, "dy": 0,
+                         "pages": "last", "seal": "合同章"}, ...]}
+    size 与界面一致：显示尺寸 = 印章原始像素尺寸 × size；未指定 seal 的位置
+    使用默认印章（seal_id 为 None）；anchor 见 ANCHORS，默认为印章中心。
+    带 "text" 的位置不用 x/y，而是盖在 pages 范围内该文字出现处（见 resolve_anchor_text），
+    dx/dy 为相对文字中心的偏移；找不到该文字时不盖章。
+    带 "rx"/"ry" 的位置（界面保存的布局）为印章中心在可见区域宽、高中的比例（0~1，
+    原点同样在左下角），各页按自身尺寸换算，并与界面导出一致地移回页面内。
+    seal_sizes 为 {seal_id: (宽, 高)}；text_index 为 None 时按需新建（不缓存）。
+    """
+    total_pages = len(pdf_reader.pages)
+    boxes = {}  # {页码: PageBox}
+    page_placements = {}
+    placements = layout.get("placements", [])
+    if not isinstance(placements, list) or not all(isinstance(item, dict) for item in placements):
+        raise ValueError("placements 应为对象列表")
+    for number, item in enumerate(placements, 1):
+        try:
+            seal_id = item.get("seal")
+            if seal_id not in seal_sizes:
+                raise ValueError(f"布局引用了未定义的印章: {seal_id}")
+            stamp_width, stamp_height = seal_sizes[seal_id]
+            size = float(item.get("size", 1.0))
+            anchor = item.get("anchor", "center")
+            pages = parse_page_spec(item.get("pages", "all"), total_pages)
+            if "text" in item:
+                if text_index is None:
+                    text_index = TextIndex(pdf_reader)
+                with TRACE.span("layout.anchor_text"):
+                    positions = resolve_anchor_text(
+                        text_index, item["text"], pages, item.get("occurrence", "all"),
+                        (float(item.get("dx", 0)), float(item.get("dy", 0))))
+            elif "rx" in item:
+                positions = [(page_num, float(item["rx"]), float(item["ry"]))
+                             for page_num in pages]
+            else:
+                positions = [(page_num, float(item["x"]), float(item["y"]))
+                             for page_num in pages]
+            relative = "rx" in item and "text" not in item
+            draw_width, draw_height = stamp_width * size, stamp_height * size
+            for page_num, x, y in positions:
+                box = boxes.get(page_num)
+                if box is None:
+                    box = boxes[page_num] = PageBox(pdf_reader.pages[page_num])
+                if relative:
+                    x, y = box.clamp(x * box.width, y * box.height, draw_width, draw_height)
+                page_placements.setdefault(page_num, []).append(box.placement(
+                    x, y, draw_width, draw_height, seal_id, anchor))
+        except (TypeError, AttributeError) as e:
+            # 字段类型不对（如 "size": null）同样是布局错误
+            raise ValueError(f"第 {number} 个位置无效: {e}") from e
+    return page_placements
+
+def layout_seal_paths(layout, default_stamp=None):
+    """布局中用到的印章图片 {seal_id: 路径}，默认印章的 seal_id 为 None"""
+    seal_paths = dict(layout.get("seals", {}))
+    default_stamp = default_stamp or layout.get("stamp")
+    if default_stamp:
+        seal_paths[None] = default_stamp
+    return seal_paths
+
+LAYOUT_VERSION = 1
+
+def pdf_source_info(pdf_path):
+    """布局文件中记录的源PDF：{"name": 文件名, "sha256": 内容哈希, "pages": 页数}"""
+    with TRACE.span("layout.source", pdf=os.path.basename(pdf_path)):
+        return {"name": os.path.basename(pdf_path), "sha256": file_digest(pdf_path),
+                "pages": len(PdfReader(pdf_path).pages)}
+
+def save_layout(path, layout):
+    """写出布局文件（先写临时文件再替换）；补上 "version" """
+    layout = {"version": LAYOUT_VERSION, **layout}
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".part")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(layout, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def load_layout(path):
+    """读取布局文件（手写的批量布局或界面保存的布局），不读取PDF、不渲染页面"""
+    with open(path, "r", encoding="utf-8") as f:
+        layout = json.load(f)
+    if not isinstance(layout, dict) or not isinstance(layout.get("placements", []), list):
+        raise ValueError(f"无效的布局文件: {path}")
+    version = layout.get("version", LAYOUT_VERSION)
+    if not isinstance(version, int) or version > LAYOUT_VERSION:
+        raise ValueError(f"布局文件版本 {version} 过新（支持到 {LAYOUT_VERSION}）")
+    return layout
+
+# 批量模式工作进程内的印章（每个进程只加载和处理一次）{seal_id: (ImageReader, 宽, 高)}
+_batch_seals = None
+
+def _batch_worker_init(seal_paths, process, trace=False):
+    global _batch_seals
+    if trace:
+        TRACE.enable(path=None)  # 事件随每个文件的结果返回主进程
+    _batch_seals = {}
+    for seal_id, stamp_path in seal_paths.items():
+        stamp_img = Image.open(stamp_path).convert("RGBA")
+        if process:
+            stamp_img = process_stamp_image(stamp_img)
+        _batch_seals[seal_id] = (ImageReader(stamp_img), stamp_img.width, stamp_img.height)
+
+def _batch_stamp_file(pdf_path, output_path, layout, incremental=False, encoding=None,
+                      compact=False):
+    """在工作进程中为单个文件盖章，返回 (耗时秒数, 追踪事件)"""
+    start = time.perf_counter()
+    stamp_images = {seal_id: seal[0] for seal_id, seal in _batch_seals.items()}
+    seal_sizes = {seal_id: seal[1:] for seal_id, seal in _batch_seals.items()}
+    try:
+        with TRACE.span("batch.file", pdf=os.path.basename(pdf_path)):
+            with TRACE.span("export.read"):
+                pdf_reader = PdfReader(pdf_path)
+            text_index = layout_text_index(layout, pdf_reader, pdf_path)
+            page_placements = layout_to_placements(layout, pdf_reader, seal_sizes, text_index)
+            if text_index is not None:
+                text_index_cache().save(text_index)
+            if incremental:
+                append_stamped_pdf(pdf_path, page_placements, stamp_images, output_path,
+                                   pdf_reader=pdf_reader, encoding=encoding)
+            else:
+                write_stamped_pdf(pdf_reader, page_placements, stamp_images, output_path,
+                                  encoding=encoding, compact=compact)
+    except Exception:
+        TRACE.drain()
+        if os.path.exists(output_path):
+            try:
+                os.remove(output_path)
+            except OSError:
+                pass
+        raise
+    return time.perf_counter() - start, TRACE.drain()
+
+def add_encoding_arguments(parser):
+    """印章图像编码相关的命令行参数（batch 与 serve 共用）"""
+    parser.add_argument("--seal-dpi", type=float,
+                        help="按绘制尺寸将印章重采样到该分辨率（默认嵌入原始像素）")
+    parser.add_argument("--seal-format", choices=SealEncoding.FORMATS,
+                        help="印章图像编码：flate 无损，jpeg 颜色有损、透明度无损，"
+                             "vector 描摹为单色矢量路径")
+    parser.add_argument("--jpeg-quality", type=int, default=85, help="jpeg 编码质量（1-95）")
+    parser.add_argument("--vector-tolerance", type=float, default=1.0,
+                        help="vector 描摹的简化容差（像素，越大路径越少、越平滑）")
+
+def encoding_from_args(args):
+    """命令行参数 → SealEncoding；均未指定时返回 None（保持默认输出）"""
+    if args.seal_dpi is None and args.seal_format is None:
+        return None
+    return SealEncoding(dpi=args.seal_dpi, format=args.seal_format or "flate",
+                        quality=args.jpeg_quality, tolerance=args.vector_tolerance)
+
+def collect_pdf_inputs(inputs):
+    """展开输入（文件、目录或通配符）为PDF文件列表"""
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            matches = sorted(glob.glob(os.path.join(item, "*.pdf")))
+        else:
+            matches = sorted(glob.glob(item)) or [item]
+        for path in matches:
+            if path not in paths:
+                paths.append(path)
+    return paths
+
+def batch_output_paths(pdf_paths, out_dir):
+    """输入PDF → 输出路径 {输入: 输出}
+
+    默认输出为 out_dir/文件名_stamped.pdf；不同目录下的同名文件各自保留相对于
+    它们公共上级目录的子目录（如 a/x.pdf、b/x.pdf → out_dir/a/、out_dir/b/），互不覆盖。
+    """
+    groups = {}
+    for pdf_path in pdf_paths:
+        base_name = os.path.splitext(os.path.basename(pdf_path))[0]
+        groups.setdefault(os.path.normcase(base_name), []).append(pdf_path)
+    outputs = {}
+    for paths in groups.values():
+        if len(paths) == 1:
+            subdirs = [""]
+        else:
+            # 不同盘符的路径没有公共目录，去掉盘符后比较（仍然相同时由调用方报告冲突）
+            parents = [os.path.splitdrive(os.path.dirname(os.path.abspath(path)))[1]
+                       for path in paths]
+            common = os.path.commonpath(parents)
+            subdirs = [os.path.relpath(parent, common) for parent in parents]
+        for pdf_path, subdir in zip(paths, subdirs):
+            base_name = os.path.splitext(os.path.basename(pdf_path))[0]
+            outputs[pdf_path] = os.path.normpath(
+                os.path.join(out_dir, subdir, f"{base_name}_stamped.pdf"))
+    return outputs
+
+def run_batch(args):
+    """批量盖章：按文件分发到进程池，逐个报告耗时和失败"""
+    layout = load_layout(args.layout)
+    seal_paths = layout_seal_paths(layout, args.stamp)
+    if not seal_paths:
+        print("错误: 未指定印章图片（--stamp 或布局中的 \"stamp\"/\"seals\"）")
+        return 2
+    
+    pdf_paths = collect_pdf_inputs(args.inputs)
+    if not pdf_paths:
+        print("错误: 没有找到PDF文件")
+        return 2
+    os.makedirs(args.out_dir, exist_ok=True)
+    
+    # 同名输入保留子目录；仍会写到同一输出的（同一文件的不同写法等）只处理第一个
+    output_paths = batch_output_paths(pdf_paths, args.out_dir)
+    claimed = {}  # {规范化的输出路径: 输入}
+    conflicts = []
+    for pdf_path in pdf_paths:
+        key = os.path.normcase(os.path.abspath(output_paths[pdf_path]))
+        if key in claimed:
+            conflicts.append(pdf_path)
+            print(f"失败 {pdf_path}: 输出 {output_paths[pdf_path]} 与 {claimed[key]} 相同，已跳过")
+        else:
+            claimed[key] = pdf_path
+    if any(os.path.dirname(path) != os.path.normpath(args.out_dir)
+           for path in output_paths.values()):
+        print("注意: 不同目录下有同名文件，其输出保留各自的子目录")
+    
+    workers = args.workers or os.cpu_count() or 1
+    encoding = encoding_from_args(args)
+    failures = len(conflicts)
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_batch_worker_init,
+                             initargs=(seal_paths, not args.raw, TRACE.enabled)) as executor:
+        futures = {}
+        for pdf_path in pdf_paths:
+            if pdf_path in conflicts:
+                continue
+            output_path = output_paths[pdf_path]
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            futures[executor.submit(_batch_stamp_file, pdf_path, output_path, layout,
+                                     args.incremental, encoding,
+                                     args.compact)] = (pdf_path, output_path)
+        
+        for future in as_completed(futures):
+            pdf_path, output_path = futures[future]
+            try:
+                elapsed, events = future.result()
+                TRACE.merge(events)
+                note = ""
+                if args.compact and not args.incremental:
+                    note = "，" + describe_size_change(os.path.getsize(pdf_path),
+                                                      os.path.getsize(output_path))
+                print(f"完成 {pdf_path} ({elapsed * 1000:.0f} ms{note})")
+            except Exception as e:
+                failures += 1
+                print(f"失败 {pdf_path}: {str(e)}")
+    
+    total = time.perf_counter() - start
+    done = len(pdf_paths) - failures
+    print(f"共 {len(pdf_paths)} 个文件，成功 {done}，失败 {failures}，"
+          f"用时 {total:.2f} 秒（{len(pdf_paths) / total:.1f} 个/秒，{workers} 个进程）")
+    return 1 if failures else 0
+
+# ---------------------------------------------------------------------------
+# 本地HTTP服务模式：python stmp.py serve --stamp 印章.png [--seal ID=路径 ...]
+#   POST /stamp   请求体为PDF，布局JSON（格式同批量模式，仅使用 placements）放在
+#                 X-Stamp-Layout 头（非ASCII字符需转义为 \uXXXX）或 layout 查询参数中，
+#                 ?incremental=1 时增量保存；响应体为盖章后的PDF
+#   GET  /stats   吞吐与延迟统计（JSON）
+#   GET  /health  存活检查
+# ---------------------------------------------------------------------------
+
+def _serve_stamp(pdf_data, layout, incremental=False, encoding=None):
+    """在工作进程中为内存中的PDF盖章，返回 (输出PDF的bytes, 追踪事件)"""
+    stamp_images = {seal_id: seal[0] for seal_id, seal in _batch_seals.items()}
+    seal_sizes = {seal_id: seal[1:] for seal_id, seal in _batch_seals.items()}
+    try:
+        with TRACE.span("serve.request", bytes=len(pdf_data)):
+            with TRACE.span("export.read"):
+                pdf_reader = PdfReader(io.BytesIO(pdf_data))
+            text_index = layout_text_index(layout, pdf_reader, pdf_data)
+            page_placements = layout_to_placements(layout, pdf_reader, seal_sizes, text_index)
+            if text_index is not None:
+                text_index_cache().save(text_index)
+            if not incremental:
+                output = io.BytesIO()
+                write_stamped_pdf(pdf_reader, page_placements, stamp_images, output,
+                                  encoding=encoding)
+                return output.getvalue(), TRACE.drain()
+            # 增量保存需要文件：写入临时文件后原地追加
+            with tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, "input.pdf")
+                with open(path, "wb") as f:
+                    f.write(pdf_data)
+                append_stamped_pdf(path, page_placements, stamp_images, path,
+                                   pdf_reader=pdf_reader, encoding=encoding)
+                with open(path, "rb") as f:
+                    return f.read(), TRACE.drain()
+    except Exception:
+        TRACE.drain()
+        raise
+
+class ServiceBusy(Exception):
+    """请求队列已满"""
+
+class StampService:
+    """盖章服务：有界进程池 + 有界请求队列，队列满时立即拒绝（背压），并统计吞吐与延迟
+
+    同时处理或排队的请求最多 workers + queue_size 个；请求超时后其任务仍占用名额，
+    直到工作进程真正完成，因此慢请求不会让积压无限增长。
+    encoding（SealEncoding）为所有请求共用的印章图像编码方式。
+    """
+    def __init__(self, seal_paths, workers=None, queue_size=16, process=True,
+                 max_bytes=100 * 1024 * 1024, timeout=120.0, latency_window=1024,
+                 encoding=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.encoding = encoding
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.seal_ids = list(seal_paths)
+        self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_batch_worker_init,
+                                             initargs=(seal_paths, process, TRACE.enabled))
+        self._slots = threading.BoundedSemaphore(self.workers + queue_size)
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._pending = 0
+        self._counters = {'requests': 0, 'ok': 0, 'rejected': 0, 'client_errors': 0,
+                          'errors': 0, 'timeouts': 0, 'bytes_in': 0, 'bytes_out': 0}
+        self._latencies = deque(maxlen=latency_window)  # [(完成时间, 耗时秒数)]
+    
+    def count(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+    
+    def _release(self, future):
+        with self._lock:
+            self._pending -= 1
+        self._slots.release()
+    
+    def stamp(self, pdf_data, layout, incremental=False):
+        """盖章并返回输出PDF；队列满时抛出 ServiceBusy，超时抛出 concurrent.futures.TimeoutError"""
+        if not self._slots.acquire(blocking=False):
+            self.count('rejected')
+            raise ServiceBusy()
+        with self._lock:
+            self._pending += 1
+        start = time.perf_counter()
+        try:
+            future = self._executor.submit(_serve_stamp, pdf_data, layout, incremental,
+                                           self.encoding)
+        except BaseException:
+            self._release(None)
+            raise
+        future.add_done_callback(self._release)
+        try:
+            data, events = future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            self.count('timeouts')
+            raise
+        TRACE.merge(events)
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self._counters['ok'] += 1
+            self._counters['bytes_in'] += len(pdf_data)
+            self._counters['bytes_out'] += len(data)
+            self._latencies.append((time.time(), elapsed))
+        return data
+    
+    def stats(self):
+        """吞吐与延迟统计（延迟取最近 latency_window 个成功请求，单位毫秒）"""
+        now = time.time()
+        with self._lock:
+            counters = dict(self._counters)
+            pending = self._pending
+            latencies = sorted(elapsed for _, elapsed in self._latencies)
+            recent = sum(1 for finished, _ in self._latencies if finished >= now - 60)
+        uptime = now - self._started
+        
+        def percentile(p):
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))] * 1000, 1)
+        
+        counters.update({
+            'uptime_s': round(uptime, 1),
+            'workers': self.workers,
+            'queue_size': self.queue_size,
+            'in_flight': min(pending, self.workers),
+            'queued': max(0, pending - self.workers),
+            'throughput_rps': round(counters['ok'] / uptime, 3) if uptime > 0 else 0.0,
+            'throughput_rps_1m': round(recent / min(60.0, uptime), 3) if uptime > 0 else 0.0,
+            'latency_ms': {
+                'mean': round(sum(latencies) / len(latencies) * 1000, 1) if latencies else None,
+                'p50': percentile(50), 'p95': percentile(95), 'p99': percentile(99),
+                'max': round(latencies[-1] * 1000, 1) if latencies else None,
+            },
+        })
+        return counters
+    
+    def make_server(self, host="127.0.0.1", port=8765):
+        server = ThreadingHTTPServer((host, port), _StampRequestHandler)
+        server.daemon_threads = True
+        server.service = self
+        return server
+    
+    def close(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+class _StampRequestHandler(BaseHTTPRequestHandler):
+    server_version = "stmp/1.0"
+    protocol_version = "HTTP/1.1"
+    chunk_size = 64 * 1024
+    
+    def log_message(self, format, *args):
+        pass
+    
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def _error(self, status, message, headers=None):
+        if status >= 500 and status != 503:
+            self.server.service.count('errors')
+        elif status != 503:
+            self.server.service.count('client_errors')
+        self._send_json(status, {'error': message}, headers)
+    
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if path == "/stats":
+            self._send_json(200, self.server.service.stats())
+        elif path == "/health":
+            self._send_json(200, {'status': 'ok', 'seals': self.server.service.seal_ids})
+        else:
+            self._send_json(404, {'error': "未知路径"})
+    
+    def do_POST(self):
+        service = self.server.service
+        url = urlsplit(self.path)
+        if url.path != "/stamp":
+            self._send_json(404, {'error': "未知路径"})
+            return
+        service.count('requests')
+        
+        length = self.headers.get("Content-Length")
+        if length is None:
+            self.close_connection = True
+            self._error(411, "需要 Content-Length")
+            return
+        try:
+            length = int(length)
+        except ValueError:
+            length = -1
+        if length < 0:
+            # 无法确定请求体的边界，读取剩余数据也不可靠，回复后关闭连接
+            self.close_connection = True
+            self._error(400, "Content-Length 无效")
+            return
+        if length > service.max_bytes:
+            self.close_connection = True
+            self._error(413, f"PDF超过 {service.max_bytes} 字节")
+            return
+        pdf_data = self.rfile.read(length)
+        
+        query = parse_qs(url.query)
+        try:
+            layout = json.loads(self.headers.get("X-Stamp-Layout")
+                                or query.get("layout", [""])[0] or "{}")
+            if not isinstance(layout, dict) or not layout.get("placements"):
+                raise ValueError("布局中没有 placements")
+            if not isinstance(layout["placements"], list) or not all(
+                    isinstance(item, dict) for item in layout["placements"]):
+                raise ValueError("placements 应为对象列表")
+            # 印章只能使用服务启动时加载的，请求不能指定服务器上的图片路径
+            layout = {'placements': layout['placements']}
+        except ValueError as e:
+            self._error(400, f"布局无效: {e}")
+            return
+        incremental = query.get("incremental", ["0"])[0].lower() in ("1", "true", "yes")
+        
+        start = time.perf_counter()
+        try:
+            data = service.stamp(pdf_data, layout, incremental)
+        except ServiceBusy:
+            self._error(503, "服务繁忙，请稍后重试", {'Retry-After': "1"})
+            return
+        except FutureTimeoutError:
+            self._error(504, "处理超时")
+            return
+        except (ValueError, KeyError, PdfReadError) as e:
+            self._error(400, f"{type(e).__name__}: {e}")
+            return
+        except Exception as e:
+            self._error(500, f"{type(e).__name__}: {e}")
+            return
+        
+        # 分块写回，不在一次 write 中发送整个文件
+        self.send_response(200)
+        self.send_header("Content-Type", "application/pdf")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("X-Stamp-Elapsed-Ms", f"{(time.perf_counter() - start) * 1000:.1f}")
+        self.end_headers()
+        view = memoryview(data)
+        for offset in range(0, len(view), self.chunk_size):
+            self.wfile.write(view[offset:offset + self.chunk_size])
+
+def run_serve(args):
+    """启动本地盖章服务，Ctrl+C 退出"""
+    seal_paths = {None: args.stamp} if args.stamp else {}
+    for item in args.seal:
+        seal_id, sep, path = item.partition("=")
+        if not sep:
+            print(f"错误: --seal 格式应为 ID=路径: {item}")
+            return 2
+        seal_paths[seal_id] = path
+    if not seal_paths:
+        print("错误: 未指定印章图片（--stamp 或 --seal ID=路径）")
+        return 2
+    
+    service = StampService(seal_paths, workers=args.workers, queue_size=args.queue,
+                           process=not args.raw, max_bytes=args.max_mb * 1024 * 1024,
+                           timeout=args.timeout, encoding=encoding_from_args(args))
+    server = service.make_server(args.host, args.port)
+    print(f"盖章服务已启动: http://{args.host}:{server.server_port}/stamp "
+          f"（{service.workers} 个进程，队列 {service.queue_size}）")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+    return 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="PDF多页盖章工具（不带参数时启动图形界面）")
+    parser.add_argument("--trace", metavar="输出.json",
+                        help="记录各阶段耗时，退出时写出 Chrome trace 并打印汇总表"
+                             "（也可用环境变量 STMP_TRACE）")
+    subparsers = parser.add_subparsers(dest="command")
+    
+    batch = subparsers.add_parser("batch", help="批量为PDF文件盖章（无界面）")
+    batch.add_argument("inputs", nargs="+", help="PDF文件、目录或通配符")
+    batch.add_argument("--layout", required=True, help="JSON布局文件")
+    batch.add_argument("--stamp", help="印章图片（默认使用布局中的 stamp）")
+    batch.add_argument("--out-dir", required=True, help="输出目录")
+    batch.add_argument("--workers", type=int, default=0, help="工作进程数（默认为CPU核数）")
+    batch.add_argument("--raw", action="store_true", help="直接使用原始印章图片，不做透明化/着色")
+    batch.add_argument("--incremental", action="store_true",
+                       help="增量保存：复制原文件并在末尾追加印章，不重写原有内容")
+    batch.add_argument("--compact", action="store_true",
+                       help="紧凑输出：合并重复对象、压缩内容流并写入对象流（--incremental 时不生效）")
+    add_encoding_arguments(batch)
+    
+    serve = subparsers.add_parser("serve", help="启动本地HTTP盖章服务")
+    serve.add_argument("--host", default="127.0.0.1", help="监听地址（默认仅本机）")
+    serve.add_argument("--port", type=int, default=8765, help="监听端口")
+    serve.add_argument("--stamp", help="默认印章图片（布局中未指定 seal 的位置使用）")
+    serve.add_argument("--seal", action="append", default=[], metavar="ID=路径",
+                       help="其他印章，可多次指定；布局中用 \"seal\": ID 引用")
+    serve.add_argument("--workers", type=int, default=0, help="工作进程数（默认为CPU核数）")
+    serve.add_argument("--queue", type=int, default=16, help="排队请求数上限，超出时返回503")
+    serve.add_argument("--max-mb", type=int, default=100, help="单个PDF大小上限（MB）")
+    serve.add_argument("--timeout", type=float, default=120.0, help="单个请求超时（秒）")
+    serve.add_argument("--raw", action="store_true", help="直接使用原始印章图片，不做透明化/着色")
+    add_encoding_arguments(serve)
+    
+    args = parser.parse_args(argv)
+    if args.trace:
+        TRACE.enable(args.trace)
+    if args.command == "batch":
+        return run_batch(args)
+    if args.command == "serve":
+        return run_serve(args)
+    
     root = tk.Tk()
     app = StampApp(root)
-    root.mainloop()
\ No newline at end of file
+    root.mainloop()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
\ No newline at end of file